@@ -0,0 +1,83 @@
+import importlib
+import importlib.util
+import os
+
+# Бэкенды: XML-форматы, .xls без Excel и .doc без Word обрабатываются в пуле процессов,
+# COM-приложения — каждое в своём дочернем процессе
+WORD = 'word'
+EXCEL = 'excel'
+BIFF = 'biff'
+WW8 = 'ww8'
+XLS = 'xls'
+DOC = 'doc'
+DWG = 'dwg'
+SHA = 'sha'
+
+XML_BACKENDS = (WORD, EXCEL, BIFF, WW8)
+COM_BACKENDS = (XLS, DOC, DWG, SHA)
+
+# Конвертация файлов, которые нельзя изменить на месте: {бэкенд: (COM-конвертер, расширение результата)}
+CONVERSIONS = {BIFF: (XLS, '.xlsm'), WW8: (DOC, '.docx')}
+# Обработка результата конвертации: {COM-конвертер: бэкенд пула}
+CONVERTED = {XLS: EXCEL, DOC: WORD}
+
+
+class Backend:
+    """Описание бэкенда: модуль с обработчиком импортируется только при первом использовании.
+
+    Доступность проверяется через importlib.util.find_spec, без импорта
+    win32com, pythoncom и прочих тяжёлых модулей.
+    """
+
+    def __init__(self, name, module, class_name, requires):
+        self.name = name
+        self.module = module
+        self.class_name = class_name
+        self.requires = requires
+        self._class = None
+        self._available = None
+
+    def missing(self):
+        """Модули, которых нет в окружении (пустой список — бэкенд доступен)."""
+        return [name for name in self.requires if importlib.util.find_spec(name) is None]
+
+    def available(self):
+        if self._available is None:
+            self._available = not self.missing()
+        return self._available
+
+    def load(self):
+        if self._class is None:
+            self._class = getattr(importlib.import_module(self.module), self.class_name)
+        return self._class
+
+
+BACKENDS = {
+    WORD: Backend(WORD, 'word_parser', 'WordProcessor', ('lxml',)),
+    EXCEL: Backend(EXCEL, 'excel_parser', 'ExcelProcessor', ('lxml',)),
+    BIFF: Backend(BIFF, 'xls_biff', 'XlsProcessor', ('lxml',)),
+    WW8: Backend(WW8, 'word_binary', 'DocProcessor', ('lxml',)),
+    XLS: Backend(XLS, 'excel_parser', 'XlsConverter', ('lxml', 'win32com', 'pythoncom')),
+    DOC: Backend(DOC, 'word_parser', 'DocConverter', ('lxml', 'win32com', 'pythoncom')),
+    DWG: Backend(DWG, 'dwg_parser', 'AutoCADProcessor', ('win32com', 'pythoncom', 'psutil')),
+    SHA: Backend(SHA, 'sha_parser', 'ShaProcessorWinAPI', ('win32com', 'pythoncom', 'pywintypes', 'winreg')),
+}
+
+_EXTENSIONS = {
+    '.doc': WW8,  # через Word (DOC) — только если правка на месте невозможна
+    '.docx': WORD, '.dotx': WORD,
+    '.xlsx': EXCEL, '.xlsm': EXCEL,
+    '.xls': BIFF,  # через Excel (XLS) — только если правка на месте невозможна
+    '.dwg': DWG,
+    '.sha': SHA,
+}
+
+
+def backend_for(path):
+    """Бэкенд по расширению файла или None для неподдерживаемого формата."""
+    return _EXTENSIONS.get(os.path.splitext(path)[1].lower())
+
+
+def load(name):
+    """Класс обработчика бэкенда (импорт модуля при первом обращении)."""
+    return BACKENDS[name].load()
@@ -0,0 +1,203 @@
+import argparse
+import glob
+import os
+import re
+import sys
+from datetime import datetime
+from multiprocessing import freeze_support
+from backends import BACKENDS, DWG, backend_for
+from corpus_index import default_index_path, select_indexed
+from io_pipeline import is_network_path
+from metrics import export_metrics
+from part_cache import default_cache_path
+from profiling import ProfileSettings
+from scheduler import BatchScheduler, Job
+
+UNITS = ("1", "2", "3", "4")
+
+
+def select_files(input_dir):
+    excel_files = glob.glob(os.path.join(input_dir, '*.xls*'))
+    word_files = glob.glob(os.path.join(input_dir, '*.do*'))
+    dwg_files = glob.glob(os.path.join(input_dir, '*.dwg'))
+    sha_files = glob.glob(os.path.join(input_dir, '*.sha'))
+    files = excel_files + word_files + dwg_files + sha_files
+    return files
+
+
+def make_output_path(input_path, output_dir, replacement_digit):
+    filename = os.path.basename(input_path)
+    name, ext = os.path.splitext(filename)
+
+    if name[0].isdigit():
+        new_name = f"{replacement_digit}{name[1:]}"
+    elif name.startswith("ED.D."):
+        new_name = re.sub(
+            r'(ED\.D\.[A-Z]\d{3}\.)(\d)',
+            lambda m: f"{m.group(1)}{replacement_digit}",
+            name
+        )
+    else:
+        new_name = f"processed_{name}"
+
+    return os.path.join(output_dir, new_name + ext)
+
+
+def make_jobs(input_files, output_dir, replacement_digit, log, all_units=False, installed_only=True):
+    """Задания пакета: бэкенд и пути результатов каждого файла; папки результатов создаются.
+
+    installed_only=False — без проверки установленных модулей бэкендов
+    (задания выполнит другой компьютер, см. job_queue).
+    """
+    os.makedirs(output_dir, exist_ok=True)
+
+    # Режим всех блоков: файл открывается один раз, результаты — в подпапки "Блок N"
+    if all_units:
+        unit_dirs = {digit: os.path.join(output_dir, f"Блок {digit}") for digit in UNITS}
+    else:
+        unit_dirs = {replacement_digit: output_dir}
+    for unit_dir in unit_dirs.values():
+        os.makedirs(unit_dir, exist_ok=True)
+
+    jobs = []
+    for input_path in input_files:
+        filename = os.path.basename(input_path)
+        backend = backend_for(input_path)
+        if backend is None:
+            extension = os.path.splitext(filename)[1].lower()
+            log(f"Пропуск {filename} (неподдерживаемый формат: {extension})")
+            continue
+        if installed_only and not BACKENDS[backend].available():
+            missing = ", ".join(BACKENDS[backend].missing())
+            log(f"Пропуск {filename} (не установлены модули: {missing})")
+            continue
+        try:
+            outputs = {digit: make_output_path(input_path, unit_dir, digit)
+                       for digit, unit_dir in unit_dirs.items()}
+        except Exception as e:
+            log(f"Критическая ошибка {filename}: {str(e)}")
+            continue
+        jobs.append(Job(input_path, outputs, backend))
+    return jobs
+
+
+def process_files(input_files, output_dir, replacement_digit, log, debug=False, all_units=False, idle=None,
+                  staging=None, job_timeout=None, dwg_editor=False, part_cache=True, daemon=False,
+                  profile=None, index=None, metrics=None):
+    """Обработка пакета файлов; возвращает число успешно обработанных.
+
+    Используется и GUI, и командной строкой: log получает все сообщения,
+    idle вызывается, пока идёт ожидание результатов. staging — локальная
+    подготовка файлов (None — включается сама для сетевых папок), job_timeout —
+    предельное время одного файла AutoCAD/SmartSketch/Excel, секунды,
+    dwg_editor — открывать чертежи в редакторе AutoCAD вместо ObjectDBX,
+    part_cache — каталог кэша обработанных частей Word/Excel (True — в профиле
+    пользователя, False — без кэша). daemon — отдать пакет запущенному фоновому
+    обработчику (worker_daemon), если он есть; тогда staging, job_timeout,
+    dwg_editor, part_cache и index берутся из его настроек. profile — профилирование
+    файлов (profiling.ProfileSettings): отчёты .prof и .alloc.txt рядом с результатами;
+    пакет с профилированием всегда обрабатывается в этом процессе. index — файл
+    индекса идентификаторов (corpus_index), который пополняется при обработке.
+    metrics — куда экспортировать метрики пакета во время работы: файл *.prom
+    или [АДРЕС:]ПОРТ для HTTP (см. metrics.start_exporter).
+    """
+    if daemon and profile is None:
+        from worker_daemon import run_remote
+        processed = run_remote(input_files, output_dir, replacement_digit, log, all_units=all_units, idle=idle)
+        if processed is not None:
+            return processed
+        if debug:
+            log("Фоновый обработчик не запущен, пакет обрабатывается в этом процессе")
+
+    processed = 0
+    jobs = make_jobs(input_files, output_dir, replacement_digit, log, all_units=all_units)
+
+    if staging is None:
+        staging = any(is_network_path(path) for path in
+                      {os.path.dirname(job.input_path) for job in jobs} | {output_dir})
+    if staging and debug:
+        log("Сетевые папки: упреждающее чтение и отложенная запись через локальную папку")
+
+    # Word/Excel — в пуле процессов, AutoCAD/SmartSketch/конвертация .xls и .doc — параллельно в своих потоках
+    if part_cache is True:
+        part_cache = default_cache_path()
+    registry, exporter = export_metrics(metrics, log) if metrics else (None, None)
+    scheduler = BatchScheduler(replacement_digit, debug=debug, staging=staging, job_timeout=job_timeout,
+                               backend_options={DWG: {'database_only': not dwg_editor}},
+                               part_cache=part_cache or None, profile=profile, index=index, metrics=registry)
+    try:
+        for job, success in scheduler.run(jobs, log=log, idle=idle):
+            if success:
+                log(f"Успешно: {job.filename}")
+                processed += 1
+            else:
+                log(f"Ошибка обработки: {job.filename}")
+    finally:
+        if exporter is not None:
+            exporter.stop()
+
+    return processed
+
+
+def main(argv=None):
+    """Запуск без GUI: python batch.py --input DIR --output DIR --digit N."""
+    parser = argparse.ArgumentParser(description="Пакетная обработка Excel, Word, DWG и SHA без GUI")
+    parser.add_argument("--input", required=True, help="Папка с исходными файлами")
+    parser.add_argument("--output", required=True, help="Папка для сохранения новых файлов")
+    parser.add_argument("--digit", default="1", choices=UNITS, help="Номер блока")
+    parser.add_argument("--all-units", action="store_true", help="Все блоки (1–4) в подпапки \"Блок N\"")
+    parser.add_argument("--staging", default="auto", choices=("auto", "on", "off"),
+                        help="Локальная подготовка файлов (auto — для сетевых папок)")
+    parser.add_argument("--job-timeout", type=float, help="Предельное время одного файла DWG/SHA/XLS/DOC, секунды")
+    parser.add_argument("--dwg-editor", action="store_true",
+                        help="Открывать чертежи в редакторе AutoCAD (без ObjectDBX)")
+    parser.add_argument("--part-cache", help="Каталог кэша обработанных частей Word/Excel")
+    parser.add_argument("--no-part-cache", action="store_true", help="Не использовать кэш частей")
+    parser.add_argument("--profile", type=ProfileSettings.parse, metavar="РЕЖИМ",
+                        help="Профилирование: all, sample=ДОЛЯ, slow=СЕКУНДЫ, rss=МБ (через запятую)")
+    parser.add_argument("--index", nargs="?", const=True, metavar="ФАЙЛ",
+                        help="Пополнять индекс идентификаторов при обработке (по умолчанию — в профиле пользователя)")
+    parser.add_argument("--select", action="append", metavar="ИД",
+                        help="Только файлы, в которых индекс находит идентификатор (можно повторять)")
+    parser.add_argument("--metrics", metavar="ФАЙЛ.prom|ПОРТ",
+                        help="Метрики Prometheus во время работы: файл для textfile collector или HTTP-порт")
+    parser.add_argument("--daemon", action="store_true",
+                        help="Отдать пакет фоновому обработчику (worker_daemon.py), если он запущен")
+    parser.add_argument("--debug", action="store_true", help="Отладочные логи")
+    args = parser.parse_args(argv)
+
+    if not os.path.isdir(args.input):
+        parser.error("папка с исходными файлами не найдена")
+    os.makedirs(args.output, exist_ok=True)
+
+    with open(os.path.join(args.output, "log.txt"), 'a', encoding='utf-8') as log_file:
+        def log(message):
+            log_message = f"[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] {message}"
+            print(log_message)
+            log_file.write(log_message + "\n")
+            log_file.flush()
+
+        log("=== Запуск обработки ===")
+        input_files = select_files(args.input)
+        index = default_index_path() if args.index is True else args.index
+        if args.select and input_files:
+            input_files = select_indexed(index or default_index_path(), input_files, args.select, log)
+        if not input_files:
+            log("Файлы не найдены.")
+            return 1
+
+        processed_count = process_files(input_files, args.output, args.digit, log,
+                                        debug=args.debug, all_units=args.all_units,
+                                        staging={"auto": None, "on": True, "off": False}[args.staging],
+                                        job_timeout=args.job_timeout, dwg_editor=args.dwg_editor,
+                                        part_cache=False if args.no_part_cache else args.part_cache or True,
+                                        daemon=args.daemon, profile=args.profile, index=index,
+                                        metrics=args.metrics)
+        log(f"Обработка завершена. Успешно обработано: {processed_count}/{len(input_files)}")
+        log(f"Результаты сохранены в: {args.output}")
+    return 0 if processed_count == len(input_files) else 1
+
+
+if __name__ == "__main__":
+    freeze_support()  # для пула процессов в сборке PyInstaller
+    sys.exit(main())
@@ -0,0 +1,294 @@
+import copy
+import multiprocessing
+from multiprocessing.connection import wait
+import os
+import time
+from backends import XLS, DOC, DWG, SHA, load
+from corpus_index import record_texts
+from host_process import kill_process, process_usage
+from profiling import report_dir, run_stage
+from retry import take_waits
+from rules import merge_rule_stats, take_rule_stats
+
+# Предельное время одного задания, секунды (включая запуск приложения)
+JOB_TIMEOUTS = {DWG: 600, SHA: 300, XLS: 300, DOC: 300}
+
+# Перезапуск дочернего процесса вместе с приложением: после стольких заданий,
+# при таком объёме памяти или числе дескрипторов (приложения или дочернего процесса)
+RECYCLE_JOBS = 200
+RECYCLE_RSS = 1536 * 1024 * 1024
+RECYCLE_HANDLES = 10000
+
+
+class _DwgHandler:
+    def __init__(self, replacement_digit, log, debug, notify_host, options):
+        self.processor = load(DWG)(replacement_digit, log_callback=log, debug=debug, host_callback=notify_host,
+                                   **options)
+
+    def process(self, job):
+        return self.processor.process_file_fanout(job.source_path, job.targets)
+
+    def close(self):
+        # __del__ процессора закрывает AutoCAD и вызывает CoUninitialize — в этом же потоке
+        self.processor = None
+
+
+class _ShaHandler:
+    def __init__(self, replacement_digit, log, debug, notify_host, options):
+        self.processor = load(SHA)(replacement_digit, log_callback=log, debug=debug)
+        self.processor.start_app()
+        notify_host(self.processor.host_pid)
+
+    def process(self, job):
+        return self.processor.process_file_fanout(job.source_path, job.targets)
+
+    def close(self):
+        self.processor.stop_app()
+
+
+class _XlsHandler:
+    """Только конвертация .xls → .xlsm; текст обрабатывается затем в пуле как обычный Excel."""
+
+    def __init__(self, replacement_digit, log, debug, notify_host, options):
+        self.converter = load(XLS)(log_callback=log if debug else None)
+        self.converter.start()
+        notify_host(self.converter.host_pid)
+
+    def process(self, job):
+        # Временную папку создаёт родительский процесс, он же её и удаляет
+        converted = os.path.join(job.temp_dir, 'converted.xlsm')
+        self.converter.convert(job.source_path, converted)
+        return converted
+
+    def close(self):
+        self.converter.stop()
+
+
+class _DocHandler:
+    """Только конвертация .doc → .docx; текст обрабатывается затем в пуле как обычный Word."""
+
+    def __init__(self, replacement_digit, log, debug, notify_host, options):
+        self.converter = load(DOC)(log_callback=log if debug else None)
+        self.converter.start()
+        notify_host(self.converter.host_pid)
+
+    def process(self, job):
+        converted = os.path.join(job.temp_dir, 'converted.docx')
+        self.converter.convert(job.source_path, converted)
+        return converted
+
+    def close(self):
+        self.converter.stop()
+
+
+_HANDLERS = {DWG: _DwgHandler, SHA: _ShaHandler, XLS: _XlsHandler, DOC: _DocHandler}
+
+
+def _scratch_job(job, directory):
+    """Копия задания с результатами во временной папке directory (повтор под профилировщиком)."""
+    scratch = copy.copy(job)
+    scratch.targets = {digit: os.path.join(directory, os.path.basename(path)) for digit, path in job.targets.items()}
+    scratch.temp_dir = directory
+    return scratch
+
+
+def _index_texts(index, job, processor, texts, log):
+    try:
+        record_texts(index, job.input_path, job.source_path, processor, texts)
+    except Exception as e:
+        log(f"Индекс: {job.filename} не записан: {str(e)}")
+
+
+def run_host(backend, replacement_digit, debug, options, conn, profile=None, index=None):
+    """Точка входа дочернего процесса: COM-приложение бэкенда в однопоточном апартаменте (STA).
+
+    options — именованные параметры обработчика бэкенда, profile — profiling.ProfileSettings
+    или None, index — файл индекса идентификаторов или None. Задания приходят по conn, обратно уходят ('log', сообщение), ('host', PID
+    приложения), ('waits', ожидания), ('profiling', None) — начат повтор под профилировщиком —,
+    ('rules', статистика правил задания) и ('result', результат).
+    """
+    import pythoncom
+    pythoncom.CoInitializeEx(pythoncom.COINIT_APARTMENTTHREADED)
+    log = lambda message: conn.send(('log', message))
+    host = {}
+
+    def notify_host(pid):
+        host['pid'] = pid
+        conn.send(('host', pid))
+
+    def host_rss():
+        usage = process_usage(host['pid']) if host.get('pid') else None
+        return usage[0] if usage else None
+
+    def before_rerun():
+        # Повтор под профилировщиком не попадает в статистику правил
+        rule_stats.append(take_rule_stats())
+        conn.send(('profiling', None))
+
+    handler = None
+    try:
+        while True:
+            job = conn.recv()
+            rule_stats = []
+            if job is None:
+                break
+            try:
+                if handler is None:
+                    handler = _HANDLERS[backend](replacement_digit, log, debug, notify_host, options)
+                # AutoCAD и SmartSketch отдают тексты, прочитанные при обработке; конвертеры индексирует пул
+                processor = getattr(handler, 'processor', None) if index else None
+                if processor is not None:
+                    processor.seen_texts = []
+                if profile is None:
+                    result = handler.process(job)
+                else:
+                    result = run_stage(profile, report_dir(job.outputs), job.filename, backend,
+                                       lambda: handler.process(job),
+                                       lambda directory: handler.process(_scratch_job(job, directory)),
+                                       rss=host_rss, log=log, before_rerun=before_rerun)
+                if processor is not None:
+                    texts, processor.seen_texts = processor.seen_texts, None
+                    if result:
+                        _index_texts(index, job, processor, texts, log)
+            except Exception as e:
+                log(f"Критическая ошибка {job.filename}: {str(e)}")
+                result = False
+            conn.send(('waits', take_waits()))
+            rule_stats.append(take_rule_stats())
+            conn.send(('rules', rule_stats[0]))
+            conn.send(('result', result))
+    finally:
+        if handler is not None:
+            try:
+                handler.close()
+            except Exception as e:
+                log(f"Ошибка закрытия {backend}: {str(e)}")
+        handler = None
+        pythoncom.CoUninitialize()
+        try:
+            conn.send(('waits', take_waits()))
+        except (EOFError, OSError):
+            pass
+
+
+class ComHost:
+    """Дочерний процесс с COM-приложением одного бэкенда под надзором родителя.
+
+    Зависшее задание прерывается по таймауту: завершаются дочерний процесс
+    и только то приложение, которое он сам запустил. Ошибкой считается
+    лишь это задание, следующее получит новый процесс.
+    """
+
+    def __init__(self, backend, replacement_digit, debug, log, record_waits=None, options=None, profile=None,
+                 index=None):
+        self.backend = backend
+        self.log = log
+        self.record_waits = record_waits or (lambda waits: None)
+        self.host_pid = None
+        self.jobs_done = 0
+        self.app_starts = 0  # запуски и перезапуски приложения в этом процессе (сообщения 'host')
+        self.failure = None  # 'timeout' или 'crash', если процесс пришлось завершить
+        self.alive = True
+        context = multiprocessing.get_context('spawn')
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(target=run_host, name=f"com-{backend}", daemon=True,
+                                       args=(backend, replacement_digit, debug, options or {}, child_conn, profile,
+                                             index))
+        self.process.start()
+        child_conn.close()
+
+    def _receive(self, timeout):
+        """Следующее сообщение дочернего процесса или None по таймауту; EOFError — процесс завершился.
+
+        Ждём и сам процесс: конец канала мог унаследовать другой дочерний процесс
+        (пул, созданный через fork), и тогда EOF после выхода не наступит.
+        """
+        ready = wait([self.conn, self.process.sentinel], max(0.0, timeout))
+        if not ready:
+            return None
+        if self.conn in ready or self.conn.poll():
+            return self.conn.recv()
+        raise EOFError
+
+    def run_job(self, job, timeout):
+        """Результат задания; False — при ошибке, падении процесса или превышении timeout."""
+        deadline = time.monotonic() + timeout
+        try:
+            self.conn.send(job)
+            while True:
+                message = self._receive(deadline - time.monotonic())
+                if message is None:
+                    self.log(f"Критическая ошибка {job.filename}: превышено время обработки "
+                             f"({timeout:.0f} с), {self.backend} будет перезапущен")
+                    self.failure = 'timeout'
+                    self.kill()
+                    return False
+                kind, payload = message
+                if kind == 'log':
+                    self.log(payload)
+                elif kind == 'host':
+                    self.host_pid = payload
+                    self.app_starts += 1
+                elif kind == 'waits':
+                    self.record_waits(payload)
+                elif kind == 'rules':
+                    merge_rule_stats(job.rule_stats, payload)
+                elif kind == 'profiling':
+                    # Повтор под профилировщиком получает собственное предельное время
+                    deadline = time.monotonic() + timeout
+                else:
+                    self.jobs_done += 1
+                    return payload
+        except (EOFError, OSError):
+            self.failure = 'crash'
+            self.kill()
+            self.log(f"Критическая ошибка {job.filename}: процесс {self.backend} завершился аварийно "
+                     f"(код {self.process.exitcode})")
+            return False
+
+    def worn_out(self):
+        """Пора ли перезапустить процесс: по числу заданий, памяти или дескрипторам."""
+        if self.jobs_done >= RECYCLE_JOBS:
+            return True
+        for pid in (self.host_pid, self.process.pid):
+            usage = process_usage(pid) if pid else None
+            if usage and (usage[0] > RECYCLE_RSS or usage[1] > RECYCLE_HANDLES):
+                self.log(f"Перезапуск {self.backend}: процесс {pid} занимает {usage[0] // 2**20} МБ, "
+                         f"{usage[1]} дескрипторов")
+                return True
+        return False
+
+    def stop(self, timeout=120):
+        """Штатное завершение: приложение закрывается в дочернем процессе."""
+        if not self.alive:
+            return
+        try:
+            self.conn.send(None)
+            deadline = time.monotonic() + timeout
+            while True:
+                message = self._receive(deadline - time.monotonic())
+                if message is None:
+                    break
+                kind, payload = message
+                if kind == 'log':
+                    self.log(payload)
+                elif kind == 'waits':
+                    self.record_waits(payload)
+        except (EOFError, OSError):
+            pass
+        self.process.join(10)
+        if self.process.is_alive():
+            self.kill()
+        self.alive = False
+        self.conn.close()
+
+    def kill(self):
+        self.alive = False
+        if self.process.is_alive():
+            self.process.kill()
+        self.process.join()
+        if self.host_pid:
+            kill_process(self.host_pid)
+            self.host_pid = None
+        self.record_waits(take_waits())
+        self.conn.close()
@@ -0,0 +1 @@
+# Модули лежат в корне репозитория: conftest.py здесь добавляет корень в sys.path для tests/
@@ -0,0 +1,353 @@
+import argparse
+import hashlib
+import os
+import re
+import sqlite3
+import sys
+import time
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from multiprocessing import freeze_support
+from backends import DWG, SHA, XML_BACKENDS, backend_for, load
+from part_cache import rules_key
+
+# Набор правил Word блоков 3 и 4 полный (с ED.B.P000.S), поэтому индекс строится по нему
+INDEX_DIGIT = '3'
+# Совпадения длиннее — не идентификаторы, а фрагменты разметки (правило ревизии SmartSketch)
+MAX_IDENTIFIER = 100
+# Коды колонтитулов Excel перед совпадением (&L, &R&11) — не часть идентификатора
+_FORMAT_CODES = re.compile(r'^(?:&(?:\d+|[A-Za-z]))+')
+_READ_CHUNK = 1024 * 1024
+_GLOB_CHARS = '*?['
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    digest TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime REAL NOT NULL,
+    indexed REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS files_digest ON files (digest);
+CREATE TABLE IF NOT EXISTS contents (
+    digest TEXT PRIMARY KEY,
+    format TEXT NOT NULL,
+    rules TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS identifiers (
+    digest TEXT NOT NULL,
+    key TEXT NOT NULL,
+    identifier TEXT NOT NULL,
+    location TEXT NOT NULL,
+    hits INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS identifiers_key ON identifiers (key);
+CREATE INDEX IF NOT EXISTS identifiers_digest ON identifiers (digest);
+"""
+
+_indexes = {}
+_indexers = {}
+
+
+def default_index_path():
+    base = os.environ.get('LOCALAPPDATA') or os.path.expanduser('~')
+    return os.path.join(base, 'wesa_parser', 'corpus.sqlite')
+
+
+def open_index(path=None):
+    """Индекс в файле path; в одном процессе — одно соединение на файл."""
+    path = path or default_index_path()
+    if path not in _indexes:
+        _indexes[path] = CorpusIndex(path)
+    return _indexes[path]
+
+
+def file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(_READ_CHUNK), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def find_identifiers(patterns, texts):
+    """Совпадения правил в исходных текстах: {(идентификатор, место): число}.
+
+    texts — пары (место, текст). Каждое правило просматривает текст
+    независимо, поэтому идентификатор находится, даже если при обработке
+    его раньше изменило другое правило.
+    """
+    found = Counter()
+    for location, text in texts:
+        if not text:
+            continue
+        for pattern, _ in patterns:
+            for m in pattern.finditer(text):
+                identifier = _FORMAT_CODES.sub('', m.group(0))
+                if identifier and len(identifier) <= MAX_IDENTIFIER:
+                    found[(identifier, location)] += 1
+    return found
+
+
+class CorpusIndex:
+    """Индекс идентификаторов корпуса в локальном файле SQLite: какие файлы и где их содержат.
+
+    Идентификаторы — всё, что находят правила замены формата (ED.D.P123.2,
+    20UKD, Unit 2 …), с местом: часть пакета Word/Excel, поток .doc/.xls,
+    объект чертежа. Записи привязаны к хешу содержимого: копии файла
+    разбираются один раз, а файл, у которого не изменились размер и время
+    изменения, не читается вовсе. Содержимое разбирается заново и при
+    изменении правил формата (отпечаток part_cache.rules_key).
+
+    Писать могут несколько процессов сразу (пул, COM-процессы): журнал WAL,
+    каждый процесс открывает своё соединение (open_index).
+    """
+
+    def __init__(self, path):
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.conn = sqlite3.connect(path, timeout=60, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.executescript(_SCHEMA)
+
+    def close(self):
+        self.conn.close()
+        _indexes.pop(self.path, None)
+
+    def fresh(self, path, rules=None):
+        """Файл проиндексирован и с тех пор не менялся (по размеру и времени изменения).
+
+        rules — отпечаток правил: при другом отпечатке файл считается неактуальным.
+        """
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return False
+        row = self.conn.execute(
+            "SELECT files.size, files.mtime, contents.rules FROM files "
+            "LEFT JOIN contents ON contents.digest = files.digest WHERE files.path = ?",
+            (os.path.abspath(path),)).fetchone()
+        return (row is not None and row[0] == stat.st_size and row[1] == stat.st_mtime
+                and (rules is None or row[2] == rules))
+
+    def known(self, digest, rules):
+        """Содержимое уже разобрано этим набором правил."""
+        row = self.conn.execute("SELECT rules FROM contents WHERE digest = ?", (digest,)).fetchone()
+        return row is not None and row[0] == rules
+
+    def store(self, path, digest, format, rules, found=None):
+        """Запись файла path с содержимым digest; found — find_identifiers или None, если содержимое известно."""
+        stat = os.stat(path)
+        with _Transaction(self.conn):
+            if found is not None:
+                self.conn.execute("DELETE FROM identifiers WHERE digest = ?", (digest,))
+                self.conn.execute("INSERT OR REPLACE INTO contents (digest, format, rules) VALUES (?, ?, ?)",
+                                  (digest, format, rules))
+                self.conn.executemany(
+                    "INSERT INTO identifiers (digest, key, identifier, location, hits) VALUES (?, ?, ?, ?, ?)",
+                    [(digest, identifier.upper(), identifier, location, hits)
+                     for (identifier, location), hits in found.items()])
+            self.conn.execute("INSERT OR REPLACE INTO files (path, digest, size, mtime, indexed) VALUES (?, ?, ?, ?, ?)",
+                              (os.path.abspath(path), digest, stat.st_size, stat.st_mtime, time.time()))
+
+    def query(self, terms):
+        """Вхождения идентификаторов: [(путь, идентификатор, место, число)].
+
+        Термин без * ? [ — начало идентификатора (20UKD находит 20UKD10AA101),
+        с ними — шаблон GLOB целиком. Регистр не учитывается. Поиск идёт
+        по индексу таблицы, если шаблон не начинается с подстановочного знака.
+        """
+        rows = []
+        for term in terms:
+            pattern = term.upper() if any(char in term for char in _GLOB_CHARS) else _glob_escape(term.upper()) + '*'
+            rows += self.conn.execute(
+                "SELECT files.path, identifiers.identifier, identifiers.location, identifiers.hits "
+                "FROM identifiers JOIN files ON files.digest = identifiers.digest "
+                "WHERE identifiers.key GLOB ?", (pattern,)).fetchall()
+        return sorted(set(rows))
+
+    def paths(self, terms):
+        return sorted({row[0] for row in self.query(terms)})
+
+    def prune(self):
+        """Удаление записей о файлах, которых больше нет, и их содержимого; возвращает число файлов."""
+        missing = [path for (path,) in self.conn.execute("SELECT path FROM files") if not os.path.exists(path)]
+        with _Transaction(self.conn):
+            self.conn.executemany("DELETE FROM files WHERE path = ?", [(path,) for path in missing])
+            self.conn.execute("DELETE FROM identifiers WHERE digest NOT IN (SELECT digest FROM files)")
+            self.conn.execute("DELETE FROM contents WHERE digest NOT IN (SELECT digest FROM files)")
+        return len(missing)
+
+    def counts(self):
+        """(файлов, разных содержимых, записей об идентификаторах)."""
+        return tuple(self.conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+                     for table in ('files', 'contents', 'identifiers'))
+
+
+class _Transaction:
+    """BEGIN IMMEDIATE … COMMIT: блокировка записи берётся сразу, а не при первом изменении."""
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __enter__(self):
+        self.conn.execute("BEGIN IMMEDIATE")
+
+    def __exit__(self, exc_type, exc, tb):
+        self.conn.execute("COMMIT" if exc_type is None else "ROLLBACK")
+
+
+def _glob_escape(text):
+    return ''.join(f'[{char}]' if char in _GLOB_CHARS else char for char in text)
+
+
+def _indexer(backend):
+    """Обработчик бэкенда пула для чтения текстов (правила INDEX_DIGIT), один на процесс."""
+    if backend not in _indexers:
+        _indexers[backend] = load(backend)(INDEX_DIGIT)
+    return _indexers[backend]
+
+
+def index_file(index_path, backend, path, data_path=None, texts_path=None):
+    """Индексация файла Word/Excel/.doc/.xls; True — файл разобран или перепривязан, False — не менялся.
+
+    path — путь в индексе, data_path — откуда читать содержимое для хеша
+    (локальная копия), texts_path — откуда читать тексты (результат
+    конвертации .xls/.doc). По умолчанию оба — path.
+    """
+    index = open_index(index_path)
+    processor = _indexer(backend)
+    owner = type(processor).__name__
+    rules = rules_key(owner, processor.patterns)
+    if index.fresh(path, rules):
+        return False
+    digest = file_digest(data_path or path)
+    if index.known(digest, rules):
+        index.store(path, digest, owner, rules)
+    else:
+        index.store(path, digest, owner, rules,
+                    find_identifiers(processor.patterns, processor.iter_texts(texts_path or data_path or path)))
+    return True
+
+
+def record_texts(index_path, path, data_path, processor, texts):
+    """Индексация текстов, уже прочитанных обработчиком AutoCAD или SmartSketch при обработке."""
+    index = open_index(index_path)
+    owner = type(processor).__name__
+    rules = rules_key(owner, processor.patterns)
+    digest = file_digest(data_path or path)
+    index.store(path, digest, owner, rules, find_identifiers(processor.patterns, texts))
+
+
+def select_indexed(index_path, input_files, terms, log):
+    """Файлы input_files, в которых индекс находит terms, и те, о которых индекс не знает.
+
+    Не проиндексированный или изменившийся с тех пор файл тоже попадает
+    в пакет: по индексу нельзя сказать, что идентификатора в нём нет.
+    """
+    index = open_index(index_path)
+    matched = {os.path.normcase(path) for path in index.paths(terms)}
+    selected = []
+    unknown = 0
+    for path in input_files:
+        if not index.fresh(path):
+            unknown += 1
+            selected.append(path)
+        elif os.path.normcase(os.path.abspath(path)) in matched:
+            selected.append(path)
+    log(f"Индекс: {', '.join(terms)} — файлов с совпадениями {len(selected) - unknown}, "
+        f"не проиндексировано или изменено {unknown}, всего в пакете {len(selected)} из {len(input_files)}")
+    return selected
+
+
+def _scan_one(index_path, backend, path):
+    try:
+        return path, index_file(index_path, backend, path), None
+    except Exception as e:
+        return path, False, str(e)
+
+
+def scan(index_path, input_files, log, max_workers=None):
+    """Индексация файлов без обработки; чертежи DWG и SHA читаются только при обработке (batch.py --index).
+
+    Возвращает (разобрано, не менялось, с ошибкой, пропущено).
+    """
+    counts = [0, 0, 0, 0]
+    open_index(index_path)  # таблицы создаются до запуска процессов
+    files = []
+    for path in input_files:
+        backend = backend_for(path)
+        if backend in XML_BACKENDS:
+            files.append((backend, path))
+        else:
+            counts[3] += 1
+            if backend in (DWG, SHA):
+                log(f"Пропуск {os.path.basename(path)}: индексируется при обработке (batch.py --index)")
+    with ProcessPoolExecutor(max_workers=max_workers) as pool:
+        futures = [pool.submit(_scan_one, index_path, backend, path) for backend, path in files]
+        for future in futures:
+            path, indexed, error = future.result()
+            if error is not None:
+                counts[2] += 1
+                log(f"Ошибка индексации {os.path.basename(path)}: {error}")
+            else:
+                counts[0 if indexed else 1] += 1
+    return tuple(counts)
+
+
+def main(argv=None):
+    """Индекс идентификаторов: python corpus_index.py scan|query|prune [--db ФАЙЛ]."""
+    parser = argparse.ArgumentParser(description="Индекс идентификаторов в файлах корпуса")
+    parser.add_argument("--db", default=default_index_path(), help="Файл индекса SQLite")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    scan_parser = commands.add_parser("scan", help="Проиндексировать папку (Word, Excel, .doc, .xls)")
+    scan_parser.add_argument("--input", required=True, help="Папка с исходными файлами")
+    scan_parser.add_argument("--workers", type=int, help="Число процессов")
+
+    query = commands.add_parser("query", help="Найти файлы по идентификаторам")
+    query.add_argument("terms", nargs="+", help="Начало идентификатора или шаблон с * ? [")
+    query.add_argument("--paths", action="store_true", help="Только пути файлов")
+
+    commands.add_parser("prune", help="Удалить из индекса файлы, которых больше нет")
+    args = parser.parse_args(argv)
+
+    def log(message):
+        print(f"[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] {message}", flush=True)
+
+    if args.command == "scan":
+        from batch import select_files  # batch импортирует планировщик, а тот — этот модуль
+        if not os.path.isdir(args.input):
+            parser.error("папка с исходными файлами не найдена")
+        started = time.monotonic()
+        indexed, unchanged, failed, skipped = scan(args.db, select_files(args.input), log, args.workers)
+        files, contents, entries = open_index(args.db).counts()
+        log(f"Индекс {args.db}: разобрано {indexed}, без изменений {unchanged}, с ошибкой {failed}, "
+            f"пропущено {skipped} за {time.monotonic() - started:.1f} с; всего файлов {files}, "
+            f"разных содержимых {contents}, записей {entries}")
+        return 0 if not failed else 1
+
+    index = open_index(args.db)
+    if args.command == "prune":
+        log(f"Удалено из индекса файлов: {index.prune()}")
+        return 0
+
+    started = time.perf_counter()
+    rows = index.query(args.terms)
+    if args.paths:
+        for path in sorted({row[0] for row in rows}):
+            print(path)
+    else:
+        for path, identifier, location, hits in rows:
+            print(f"{path} | {identifier} | {location} | {hits}")
+        log(f"Найдено вхождений: {len(rows)}, файлов: {len({row[0] for row in rows})} "
+            f"за {(time.perf_counter() - started) * 1000:.0f} мс")
+    return 0 if rows else 1
+
+
+if __name__ == "__main__":
+    freeze_support()  # для пула процессов в сборке PyInstaller
+    sys.exit(main())
@@ -0,0 +1,108 @@
+import heapq
+import json
+import os
+import tempfile
+from backends import WORD, EXCEL, BIFF, WW8, XLS, DOC, DWG, SHA
+
+# Оценка до накопления истории: (секунды на файл, секунды на мегабайт)
+DEFAULT_COSTS = {
+    WORD: (0.5, 0.5), EXCEL: (0.5, 1.0), BIFF: (0.2, 0.3), WW8: (0.2, 0.3),
+    XLS: (5.0, 2.0), DOC: (5.0, 2.0), DWG: (15.0, 2.0), SHA: (10.0, 3.0),
+}
+# Вес старых замеров уменьшается с каждым новым, чтобы оценка следовала за изменениями
+DECAY = 0.98
+MAX_FILES = 5000
+_MB = 1024 * 1024
+
+
+def default_timings_path():
+    base = os.environ.get('LOCALAPPDATA') or os.path.expanduser('~')
+    return os.path.join(base, 'wesa_parser', 'timings.json')
+
+
+def makespan(costs, workers):
+    """Время выполнения заданий costs на workers исполнителях в порядке убывания (LPT)."""
+    loads = [0.0] * max(1, workers)
+    for cost in sorted(costs, reverse=True):
+        heapq.heapreplace(loads, loads[0] + cost)
+    return max(loads)
+
+
+class CostModel:
+    """Оценка времени обработки файла по формату, размеру и прошлым запускам.
+
+    Для каждого бэкенда хранится линейная зависимость времени от размера,
+    подобранная по замерам (методом наименьших квадратов с затуханием),
+    для каждого файла (имя и размер) — последнее измеренное время. Файл,
+    который уже обрабатывался, оценивается по собственной истории.
+    Данные хранятся в JSON в профиле пользователя.
+    """
+
+    def __init__(self, path=None):
+        self.path = path or default_timings_path()
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                data = json.load(f)
+            self.backends = data['backends']
+            self.files = data['files']
+        except (OSError, ValueError, KeyError, TypeError):
+            self.backends = {}
+            self.files = {}
+
+    @staticmethod
+    def _file_key(path, size):
+        return f"{os.path.basename(path).lower()}|{size}"
+
+    def _fit(self, backend):
+        """Коэффициенты (секунды на файл, секунды на мегабайт) для бэкенда."""
+        base, per_mb = DEFAULT_COSTS.get(backend, (1.0, 1.0))
+        stats = self.backends.get(backend)
+        if not stats or stats['n'] <= 0:
+            return base, per_mb
+        n, sx, sy, sxx, sxy = (stats[key] for key in ('n', 'sx', 'sy', 'sxx', 'sxy'))
+        mean_x, mean_y = sx / n, sy / n
+        variance = sxx / n - mean_x ** 2
+        if n >= 3 and variance > 1e-6:
+            per_mb = max(0.0, (sxy / n - mean_x * mean_y) / variance)
+        return max(0.0, mean_y - per_mb * mean_x), per_mb
+
+    def predict(self, backend, path, size):
+        seconds = self.files.get(self._file_key(path, size))
+        if seconds is not None:
+            return seconds
+        base, per_mb = self._fit(backend)
+        return base + per_mb * size / _MB
+
+    def record(self, backend, path, size, seconds):
+        x = size / _MB
+        stats = self.backends.setdefault(backend, {'n': 0.0, 'sx': 0.0, 'sy': 0.0, 'sxx': 0.0, 'sxy': 0.0})
+        for key in stats:
+            stats[key] *= DECAY
+        stats['n'] += 1
+        stats['sx'] += x
+        stats['sy'] += seconds
+        stats['sxx'] += x * x
+        stats['sxy'] += x * seconds
+
+        key = self._file_key(path, size)
+        self.files.pop(key, None)
+        self.files[key] = round(seconds, 3)
+        while len(self.files) > MAX_FILES:
+            del self.files[next(iter(self.files))]
+
+    def save(self):
+        # Файл модели общий для нескольких процессов: у каждой записи своё временное имя
+        temp_path = None
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            fd, temp_path = tempfile.mkstemp(prefix='.tmp', dir=os.path.dirname(self.path))
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump({'backends': self.backends, 'files': self.files}, f, ensure_ascii=False)
+            os.replace(temp_path, self.path)
+        except OSError:
+            # Без истории оценка просто будет грубее
+            if temp_path is not None and os.path.exists(temp_path):
+                try:
+                    os.remove(temp_path)
+                except OSError:
+                    pass
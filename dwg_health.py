@@ -0,0 +1,99 @@
+import hashlib
+import json
+import os
+import re
+import tempfile
+from datetime import datetime
+
+# Начало заголовка DWG: "AC10" + две цифры версии (AC1015, AC1032, ...)
+DWG_SIGNATURE = b'AC10'
+# Итоговая строка отчёта аудита (.adt): "Total errors found 3 fixed 0", в русской версии — "Всего найдено ошибок 3 ..."
+_AUDIT_TOTAL = re.compile(r'^\s*(?:total errors found|всего найдено ошибок)\D*(\d+)', re.IGNORECASE | re.MULTILINE)
+
+
+def default_cache_path():
+    base = os.environ.get('LOCALAPPDATA') or os.path.expanduser('~')
+    return os.path.join(base, 'wesa_parser', 'dwg_health.json')
+
+
+def content_hash(path, chunk_size=1024 * 1024):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def header_ok(path):
+    """Быстрая проверка заголовка: файл начинается с сигнатуры версии DWG."""
+    with open(path, 'rb') as f:
+        header = f.read(6)
+    return header.startswith(DWG_SIGNATURE) and header[4:6].isdigit()
+
+
+def audit_errors(report_path):
+    """Число ошибок из отчёта аудита AutoCAD (.adt) или None, если итоговой строки нет."""
+    with open(report_path, 'rb') as f:
+        data = f.read()
+    if data[:2] in (b'\xff\xfe', b'\xfe\xff'):
+        text = data.decode('utf-16', errors='replace')
+    else:
+        try:
+            text = data.decode('utf-8')
+        except UnicodeDecodeError:
+            text = data.decode('cp1251', errors='replace')  # ANSI русской Windows
+    match = _AUDIT_TOTAL.search(text)
+    return int(match.group(1)) if match else None
+
+
+class RecoveryCache:
+    """Решения о восстановлении (RECOVER) чертежей по хешу содержимого.
+
+    Хранится в JSON в профиле пользователя и служит заодно журналом
+    решений: для каждого файла записываются причина, размер и время проверки.
+    По размеру (may_recover) можно не читать чертёж ради хеша, если среди
+    требующих RECOVER нет ни одного файла такого размера.
+    """
+
+    def __init__(self, path=None):
+        self.path = path or default_cache_path()
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                self.entries = json.load(f)
+        except (OSError, ValueError):
+            self.entries = {}
+
+    def get(self, digest):
+        return self.entries.get(digest)
+
+    def may_recover(self, size):
+        """Может ли чертёж размера size быть в кэше как требующий RECOVER."""
+        # У записей старого формата размера нет — для них нужен хеш
+        return any(entry['recover'] and entry.get('size', size) == size for entry in self.entries.values())
+
+    def put(self, digest, recover, reason, filename, size=None):
+        self.entries[digest] = {
+            'recover': recover,
+            'reason': reason,
+            'file': filename,
+            'size': size,
+            'checked': datetime.now().isoformat(timespec='seconds'),
+        }
+        self._save()
+
+    def _save(self):
+        # Кэш общий для нескольких процессов: у каждой записи своё временное имя
+        temp_path = None
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            fd, temp_path = tempfile.mkstemp(prefix='.tmp', dir=os.path.dirname(self.path))
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump(self.entries, f, ensure_ascii=False, indent=1)
+            os.replace(temp_path, self.path)
+        except OSError:
+            # Кэш необязателен: в следующий раз файл просто проверится заново
+            if temp_path is not None and os.path.exists(temp_path):
+                try:
+                    os.remove(temp_path)
+                except OSError:
+                    pass
@@ -1,13 +1,23 @@
 import os
 import re
-import time
 import win32com.client
 import pythoncom
-import psutil  # Для завершения процессов
+from backends import DWG
+from host_process import HOST_PROCESSES, kill_process, process_ids, resolve_host
+from dwg_health import RecoveryCache, audit_errors, content_hash, header_ok
+from retry import Backoff, wait_until
+from rules import sub_sequential
+
+# RPC_E_CALL_REJECTED, RPC_E_SERVERCALL_RETRYLATER: приложение занято и просит повторить вызов
+_BUSY_HRESULTS = (-2147418111, -2147417846)
+
+
+def _is_busy(error):
+    return bool(error.args) and error.args[0] in _BUSY_HRESULTS
 
 
 class AutoCADProcessor:
-    def __init__(self, replacement_digit, log_callback=None, debug=False):
+    def __init__(self, replacement_digit, log_callback=None, debug=False, host_callback=None, database_only=True):
         pythoncom.CoInitialize()  # Инициализация COM
         self.debug = debug  # Флаг отладки
         if not re.match(r'^\d$', str(replacement_digit)):
@@ -17,6 +27,19 @@ class AutoCADProcessor:
         self.log = log_callback or (lambda msg: print(msg))
         self.com_app = None
         self.com_doc = None
+        # PID запущенного нами AutoCAD (None — не наш или неизвестен); о смене сообщаем host_callback
+        self.host_pid = None
+        self.host_callback = host_callback
+        # Решения о RECOVER по хешу содержимого чертежа
+        self.recovery_cache = RecoveryCache()
+        # Чтение и запись чертежей через ObjectDBX, без открытия в редакторе
+        self.database_only = database_only
+        self._database_doc = False
+        # Режим нескольких блоков: {цифра: путь} и найденные текстовые объекты
+        self._fanout_outputs = None
+        self._fanout_targets = None
+        # Тексты обхода для индекса идентификаторов: [(место, текст)] или None — не собирать
+        self.seen_texts = None
         self._initialize_autocad()
 
         self.patterns = [
@@ -56,10 +79,16 @@ class AutoCADProcessor:
     def _initialize_autocad(self):
         """Инициализация или переинициализация COM-интерфейса AutoCAD с повторами."""
         retries = 3
+        backoff = Backoff("retry_init", initial=1.0, maximum=5.0, budget=60.0)
         for attempt in range(retries):
             try:
                 self._terminate_autocad()  # Очистка перед созданием нового экземпляра
-                self.com_app = win32com.client.Dispatch("AutoCAD.Application")
+                # Отдельный экземпляр, а не подключение к открытому AutoCAD пользователя
+                before = process_ids(HOST_PROCESSES[DWG])
+                self.com_app = win32com.client.DispatchEx("AutoCAD.Application")
+                self.host_pid = resolve_host(self.com_app, HOST_PROCESSES[DWG], before)
+                if self.host_callback:
+                    self.host_callback(self.host_pid)
                 if self.wait_for_object_ready(self.com_app, timeout=20.0, check_type="app"):
                     self._log("Экземпляр AutoCAD создан")
                     return
@@ -68,7 +97,7 @@ class AutoCADProcessor:
             except Exception as e:
                 self._log(f"Не удалось создать экземпляр AutoCAD на попытке {attempt + 1}: {e}")
                 if attempt < retries - 1:
-                    time.sleep(3)  # Увеличенная задержка
+                    backoff.sleep()
                 else:
                     raise Exception(f"Не удалось создать экземпляр AutoCAD после {retries} попыток: {e}")
             finally:
@@ -76,9 +105,8 @@ class AutoCADProcessor:
                 pythoncom.CoInitialize()
 
     def wait_for_object_ready(self, obj, timeout=20.0, check_type="app"):
-        """Ожидание готовности COM-объекта с улучшенной проверкой."""
-        start_time = time.time()
-        while time.time() - start_time < timeout:
+        """Ожидание готовности COM-объекта: частые проверки сначала, затем всё реже."""
+        def ready():
             try:
                 pythoncom.PumpWaitingMessages()
                 if obj is not None:
@@ -89,20 +117,39 @@ class AutoCADProcessor:
                     return True
             except Exception as e:
                 self._log(f"Ошибка проверки готовности объекта ({check_type}): {e}")
-            time.sleep(0.2)
+            return False
+
+        if wait_until(ready, f"ready_{check_type}", budget=timeout):
+            return True
         self._log(f"Объект ({check_type}) не готов после {timeout} секунд")
         return False
 
-    def _terminate_autocad(self):
-        """Принудительное завершение процессов AutoCAD при их зависании."""
+    def _is_quiescent(self):
+        """AutoCAD закончил команду: GetAcadState().IsQuiescent, иначе системная переменная CMDACTIVE.
+
+        Отклонённый вызов (AutoCAD занят) — ещё не готов; если сигнала нет
+        вовсе, не ждём.
+        """
+        pythoncom.PumpWaitingMessages()
+        try:
+            return bool(self.com_app.GetAcadState().IsQuiescent)
+        except Exception as e:
+            if _is_busy(e):
+                return False
         try:
-            for proc in psutil.process_iter(['name']):
-                if proc.info['name'].lower().startswith('acad'):
-                    proc.kill()
-                    self._log("Процесс AutoCAD завершен")
-            time.sleep(1)  # Даем время на завершение процесса
+            return self.com_doc.GetVariable("CMDACTIVE") == 0
         except Exception as e:
-            self._log(f"Ошибка при завершении процесса AutoCAD: {e}")
+            return not _is_busy(e)
+
+    def _terminate_autocad(self):
+        """Принудительное завершение своего процесса AutoCAD при зависании; чужие сеансы не трогаем."""
+        if self.host_pid is not None:
+            try:
+                kill_process(self.host_pid)  # ждёт фактического завершения процесса
+                self._log(f"Процесс AutoCAD завершен (PID {self.host_pid})")
+            except Exception as e:
+                self._log(f"Ошибка при завершении процесса AutoCAD: {e}")
+            self.host_pid = None
         self.com_app = None
         self.com_doc = None
 
@@ -125,16 +172,26 @@ class AutoCADProcessor:
         if not text:
             return text
         original = text
-        new_text = text
-        for pattern, repl in self.patterns:
-            if pattern.search(new_text):
-                new_text = pattern.sub(repl, new_text) if callable(repl) else pattern.sub(repl, new_text)
+        new_text = sub_sequential(self.patterns, text, type(self).__name__)
         if new_text != original:
             self._log(f"Замена: {original} → {new_text}")
         return new_text
 
+    def _replace_text(self, obj, txt, location):
+        """Замена TextString объекта; в режиме нескольких блоков объект только запоминается."""
+        if self.seen_texts is not None:
+            self.seen_texts.append((location, txt))
+        if self._fanout_targets is not None:
+            self._fanout_targets.append((obj, txt, location))
+            return
+        new_txt = self._apply_replacements(txt)
+        if new_txt != txt:
+            obj.TextString = new_txt
+            self._log(f"Замена в {location}: {txt} → {new_txt}")
+
     def _process_entity(self, entity, depth=0, location=""):
         retries = 3
+        backoff = None
         for attempt in range(retries):
             try:
                 if not hasattr(entity, 'ObjectName'):
@@ -162,20 +219,13 @@ class AutoCADProcessor:
                         # Не удаляем сразу — это сделаем позже
 
                     # Продолжаем с заменами (если нужно, но замена и удаление — отдельно)
-                    new_txt = self._apply_replacements(txt)
-                    if new_txt != txt:
-                        try:
-                            entity.TextString = new_txt
-                            self._log(f"Замена в {location}: {txt} → {new_txt}")
-                        except Exception as e:
-                            self._log(f"Ошибка установки TextString в {location}: {e}")
+                    try:
+                        self._replace_text(entity, txt, location)
+                    except Exception as e:
+                        self._log(f"Ошибка установки TextString в {location}: {e}")
                 elif etype == "AcDbMLeader":
                     try:
-                        txt = entity.TextString
-                        new_txt = self._apply_replacements(txt)
-                        if new_txt != txt:
-                            entity.TextString = new_txt
-                            self._log(f"Замена в {location} (MLeader): {txt} → {new_txt}")
+                        self._replace_text(entity, entity.TextString, f"{location} (MLeader)")
                     except Exception as e:
                         self._log(f"Ошибка обработки MLeader в {location}: {e}")
                 elif etype == "AcDbBlockReference" and hasattr(entity, "GetAttributes"):
@@ -183,11 +233,7 @@ class AutoCADProcessor:
                         attributes = entity.GetAttributes()
                         for attr in attributes:
                             try:
-                                txt = attr.TextString
-                                new_txt = self._apply_replacements(txt)
-                                if new_txt != txt:
-                                    attr.TextString = new_txt
-                                    self._log(f"Замена в атрибуте блока {location}: {txt} → {new_txt}")
+                                self._replace_text(attr, attr.TextString, f"атрибуте блока {location}")
                             except Exception as e:
                                 self._log(f"Ошибка обработки атрибута в {location}: {e}")
                                 continue  # Пропускаем проблемный атрибут
@@ -197,13 +243,16 @@ class AutoCADProcessor:
             except Exception as e:
                 self._log(f"Ошибка объекта в {location} на попытке {attempt + 1}: {e}")
                 if attempt < retries - 1:
-                    time.sleep(3)
+                    # Обычно AutoCAD просто занят: короткие паузы вместо фиксированных 3 с
+                    backoff = backoff or Backoff("retry_entity", initial=0.1, maximum=2.0, budget=10.0)
+                    backoff.sleep()
                 else:
                     self._log(f"Не удалось обработать объект в {location} после {retries} попыток: {e}")
                     return
 
     def _process_blocks(self):
         retries = 3
+        backoff = Backoff("retry_blocks", initial=0.5, maximum=5.0, budget=30.0)
         for attempt in range(retries):
             try:
                 if self.com_doc is None:
@@ -223,11 +272,9 @@ class AutoCADProcessor:
             except Exception as e:
                 self._log(f"Ошибка обработки блоков на попытке {attempt + 1}: {e}")
                 if attempt < retries - 1:
-                    time.sleep(3)
+                    backoff.sleep()
                     try:
-                        if self.com_doc is not None:
-                            self.com_doc.Close(False)  # Отклонить изменения
-                            self.com_doc = None
+                        self._close_document()
                         if self.com_app is not None:
                             self.com_app.Quit()
                             self.com_app = None
@@ -242,11 +289,16 @@ class AutoCADProcessor:
 
     def _process_all_entities(self):
         retries = 3
+        backoff = Backoff("retry_entities", initial=0.5, maximum=5.0, budget=30.0)
         for attempt in range(retries):
             try:
                 if self.com_doc is None:
                     self._log("Документ не инициализирован, пропуск обработки")
                     return False
+                if self._fanout_targets is not None:
+                    self._fanout_targets = []  # Повторная попытка обходит чертёж заново
+                if self.seen_texts is not None:
+                    self.seen_texts = []
                 self._log("Обработка ModelSpace...")
                 for entity in self.com_doc.ModelSpace:
                     self._process_entity(entity, location="ModelSpace")
@@ -271,11 +323,9 @@ class AutoCADProcessor:
             except Exception as e:
                 self._log(f"Ошибка обработки объектов на попытке {attempt + 1}: {e}")
                 if attempt < retries - 1:
-                    time.sleep(3)
+                    backoff.sleep()
                     try:
-                        if self.com_doc is not None:
-                            self.com_doc.Close(False)  # Отклонить изменения
-                            self.com_doc = None
+                        self._close_document()
                         if self.com_app is not None:
                             self.com_app.Quit()
                             self.com_app = None
@@ -311,7 +361,26 @@ class AutoCADProcessor:
     def process_file(self, input_path, output_path):
         self.delete_candidates = {}  # Сброс перед каждым файлом
         retries = 3
+        backoff = Backoff("retry_file", initial=0.5, maximum=5.0, budget=30.0)
         success = False
+        filename = os.path.basename(input_path)
+        size = os.path.getsize(input_path)
+        digest = None
+
+        def file_digest():
+            # Хеш читает чертёж целиком, поэтому считается, только когда нужен кэшу
+            nonlocal digest
+            if digest is None:
+                digest = content_hash(input_path)
+            return digest
+
+        # Без редактора — если чертёж не известен как требующий RECOVER; при неудаче — через редактор
+        cached = self.recovery_cache.get(file_digest()) if self.recovery_cache.may_recover(size) else None
+        if self.database_only and not (cached and cached['recover']):
+            if self._process_database(input_path, output_path):
+                return True
+            self.delete_candidates = {}
+            self._log(f"Повтор через редактор AutoCAD: {filename}")
         for attempt in range(retries):
             try:
                 # Проверяем, что AutoCAD готов перед открытием файла
@@ -335,30 +404,32 @@ class AutoCADProcessor:
                         self.com_doc.SendCommand("(setvar \"AUTOSAVE\" 0)\n")
                     except Exception as e:
                         self._log(f"Не удалось отключить диалоговые окна или автосохранение: {e}")
-                    # Выполняем RECOVER для исправления файла
-                    try:
-                        self.com_doc.SendCommand("RECOVER\n")
-                        self._log(f"Выполнена команда RECOVER для {input_path}")
-                        time.sleep(2)  # Увеличенная задержка
-                    except Exception as e:
-                        self._log(f"Ошибка выполнения RECOVER для {input_path}: {e}")
+                    # RECOVER только для чертежей, которым он нужен
+                    if self._needs_recovery(input_path, file_digest(), size, attempt):
+                        try:
+                            self.com_doc.SendCommand("RECOVER\n")
+                            self._log(f"Выполнена команда RECOVER для {input_path}")
+                            # Ждём завершения команды вместо фиксированной паузы
+                            if not wait_until(self._is_quiescent, "recover", budget=60.0):
+                                self._log(f"RECOVER не завершился за 60 секунд: {input_path}")
+                        except Exception as e:
+                            self._log(f"Ошибка выполнения RECOVER для {input_path}: {e}")
                     if self._process_all_entities():  # Проверяем успешность обработки
-                        self.com_doc.SaveAs(os.path.abspath(output_path))
-                        self._log(f"Сохранено: {output_path}")
+                        self._save_document(output_path)
                         success = True
                     else:
                         self._log(f"Обработка {input_path} не удалась, изменения не сохраняются")
+                        self.recovery_cache.put(file_digest(), True, "ошибка обработки объектов", filename, size)
                     return success
                 else:
                     self._log(f"Документ не готов на попытке {attempt + 1}")
             except Exception as e:
                 self._log(f"Критическая ошибка в {input_path} на попытке {attempt + 1}: {e}")
+                self.recovery_cache.put(file_digest(), True, f"ошибка при обработке: {e}", filename, size)
                 if attempt < retries - 1:
-                    time.sleep(3)
+                    backoff.sleep()
                     try:
-                        if self.com_doc is not None:
-                            self.com_doc.Close(False)  # Отклонить изменения
-                            self.com_doc = None
+                        self._close_document()
                         if self.com_app is not None:
                             self.com_app.Quit()
                             self.com_app = None
@@ -372,14 +443,153 @@ class AutoCADProcessor:
                     return False
             finally:
                 try:
-                    if self.com_doc is not None:
-                        self.com_doc.Close(False)  # Отклонить изменения
-                        self.com_doc = None
+                    self._close_document()
                 except Exception as e:
                     self._log(f"Ошибка закрытия документа: {e}")
                     self._terminate_autocad()
                     self._initialize_autocad()
 
+    def _open_database(self, input_path):
+        """Чертёж как база данных (ObjectDBX.AxDbDocument той же версии, что и AutoCAD), без редактора."""
+        major = str(self.com_app.Version).split('.')[0]
+        doc = self.com_app.GetInterfaceObject(f"ObjectDBX.AxDbDocument.{major}")
+        doc.Open(os.path.abspath(input_path))
+        return doc
+
+    def _process_database(self, input_path, output_path):
+        """Обработка без редактора: без регенерации, интерфейса и командной строки.
+
+        Объекты обходятся тем же кодом, что и в редакторе; сохранение —
+        SaveAs базы. False — чертёж нужно обработать через редактор.
+        """
+        filename = os.path.basename(input_path)
+        try:
+            if not self.wait_for_object_ready(self.com_app, timeout=20.0, check_type="app"):
+                self._terminate_autocad()
+                self._initialize_autocad()
+            self.com_doc = self._open_database(input_path)
+            self._database_doc = True
+            self._log(f"Открыт без редактора: {filename}")
+            if not self._process_all_entities():
+                return False
+            self._save_document(output_path)
+            return True
+        except Exception as e:
+            self._log(f"Не удалось обработать {filename} без редактора: {e}")
+            return False
+        finally:
+            self._close_document()
+
+    def _close_document(self):
+        """Закрытие документа без сохранения; база ObjectDBX просто освобождается."""
+        if self.com_doc is not None:
+            if not self._database_doc:
+                self.com_doc.Close(False)  # Отклонить изменения
+            self.com_doc = None
+        self._database_doc = False
+
+    def _needs_recovery(self, input_path, digest, size, attempt):
+        """Нужен ли RECOVER: повторная попытка, кэш по хешу, заголовок файла, отчёт аудита.
+
+        Решение с причиной пишется в лог и в кэш; ошибка обработки позже
+        помечает чертёж как требующий восстановления. Если отчёта аудита
+        нет, проверен только заголовок — такое решение не кэшируется.
+        """
+        filename = os.path.basename(input_path)
+        cached = self.recovery_cache.get(digest)
+        store = cached is None or attempt > 0
+        if attempt > 0:
+            recover, reason = True, "повторная попытка после ошибки"
+        elif cached is not None:
+            recover, reason = cached['recover'], f"по кэшу: {cached['reason']}"
+        elif not header_ok(input_path):
+            recover, reason = True, "неверный заголовок файла"
+        else:
+            try:
+                errors = self._audit_errors(input_path)
+            except Exception as e:
+                recover, reason = True, f"аудит: {e}"
+            else:
+                if errors is None:
+                    recover, reason, store = False, "заголовок в порядке, отчёта аудита нет", False
+                else:
+                    recover, reason = errors > 0, f"аудит: ошибок {errors}"
+        if store:
+            self.recovery_cache.put(digest, recover, reason, filename, size)
+        self._log(f"Восстановление {filename}: {'требуется' if recover else 'не требуется'} ({reason})")
+        return recover
+
+    def _audit_errors(self, input_path):
+        """Число ошибок аудита открытого чертежа (без исправления) или None, если отчёта нет.
+
+        AuditInfo выводит итог только в командную строку и на повреждённом
+        чертеже завершается без исключения, поэтому число ошибок берётся
+        из отчёта .adt, который AutoCAD пишет рядом с чертежом при AUDITCTL=1.
+        Созданный нами отчёт удаляется; старый отчёт, не обновлённый аудитом, не читается.
+        """
+        report = os.path.splitext(os.path.abspath(input_path))[0] + '.adt'
+        before = os.path.getmtime(report) if os.path.exists(report) else None
+        previous = self.com_doc.GetVariable("AUDITCTL")
+        self.com_doc.SetVariable("AUDITCTL", 1)
+        try:
+            self.com_doc.AuditInfo(False)
+        finally:
+            self.com_doc.SetVariable("AUDITCTL", previous)
+        try:
+            if not os.path.exists(report) or os.path.getmtime(report) == before:
+                return None  # папка только для чтения или AutoCAD не пишет отчёт
+            return audit_errors(report)
+        except OSError:
+            return None
+        finally:
+            if before is None and os.path.exists(report):
+                try:
+                    os.remove(report)
+                except OSError:
+                    pass
+
+    def _save_document(self, output_path):
+        if self._fanout_outputs is None:
+            self.com_doc.SaveAs(os.path.abspath(output_path))
+            self._log(f"Сохранено: {output_path}")
+            return
+
+        # Один открытый чертёж — SaveAs для каждой цифры; меняем только отличающиеся тексты
+        initial_digit = self.replacement_digit
+        current = [txt for _, txt, _ in self._fanout_targets]
+        try:
+            for digit, path in self._fanout_outputs.items():
+                self.replacement_digit = str(digit)
+                for i, (obj, txt, location) in enumerate(self._fanout_targets):
+                    new_txt = self._apply_replacements(txt)
+                    if new_txt != current[i]:
+                        try:
+                            obj.TextString = new_txt
+                            current[i] = new_txt
+                            self._log(f"Замена в {location}: {txt} → {new_txt}")
+                        except Exception as e:
+                            self._log(f"Ошибка установки TextString в {location}: {e}")
+                self.com_doc.SaveAs(os.path.abspath(path))
+                self._log(f"Сохранено: {path}")
+        finally:
+            self.replacement_digit = initial_digit
+
+    def process_file_fanout(self, input_path, outputs):
+        """Обработка чертежа для нескольких блоков: outputs — {цифра: путь}.
+
+        Чертёж открывается и обходится один раз, затем для каждой цифры
+        выставляются тексты и выполняется SaveAs.
+        """
+        if list(outputs) == [self.replacement_digit]:
+            return self.process_file(input_path, outputs[self.replacement_digit])
+        self._fanout_outputs = outputs
+        self._fanout_targets = []
+        try:
+            return self.process_file(input_path, None)
+        finally:
+            self._fanout_outputs = None
+            self._fanout_targets = None
+
     def process_files(self, input_files, output_dir):
         results = {}
         for input_path in input_files:
@@ -407,9 +617,7 @@ class AutoCADProcessor:
                 self._log(f"Критическая ошибка обработки {input_path}: {e}")
                 results[input_path] = False
                 try:
-                    if self.com_doc is not None:
-                        self.com_doc.Close(False)  # Отклонить изменения
-                        self.com_doc = None
+                    self._close_document()
                     if self.com_app is not None:
                         self.com_app.Quit()
                         self.com_app = None
@@ -422,9 +630,7 @@ class AutoCADProcessor:
 
     def __del__(self):
         try:
-            if self.com_doc is not None:
-                self.com_doc.Close(False)  # Отклонить изменения
-                self.com_doc = None
+            self._close_document()
             if self.com_app is not None:
                 self.com_app.Quit()
                 self.com_app = None
@@ -1,26 +1,76 @@
 import os
 import re
+from operator import attrgetter
 from shutil import rmtree
 from tempfile import mkdtemp
-from zipfile import ZipFile
-from lxml import etree as ET
 import logging
-
-try:
-    import win32com.client as win32
-except ImportError:
-    win32 = None
+from lxml import etree as ET
+from backends import XLS
+from host_process import HOST_PROCESSES, process_ids, resolve_host
+from ooxml_package import Package
+from part_cache import rules_key
+from rules import changed_indices, sub_sequential, sub_sequential_batch
+from xml_splice import CachedParts
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger('ExcelProcessor')
 
+_TEXT = attrgetter('text')
+_TAIL = attrgetter('tail')
+
+# Признаки текста в самом листе: ячейки inlineStr/str или колонтитулы. Лист без них
+# ссылается только на общие строки и числа — его можно не разбирать
+_SHEET_TEXT = re.compile(rb'\st\s*=\s*["\'](?:inlineStr|str)["\']|headerFooter')
+
+
+class XlsConverter:
+    """Конвертация .xls в .xlsm через один экземпляр Excel (COM).
+
+    Экземпляр запускается один раз в start() и переиспользуется для всех файлов,
+    поэтому вызывать методы нужно из одного и того же потока.
+    """
+
+    def __init__(self, log_callback=None):
+        self.log = log_callback or (lambda msg: None)
+        self.excel = None
+        self.host_pid = None  # PID запущенного нами Excel (None — не наш или неизвестен)
+
+    def start(self):
+        # Вариант 1: Через pywin32 и Excel (Windows); модуль грузится только при конвертации
+        try:
+            import win32com.client as win32
+        except ImportError:
+            raise ImportError(
+                "pywin32 не установлен. Установите 'pip install pywin32' для конвертации на Windows.")
+        before = process_ids(HOST_PROCESSES[XLS])
+        self.excel = win32.DispatchEx('Excel.Application')
+        self.host_pid = resolve_host(self.excel, HOST_PROCESSES[XLS], before)
+        self.excel.Visible = False
+
+    def convert(self, input_path, output_path):
+        wb = self.excel.Workbooks.Open(os.path.abspath(input_path))
+        try:
+            wb.SaveAs(os.path.abspath(output_path), FileFormat=52)  # 52 = xlsm
+        finally:
+            wb.Close()
+        self.log(f"Конвертация завершена: {output_path}")
+
+    def stop(self):
+        try:
+            if self.excel is not None:
+                self.excel.Quit()
+        finally:
+            self.excel = None
+            self.host_pid = None
+
 
 class ExcelProcessor:
-    def __init__(self, replacement_digit, log_callback=None, debug=False):
+    def __init__(self, replacement_digit, log_callback=None, debug=False, part_cache=None):
         self.replacement_digit = str(replacement_digit)
         self.debug = debug  # Флаг отладки
         self.log = log_callback or (lambda msg: None)  # Если колбэк не передан — молчит
         self._log(f"Инициализация ExcelProcessor с цифрой: {self.replacement_digit}")
+        self.part_cache = part_cache  # part_cache.PartCache или None
         self.patterns = [
             # ED.D.* — меняем только последнюю цифру
             (re.compile(r'\b(ED\.D\.[A-Z]\d\d\d\.)\d'),
@@ -38,6 +88,7 @@ class ExcelProcessor:
             (re.compile(r'((?:&[LCR](?:&\d{2})?)?ED\.D\.[A-Z]\d\d\d\.)\d'),
              lambda m: f"{m.group(1)}{self.replacement_digit}"),
         ]
+        self.rules_key = rules_key('ExcelProcessor', self.patterns)
 
     def _log(self, message):
         # Логи, которые всегда записываются
@@ -57,33 +108,96 @@ class ExcelProcessor:
         if text is None:
             return None
         original_text = text
-        for pattern, repl in self.patterns:
-            text = pattern.sub(repl, text)
+        text = sub_sequential(self.patterns, text, type(self).__name__)
         if text != original_text:
             self._log(f"Замена текста: '{original_text}' → '{text}'")
         return text
 
+    def _replace_nodes(self, text_nodes, tail_nodes=()):
+        """Замены в text узлов text_nodes и tail узлов tail_nodes одним проходом каждого правила.
+
+        Тексты собираются в общий буфер (rules.sub_sequential_batch), обратно
+        записываются только изменённые. Возвращает узлы, в которых что-то изменилось.
+        """
+        text_nodes = list(filter(_TEXT, text_nodes))
+        tail_nodes = list(filter(_TAIL, tail_nodes))
+        texts = list(map(_TEXT, text_nodes)) + list(map(_TAIL, tail_nodes))
+        new_texts = sub_sequential_batch(self.patterns, texts, type(self).__name__)
+        if new_texts is None:
+            return []
+        changed = []
+        for index in changed_indices(texts, new_texts):
+            self._log(f"Замена текста: '{texts[index]}' → '{new_texts[index]}'")
+            if index < len(text_nodes):
+                node = text_nodes[index]
+                node.text = new_texts[index]
+            else:
+                node = tail_nodes[index - len(text_nodes)]
+                node.tail = new_texts[index]
+            changed.append(node)
+        return changed
+
     def _process_xml_tree(self, tree):
-        modified = False
-        nsmap = {'a': 'http://schemas.openxmlformats.org/spreadsheetml/2006/main'}
+        """Замены в части книги с учётом её разметки SpreadsheetML.
+
+        В таблице общих строк обрабатывается текст каждой строки (<si>), в листах —
+        только ячейки со строкой внутри листа (inlineStr) или строковым результатом
+        формулы (str) и колонтитулы. Числа, стили и прочая разметка не просматриваются.
+        Прочие части проходятся целиком, как раньше.
+        """
+        root = tree.getroot()
+        namespace, _, name = root.tag[1:].rpartition('}')
+        if namespace and name == 'sst':
+            return self._process_shared_strings(root, namespace)
+        if namespace and name == 'worksheet':
+            return self._process_sheet(root, namespace)
+
         # --- Проход по всем узлам ---
-        for elem in tree.iter():
-            if elem.text:
-                new_text = self._apply_replacements(elem.text)
-                if new_text != elem.text:
-                    elem.text = new_text
-                    modified = True
-            if elem.tail:
-                new_tail = self._apply_replacements(elem.tail)
-                if new_tail != elem.tail:
-                    elem.tail = new_tail
-                    modified = True
-        return modified
+        nodes = list(tree.iter())
+        return bool(self._replace_nodes(nodes, nodes))
+
+    def _process_shared_strings(self, root, namespace):
+        """Общие строки: листы ссылаются на них по номеру, поэтому замена текста листы не затрагивает."""
+        # Текст строк и их фрагментов с форматированием (<r>), включая фонетику
+        changed = self._replace_nodes(root.iter(f'{{{namespace}}}t'))
+        if changed:
+            self._log(f"Изменено текстов общих строк: {len(changed)}")
+        return bool(changed)
+
+    def _process_sheet(self, root, namespace):
+        return bool(self._replace_nodes(self._sheet_nodes(root, namespace)))
+
+    @staticmethod
+    def _sheet_nodes(root, namespace):
+        """Узлы листа с текстом для правил: строки ячеек inlineStr и str, колонтитулы."""
+        # Итераторы lxml, а не XPath: объединение больших наборов узлов в libxml2 квадратично
+        text_tag = f'{{{namespace}}}t'
+        nodes = []
+        for cell in root.iter(f'{{{namespace}}}c'):
+            cell_type = cell.get('t')
+            if cell_type == 'inlineStr':
+                nodes.extend(cell.iter(text_tag))
+            elif cell_type == 'str':
+                # Строковый результат формулы меняется вместе с самой формулой
+                nodes.extend(cell.iterchildren(f'{{{namespace}}}f', f'{{{namespace}}}v'))
+        for header_footer in root.iterchildren(f'{{{namespace}}}headerFooter'):
+            nodes.extend(header_footer.iterchildren(f'{{{namespace}}}*'))
+        return nodes
+
+    def set_digit(self, replacement_digit):
+        # Правила читают self.replacement_digit при каждой замене
+        self.replacement_digit = str(replacement_digit)
 
     def process_file(self, input_path, output_path):
+        return self.process_file_fanout(input_path, {self.replacement_digit: output_path})
+
+    def process_file_fanout(self, input_path, outputs):
+        """Обработка файла для нескольких блоков сразу: outputs — {цифра: путь}.
+
+        Конвертация .xls, чтение пакета и разбор XML выполняются один раз.
+        """
         tmp_dir = mkdtemp()
         self._log(f"Открыт файл: {input_path}")
-        modified_files = set()
         converted = False
         temp_input = None
 
@@ -93,53 +207,21 @@ class ExcelProcessor:
                 self._log(f"Обнаружен .xls файл. Конвертируем в .xlsm...")
                 temp_input = os.path.join(tmp_dir, 'converted.xlsm')
 
-                # Вариант 1: Через pywin32 и Excel (Windows)
-                if win32:
-                    excel = win32.Dispatch('Excel.Application')
-                    excel.Visible = False
-                    wb = excel.Workbooks.Open(os.path.abspath(input_path))
-                    wb.SaveAs(os.path.abspath(temp_input), FileFormat=52)  # 52 = xlsm
-                    wb.Close()
-                    excel.Quit()
-                    self._log(f"Конвертация завершена: {temp_input}")
-                else:
-                    raise ImportError(
-                        "pywin32 не установлен. Установите 'pip install pywin32' для конвертации на Windows.")
-
-
+                converter = XlsConverter(log_callback=self._log)
+                converter.start()
+                try:
+                    converter.convert(input_path, temp_input)
+                finally:
+                    converter.stop()
 
                 input_path = temp_input  # Теперь обрабатываем конвертированный файл
                 converted = True
 
             # Основная обработка (как раньше)
-            with ZipFile(input_path) as zip_in:
-                filenames = zip_in.namelist()
-                zip_in.extractall(tmp_dir)
-
-            target_files = ['xl/sharedStrings.xml']
-            target_files += [f for f in filenames if f.startswith('xl/worksheets/sheet')]
-
-            for fname in target_files:
-                full_path = os.path.join(tmp_dir, fname)
-                if not os.path.exists(full_path) or os.path.getsize(full_path) == 0:
-                    self._log(f"Пропущен файл (отсутствует или пуст): {fname}")
-                    continue
-                try:
-                    parser = ET.XMLParser(remove_blank_text=True)
-                    tree = ET.parse(full_path, parser)
-                    modified = self._process_xml_tree(tree)
-                    if modified:
-                        tree.write(full_path, encoding='UTF-8', xml_declaration=True, pretty_print=True)
-                        modified_files.add(fname)
-                        self._log(f"Файл изменен: {fname}")
-                except ET.XMLSyntaxError as e:
-                    self._log(f"Ошибка XML в {fname}: {e}")
-
-            with ZipFile(output_path, 'w') as zip_out:
-                for fname in filenames:
-                    zip_out.write(os.path.join(tmp_dir, fname), fname)
-
-            self._log(f"Файл успешно обработан: {output_path}")
+            with Package(input_path) as package:
+                self._process_package(package, outputs)
+            for output_path in outputs.values():
+                self._log(f"Файл успешно обработан: {output_path}")
             return True
 
         except Exception as e:
@@ -147,4 +229,75 @@ class ExcelProcessor:
             return False
 
         finally:
-            rmtree(tmp_dir, ignore_errors=True)
\ No newline at end of file
+            rmtree(tmp_dir, ignore_errors=True)
+
+    @staticmethod
+    def _target_parts(filenames):
+        """Части книги, к которым применяются правила: общие строки и листы."""
+        target_files = ['xl/sharedStrings.xml']
+        target_files += [f for f in filenames if f.startswith('xl/worksheets/sheet')]
+        return target_files
+
+    def iter_texts(self, input_path):
+        """Тексты книги для индекса идентификаторов (corpus_index): (часть пакета, текст).
+
+        Просматриваются те же узлы, что и при обработке (см. _process_xml_tree).
+        """
+        with Package(input_path) as package:
+            data = package.read_parts(self._target_parts(package.namelist()))
+        for fname, xml in data.items():
+            if not xml or (fname.startswith('xl/worksheets/') and not _SHEET_TEXT.search(xml)):
+                continue
+            root = ET.fromstring(xml)
+            namespace, _, name = root.tag[1:].rpartition('}')
+            if namespace and name == 'sst':
+                text_nodes, tail_nodes = root.iter(f'{{{namespace}}}t'), ()
+            elif namespace and name == 'worksheet':
+                text_nodes, tail_nodes = self._sheet_nodes(root, namespace), ()
+            else:
+                text_nodes = tail_nodes = list(root.iter())
+            for text in filter(None, map(_TEXT, text_nodes)):
+                yield fname, text
+            for text in filter(None, map(_TAIL, tail_nodes)):
+                yield fname, text
+
+    def _process_package(self, package, outputs):
+        """Обработка открытого пакета; outputs — {цифра: путь или файловый объект}.
+
+        Возвращает {цифра: были ли изменения}. Без изменений путь получает копию
+        исходного файла, а в файловый объект ничего не записывается.
+        """
+        initial_digit = self.replacement_digit
+        target_files = self._target_parts(package.namelist())
+        data = package.read_parts(target_files)
+
+        sources = {}
+        for fname in target_files:
+            if not data.get(fname):
+                self._log(f"Пропущен файл (отсутствует или пуст): {fname}")
+                continue
+            if fname.startswith('xl/worksheets/') and not _SHEET_TEXT.search(data[fname]):
+                # Общие строки правятся в sharedStrings.xml, а текста в самом листе нет
+                self._log(f"Лист без текстовых ячеек и колонтитулов пропущен: {fname}")
+                continue
+            sources[fname] = data[fname]
+        parts = CachedParts(sources, self.part_cache, self._log)
+
+        changed = {}
+        try:
+            for digit, output in outputs.items():
+                self.set_digit(digit)
+                modified_files = parts.transform(self._process_xml_tree, self.rules_key, digit)
+                for fname in modified_files:
+                    self._log(f"Файл изменен: {fname}")
+
+                if modified_files:
+                    package.write(output, modified_files)
+                elif isinstance(output, str):
+                    # Правила ничего не нашли — пакет не пересобирается
+                    method = package.copy(output)
+                    self._log(f"Изменений нет, файл скопирован без перепаковки ({method}): {output}")
+                changed[digit] = bool(modified_files)
+        finally:
+            self.set_digit(initial_digit)
+        return changed
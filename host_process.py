@@ -0,0 +1,77 @@
+import os
+import time
+from backends import XLS, DOC, DWG, SHA
+from retry import record_wait
+
+# Начало имени процесса COM-сервера (в нижнем регистре) для каждого бэкенда
+HOST_PROCESSES = {
+    DWG: ('acad',),
+    SHA: ('shape2d', 'smartsketch'),
+    XLS: ('excel',),
+    DOC: ('winword',),
+}
+
+
+def process_ids(prefixes):
+    """PID процессов, имя которых начинается с одного из prefixes (пустое множество без psutil)."""
+    try:
+        import psutil
+    except ImportError:
+        return set()
+    pids = set()
+    for proc in psutil.process_iter(['name']):
+        name = (proc.info['name'] or '').lower()
+        if name.startswith(prefixes):
+            pids.add(proc.pid)
+    return pids
+
+
+def resolve_host(app, prefixes, before):
+    """PID процесса, в котором работает COM-объект app, если его запустили мы.
+
+    Сначала по окну приложения (свойство HWND/Hwnd), иначе — единственный
+    новый процесс с подходящим именем. Процесс из before (был запущен до нас,
+    например AutoCAD инженера) своим не считается: возвращается None.
+    """
+    pid = None
+    for attr in ('HWND', 'Hwnd'):
+        try:
+            import win32process
+            pid = win32process.GetWindowThreadProcessId(int(getattr(app, attr)))[1]
+            break
+        except Exception:
+            continue
+    if not pid:
+        new_pids = process_ids(prefixes) - before
+        pid = new_pids.pop() if len(new_pids) == 1 else None
+    if pid is None or pid in before:
+        return None
+    return pid
+
+
+def kill_process(pid, timeout=10.0):
+    """Завершение процесса с ожиданием его фактического выхода (не дольше timeout)."""
+    try:
+        import psutil
+    except ImportError:
+        os.kill(pid, 9)  # на Windows — TerminateProcess
+        return
+    started = time.monotonic()
+    try:
+        proc = psutil.Process(pid)
+        proc.kill()
+        proc.wait(timeout)
+    except (psutil.NoSuchProcess, psutil.TimeoutExpired):
+        pass
+    record_wait("terminate", time.monotonic() - started)
+
+
+def process_usage(pid):
+    """(RSS в байтах, число дескрипторов) процесса или None, если узнать нельзя."""
+    try:
+        import psutil
+        proc = psutil.Process(pid)
+        handles = proc.num_handles() if hasattr(proc, 'num_handles') else proc.num_fds()
+        return proc.memory_info().rss, handles
+    except Exception:
+        return None
@@ -0,0 +1,237 @@
+import os
+import shutil
+import stat
+import sys
+import threading
+import time
+from collections import deque
+from tempfile import mkdtemp
+
+# Файловые системы, которые считаем сетевыми (Linux, /proc/mounts)
+_NETWORK_FS = ('cifs', 'smb3', 'smbfs', 'nfs', 'nfs4', 'fuse.sshfs', '9p')
+_FICLONE = 0x40049409  # ioctl клонирования файла (общие блоки вместо копии данных)
+
+
+def is_network_path(path):
+    """Путь на сетевом ресурсе: UNC, подключённый сетевой диск Windows или сетевой mount."""
+    path = os.path.abspath(path)
+    if path.startswith('\\\\') or path.startswith('//'):
+        return True
+    if sys.platform == 'win32':
+        import ctypes
+        drive = os.path.splitdrive(path)[0]
+        return bool(drive) and ctypes.windll.kernel32.GetDriveTypeW(drive + '\\') == 4  # DRIVE_REMOTE
+    try:
+        with open('/proc/mounts', encoding='utf-8') as mounts:
+            best, fs_type = '', ''
+            for line in mounts:
+                fields = line.split()
+                if len(fields) > 2 and (path == fields[1] or path.startswith(fields[1].rstrip('/') + '/')):
+                    if len(fields[1]) > len(best):
+                        best, fs_type = fields[1], fields[2]
+            return fs_type in _NETWORK_FS
+    except OSError:
+        return False
+
+
+def atomic_copy(source, destination):
+    """Копирование под временным именем в папке назначения и атомарное переименование."""
+    directory, name = os.path.split(destination)
+    temp_path = os.path.join(directory, f".{name}.part")
+    try:
+        shutil.copyfile(source, temp_path)
+        os.replace(temp_path, destination)
+    except BaseException:
+        try:
+            os.remove(temp_path)
+        except OSError:
+            pass
+        raise
+
+
+def kernel_copy(source, destination):
+    """Копирование файла без передачи данных через Python; возвращает способ копирования для лога.
+
+    Windows — CopyFileW (на ReFS клонирует блоки). Linux — reflink (ioctl FICLONE:
+    btrfs, XFS), затем copy_file_range и sendfile. Если ни один способ
+    не сработал, файл копируется обычным образом.
+    """
+    if sys.platform == 'win32':
+        import ctypes
+        if ctypes.windll.kernel32.CopyFileW(source, destination, False):
+            # CopyFileW переносит атрибуты и время изменения, а результат — новый файл
+            os.chmod(destination, stat.S_IREAD | stat.S_IWRITE)
+            os.utime(destination)
+            return 'CopyFile'
+    with open(source, 'rb') as src, open(destination, 'wb') as dst:
+        size = os.fstat(src.fileno()).st_size
+        try:
+            import fcntl
+            fcntl.ioctl(dst.fileno(), _FICLONE, src.fileno())
+            return 'reflink'
+        except (ImportError, OSError):
+            pass
+        for method in ('copy_file_range', 'sendfile'):
+            if not hasattr(os, method):
+                continue
+            copied = 0
+            try:
+                while copied < size:
+                    if method == 'copy_file_range':
+                        sent = os.copy_file_range(src.fileno(), dst.fileno(), size - copied, copied, copied)
+                    else:
+                        dst.seek(copied)
+                        sent = os.sendfile(dst.fileno(), src.fileno(), copied, size - copied)
+                    if not sent:
+                        break
+                    copied += sent
+            except OSError:
+                pass
+            if copied == size:
+                return method
+            dst.truncate(0)
+        src.seek(0)
+        dst.seek(0)
+        shutil.copyfileobj(src, dst)
+    return 'copyfileobj'
+
+
+class StagingArea:
+    """Опережающее чтение входных файлов в локальную папку и отложенная запись результатов.
+
+    Входные файлы копируются с сетевого ресурса фоновыми потоками заранее,
+    по очереди на каждый бэкенд, чтобы длинная очередь DWG не занимала всё
+    окно упреждения. Обработчики пишут результаты на локальный диск, а затем
+    они копируются в папку назначения (временное имя + os.replace).
+
+    Объём локальных данных ограничен: слот файла освобождается только после
+    записи его результатов, поэтому чтение притормаживает, если обработка или
+    запись не успевают. Окно бэкенда — per_backend заданий, для бэкендов
+    из limits ({бэкенд: окно}) — своё: пул процессов Word/Excel обрабатывает
+    несколько файлов сразу, и окна в два файла ему мало. События ('fetched', job, ошибка) и ('written', job, успех)
+    кладутся в очередь events; время копирования — в job.fetch_seconds и job.write_seconds.
+    """
+
+    def __init__(self, events, per_backend=2, max_bytes=512 * 1024 * 1024, readers=2, writers=2, limits=None):
+        self.events = events
+        self.per_backend = per_backend
+        self.limits = limits or {}
+        self.max_bytes = max_bytes
+        self.scratch = mkdtemp(prefix='wesa_')
+        self._pending = {}  # бэкенд -> deque заданий, ожидающих чтения
+        self._order = deque()  # очередность бэкендов для чтения по кругу
+        self._in_flight = {}  # бэкенд -> число заданий, прочитанных и ещё не записанных
+        self._bytes = 0
+        self._writes = deque()
+        self._closed = False
+        self._counter = 0
+        self._lock = threading.Condition()
+        self._threads = [threading.Thread(target=self._reader, name=f"prefetch-{i}", daemon=True)
+                         for i in range(readers)]
+        self._threads += [threading.Thread(target=self._writer, name=f"write-behind-{i}", daemon=True)
+                          for i in range(writers)]
+        for thread in self._threads:
+            thread.start()
+
+    def submit(self, job):
+        try:
+            job.size = os.path.getsize(job.input_path)
+        except OSError:
+            job.size = 0  # ошибку покажет копирование
+        with self._lock:
+            self._counter += 1
+            job.stage_dir = os.path.join(self.scratch, str(self._counter))
+            # Бэкенд задания может смениться (.xls → конвертация), слот считается по исходному
+            job.stage_queue = job.backend
+            if job.stage_queue not in self._pending:
+                self._pending[job.stage_queue] = deque()
+                self._in_flight[job.stage_queue] = 0
+                self._order.append(job.stage_queue)
+            self._pending[job.stage_queue].append(job)
+            self._lock.notify_all()
+
+    def finish(self, job, success):
+        """Обработка задания завершена: результаты уходят на запись, входная копия удаляется."""
+        with self._lock:
+            self._writes.append((job, success))
+            self._lock.notify_all()
+
+    def close(self):
+        with self._lock:
+            self._closed = True
+            self._lock.notify_all()
+        for thread in self._threads:
+            thread.join()
+        shutil.rmtree(self.scratch, ignore_errors=True)
+
+    def _next_fetch(self):
+        # Бэкенды по кругу; файл больше бюджета читается, только если больше ничего не в работе
+        for _ in range(len(self._order)):
+            backend = self._order[0]
+            self._order.rotate(-1)
+            pending = self._pending[backend]
+            if pending and self._in_flight[backend] < self.limits.get(backend, self.per_backend):
+                job = pending[0]
+                if self._bytes + job.size <= self.max_bytes or self._bytes == 0:
+                    pending.popleft()
+                    self._in_flight[backend] += 1
+                    self._bytes += job.size
+                    return job
+        return None
+
+    def _reader(self):
+        while True:
+            with self._lock:
+                job = None
+                while job is None:
+                    if self._closed:
+                        return
+                    job = self._next_fetch()
+                    if job is None:
+                        self._lock.wait()
+            error = None
+            started = time.monotonic()
+            try:
+                os.makedirs(job.stage_dir)
+                local_input = os.path.join(job.stage_dir, job.filename)
+                shutil.copyfile(job.input_path, local_input)
+                job.source_path = local_input
+                job.targets = {}
+                for digit, output_path in job.outputs.items():
+                    target_dir = os.path.join(job.stage_dir, 'out', digit)
+                    os.makedirs(target_dir, exist_ok=True)
+                    job.targets[digit] = os.path.join(target_dir, os.path.basename(output_path))
+            except Exception as e:
+                error = e
+                self._release(job)
+            job.fetch_seconds = time.monotonic() - started
+            self.events.put(('fetched', job, error))
+
+    def _writer(self):
+        while True:
+            with self._lock:
+                while not self._writes and not self._closed:
+                    self._lock.wait()
+                if not self._writes:
+                    return
+                job, success = self._writes.popleft()
+            error = None
+            started = time.monotonic()
+            if success:
+                try:
+                    for digit, output_path in job.outputs.items():
+                        # Обработчик мог не сохранить файл (например, SHA без изменений)
+                        if os.path.exists(job.targets[digit]):
+                            atomic_copy(job.targets[digit], output_path)
+                except Exception as e:
+                    error = e
+            job.write_seconds = time.monotonic() - started
+            self._release(job)
+            self.events.put(('written', job, error if error else success))
+
+    def _release(self, job):
+        shutil.rmtree(job.stage_dir, ignore_errors=True)
+        with self._lock:
+            self._in_flight[job.stage_queue] -= 1
+            self._bytes -= job.size
+            self._lock.notify_all()
@@ -0,0 +1,383 @@
+import argparse
+import json
+import os
+import socket
+import sqlite3
+import sys
+import threading
+import time
+from datetime import datetime
+from multiprocessing import freeze_support
+from backends import BACKENDS, DWG
+from batch import UNITS, make_jobs, select_files
+from cost_model import CostModel
+from io_pipeline import is_network_path
+from metrics import export_metrics
+from part_cache import default_cache_path
+from scheduler import BatchScheduler, Job
+
+# Аренда задания: без продления за это время задание снова становится доступным
+DEFAULT_LEASE = 120.0
+# Сколько раз задание может быть выдано, прежде чем будет признано неисполнимым
+MAX_ATTEMPTS = 3
+POLL_INTERVAL = 2.0
+
+PENDING = 'pending'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY,
+    batch TEXT NOT NULL,
+    input_path TEXT NOT NULL,
+    outputs TEXT NOT NULL,
+    backend TEXT NOT NULL,
+    predicted REAL NOT NULL DEFAULT 0,
+    state TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    worker TEXT,
+    lease_until REAL,
+    error TEXT,
+    created REAL NOT NULL,
+    finished REAL
+);
+CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, backend, predicted);
+"""
+
+
+def default_worker_name():
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+class JobQueue:
+    """Общая очередь заданий в файле SQLite: один пакет могут разбирать несколько компьютеров.
+
+    Координатор кладёт задания (enqueue), исполнители забирают их в аренду
+    (claim) и продлевают её, пока обрабатывают (renew). Задание, аренда которого
+    истекла (исполнитель упал или потерял связь), выдаётся снова, но не более
+    MAX_ATTEMPTS раз. Результат принимается только от текущего арендатора.
+
+    Файл базы может лежать на сетевом ресурсе: журнал — обычный (WAL требует
+    общей памяти и на сетевых ресурсах не работает), запись — в транзакциях
+    BEGIN IMMEDIATE. Сроки аренды считаются по часам исполнителей, поэтому
+    часы компьютеров должны быть синхронизированы с точностью много меньше аренды.
+    Каждый поток открывает свой JobQueue.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.conn = sqlite3.connect(path, timeout=60, isolation_level=None)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.executescript(_SCHEMA)
+
+    def close(self):
+        self.conn.close()
+
+    def _transaction(self):
+        return _Transaction(self.conn)
+
+    def enqueue(self, jobs, batch):
+        """Постановка заданий scheduler.Job пакета batch; job.predicted задаёт порядок выдачи."""
+        now = time.time()
+        with self._transaction():
+            self.conn.executemany(
+                "INSERT INTO jobs (batch, input_path, outputs, backend, predicted, created) VALUES (?, ?, ?, ?, ?, ?)",
+                [(batch, job.input_path, json.dumps(job.outputs, ensure_ascii=False), job.backend,
+                  job.predicted, now) for job in jobs])
+
+    def claim(self, worker, backends, limit=1, lease=DEFAULT_LEASE):
+        """Аренда до limit заданий указанных бэкендов, самые долгие первыми: список scheduler.Job."""
+        now = time.time()
+        marks = ", ".join("?" * len(backends))
+        with self._transaction():
+            # Задания, аренда которых истекала слишком часто, больше не выдаются
+            self.conn.execute(
+                "UPDATE jobs SET state = ?, error = ?, finished = ? "
+                "WHERE state = ? AND lease_until < ? AND attempts >= ?",
+                (FAILED, "аренда истекла без результата", now, RUNNING, now, MAX_ATTEMPTS))
+            rows = self.conn.execute(
+                f"SELECT * FROM jobs WHERE backend IN ({marks}) "
+                f"AND (state = ? OR (state = ? AND lease_until < ?)) "
+                f"ORDER BY predicted DESC, id LIMIT ?",
+                (*backends, PENDING, RUNNING, now, limit)).fetchall()
+            self.conn.executemany(
+                "UPDATE jobs SET state = ?, worker = ?, lease_until = ?, attempts = attempts + 1 WHERE id = ?",
+                [(RUNNING, worker, now + lease, row['id']) for row in rows])
+        jobs = []
+        for row in rows:
+            job = Job(row['input_path'], json.loads(row['outputs']), row['backend'])
+            job.queue_id = row['id']
+            jobs.append(job)
+        return jobs
+
+    def renew(self, worker, ids, lease=DEFAULT_LEASE):
+        """Продление аренды; возвращает id заданий, аренда которых уже потеряна."""
+        if not ids:
+            return set()
+        now = time.time()
+        marks = ", ".join("?" * len(ids))
+        with self._transaction():
+            self.conn.execute(
+                f"UPDATE jobs SET lease_until = ? WHERE worker = ? AND state = ? AND id IN ({marks})",
+                (now + lease, worker, RUNNING, *ids))
+            held = {row[0] for row in self.conn.execute(
+                f"SELECT id FROM jobs WHERE worker = ? AND state = ? AND id IN ({marks})",
+                (worker, RUNNING, *ids))}
+        return set(ids) - held
+
+    def complete(self, worker, job_id, success, error=None):
+        """Результат задания; False — аренда уже перешла к другому исполнителю."""
+        with self._transaction():
+            cursor = self.conn.execute(
+                "UPDATE jobs SET state = ?, error = ?, finished = ?, lease_until = NULL "
+                "WHERE id = ? AND worker = ? AND state = ?",
+                (DONE if success else FAILED, error, time.time(), job_id, worker, RUNNING))
+        return cursor.rowcount == 1
+
+    def unfinished(self, backends):
+        """Число заданий указанных бэкендов, которые ещё ждут исполнителя или обрабатываются."""
+        marks = ", ".join("?" * len(backends))
+        return self.conn.execute(f"SELECT COUNT(*) FROM jobs WHERE backend IN ({marks}) AND state IN (?, ?)",
+                                 (*backends, PENDING, RUNNING)).fetchone()[0]
+
+    def status(self, batch=None):
+        """{(пакет, бэкенд, состояние): число заданий}."""
+        query = "SELECT batch, backend, state, COUNT(*) FROM jobs"
+        params = ()
+        if batch:
+            query += " WHERE batch = ?"
+            params = (batch,)
+        query += " GROUP BY batch, backend, state ORDER BY batch, backend, state"
+        return {(row[0], row[1], row[2]): row[3] for row in self.conn.execute(query, params)}
+
+    def failures(self, batch=None):
+        query = "SELECT input_path, worker, attempts, error FROM jobs WHERE state = ?"
+        params = (FAILED,)
+        if batch:
+            query += " AND batch = ?"
+            params += (batch,)
+        return self.conn.execute(query + " ORDER BY id", params).fetchall()
+
+
+class _Transaction:
+    """BEGIN IMMEDIATE … COMMIT: блокировка записи берётся сразу, а не при первом изменении."""
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __enter__(self):
+        self.conn.execute("BEGIN IMMEDIATE")
+
+    def __exit__(self, exc_type, exc, tb):
+        self.conn.execute("COMMIT" if exc_type is None else "ROLLBACK")
+
+
+class _LeaseKeeper(threading.Thread):
+    """Продление аренды удерживаемых заданий каждую треть срока, через своё соединение."""
+
+    def __init__(self, path, worker, lease, log):
+        super().__init__(name="lease-keeper", daemon=True)
+        self.path = path
+        self.worker = worker
+        self.lease = lease
+        self.log = log
+        self.held = set()
+        self.lost = set()
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+
+    def hold(self, ids):
+        with self._lock:
+            self.held.update(ids)
+
+    def release(self, job_id):
+        with self._lock:
+            self.held.discard(job_id)
+
+    def count(self):
+        with self._lock:
+            return len(self.held)
+
+    def stop(self):
+        self._stopping.set()
+        self.join()
+
+    def run(self):
+        queue = JobQueue(self.path)
+        try:
+            while not self._stopping.wait(self.lease / 3):
+                with self._lock:
+                    ids = list(self.held)
+                try:
+                    lost = queue.renew(self.worker, ids, self.lease)
+                except sqlite3.Error as e:
+                    # База недоступна (сеть): следующая попытка через треть срока
+                    self.log(f"Очередь: не удалось продлить аренду: {str(e)}")
+                    continue
+                if lost - self.lost:
+                    self.log(f"Очередь: аренда потеряна для заданий {sorted(lost - self.lost)}")
+                with self._lock:
+                    self.lost |= lost
+        finally:
+            queue.close()
+
+
+def run_worker(path, log, backends=None, capacity=None, lease=DEFAULT_LEASE, exit_when_empty=False,
+               worker=None, debug=False, staging=None, job_timeout=None, dwg_editor=False, part_cache=True,
+               metrics=None):
+    """Исполнитель: забирает задания из очереди path и обрабатывает их, пока его не остановят.
+
+    backends — какие бэкенды брать (по умолчанию все, для которых установлены
+    модули), capacity — сколько заданий держать одновременно. Задания подаются
+    в один BatchScheduler, поэтому AutoCAD и SmartSketch не перезапускаются
+    между заданиями. exit_when_empty — завершиться, когда в очереди не останется
+    ни ожидающих, ни обрабатываемых заданий его бэкендов. metrics — файл *.prom
+    или [АДРЕС:]ПОРТ для метрик исполнителя. Возвращает (успешно, с ошибкой).
+    """
+    worker = worker or default_worker_name()
+    backends = backends or [name for name, backend in BACKENDS.items() if backend.available()]
+    capacity = capacity or max(2, os.cpu_count() or 1)
+    if staging is None:
+        staging = is_network_path(path)
+    if part_cache is True:
+        part_cache = default_cache_path()
+
+    queue = JobQueue(path)
+    keeper = _LeaseKeeper(path, worker, lease, log)
+    keeper.start()
+    last_poll = 0.0
+    counts = [0, 0]
+    log(f"Очередь {path}: исполнитель {worker}, бэкенды: {', '.join(backends)}")
+
+    def more():
+        nonlocal last_poll
+        held = keeper.count()
+        if held >= capacity or time.monotonic() - last_poll < POLL_INTERVAL:
+            return []
+        last_poll = time.monotonic()
+        try:
+            jobs = queue.claim(worker, backends, capacity - held, lease)
+            if not jobs and not held and exit_when_empty and not queue.unfinished(backends):
+                return None
+        except sqlite3.Error as e:
+            log(f"Очередь: ошибка чтения: {str(e)}")
+            return []
+        keeper.hold(job.queue_id for job in jobs)
+        for job in jobs:
+            log(f"Очередь: получено задание {job.filename} ({job.backend})")
+        return jobs
+
+    registry, exporter = export_metrics(metrics, log) if metrics else (None, None)
+    scheduler = BatchScheduler(UNITS[0], debug=debug, staging=staging, job_timeout=job_timeout,
+                               backend_options={DWG: {'database_only': not dwg_editor}},
+                               part_cache=part_cache or None, cost_model=CostModel(), metrics=registry)
+    try:
+        for job, success in scheduler.run([], log=log, more=more):
+            keeper.release(job.queue_id)
+            counts[0 if success else 1] += 1
+            log(f"{'Успешно' if success else 'Ошибка обработки'}: {job.filename}")
+            try:
+                accepted = queue.complete(worker, job.queue_id, success,
+                                          None if success else "ошибка обработки, см. лог исполнителя")
+            except sqlite3.Error as e:
+                log(f"Очередь: результат {job.filename} не записан: {str(e)}")
+                continue
+            if not accepted:
+                log(f"Очередь: аренда {job.filename} истекла, результат записан другим исполнителем")
+    finally:
+        keeper.stop()
+        queue.close()
+        if exporter is not None:
+            exporter.stop()
+    return tuple(counts)
+
+
+def main(argv=None):
+    """Очередь заданий: python job_queue.py enqueue|work|status --db ФАЙЛ."""
+    parser = argparse.ArgumentParser(description="Общая очередь заданий для нескольких компьютеров")
+    parser.add_argument("--db", required=True, help="Файл очереди SQLite (общий для всех компьютеров)")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    enqueue = commands.add_parser("enqueue", help="Поставить папку в очередь")
+    enqueue.add_argument("--input", required=True, help="Папка с исходными файлами")
+    enqueue.add_argument("--output", required=True, help="Папка для сохранения новых файлов")
+    enqueue.add_argument("--digit", default="1", choices=UNITS, help="Номер блока")
+    enqueue.add_argument("--all-units", action="store_true", help="Все блоки (1–4) в подпапки \"Блок N\"")
+    enqueue.add_argument("--batch", help="Имя пакета (по умолчанию — дата и время)")
+
+    work = commands.add_parser("work", help="Обрабатывать задания из очереди")
+    work.add_argument("--backends", help="Бэкенды через запятую (по умолчанию все установленные)")
+    work.add_argument("--capacity", type=int, help="Сколько заданий держать одновременно")
+    work.add_argument("--lease", type=float, default=DEFAULT_LEASE, help="Срок аренды задания, секунды")
+    work.add_argument("--exit-when-empty", action="store_true", help="Завершиться, когда очередь опустеет")
+    work.add_argument("--name", help="Имя исполнителя (по умолчанию компьютер:процесс)")
+    work.add_argument("--staging", default="auto", choices=("auto", "on", "off"),
+                      help="Локальная подготовка файлов (auto — если очередь на сетевом ресурсе)")
+    work.add_argument("--job-timeout", type=float, help="Предельное время одного файла DWG/SHA/XLS/DOC, секунды")
+    work.add_argument("--dwg-editor", action="store_true", help="Открывать чертежи в редакторе AutoCAD")
+    work.add_argument("--no-part-cache", action="store_true", help="Не использовать кэш частей")
+    work.add_argument("--metrics", metavar="ФАЙЛ.prom|ПОРТ",
+                      help="Метрики Prometheus: файл для textfile collector или HTTP-порт")
+    work.add_argument("--log", help="Файл лога исполнителя")
+    work.add_argument("--debug", action="store_true", help="Отладочные логи")
+
+    status = commands.add_parser("status", help="Состояние очереди")
+    status.add_argument("--batch", help="Только указанный пакет")
+    args = parser.parse_args(argv)
+
+    log_file = open(args.log, 'a', encoding='utf-8') if getattr(args, 'log', None) else None
+
+    def log(message):
+        log_message = f"[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] {message}"
+        print(log_message, flush=True)
+        if log_file:
+            log_file.write(log_message + "\n")
+            log_file.flush()
+
+    try:
+        if args.command == "enqueue":
+            if not os.path.isdir(args.input):
+                parser.error("папка с исходными файлами не найдена")
+            batch = args.batch or datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+            # Пути — абсолютные: исполнители на других компьютерах должны видеть те же файлы
+            input_files = [os.path.abspath(path) for path in select_files(args.input)]
+            jobs = make_jobs(input_files, os.path.abspath(args.output), args.digit, log,
+                             all_units=args.all_units, installed_only=False)
+            cost_model = CostModel()
+            for job in jobs:
+                job.size = os.path.getsize(job.input_path)
+                job.predicted = cost_model.predict(job.backend, job.input_path, job.size)
+            queue = JobQueue(args.db)
+            queue.enqueue(jobs, batch)
+            queue.close()
+            log(f"Пакет '{batch}': в очередь поставлено заданий: {len(jobs)}")
+            return 0
+
+        if args.command == "work":
+            done, failed = run_worker(
+                args.db, log, backends=args.backends.split(",") if args.backends else None,
+                capacity=args.capacity, lease=args.lease, exit_when_empty=args.exit_when_empty,
+                worker=args.name, debug=args.debug,
+                staging={"auto": None, "on": True, "off": False}[args.staging],
+                job_timeout=args.job_timeout, dwg_editor=args.dwg_editor,
+                part_cache=not args.no_part_cache, metrics=args.metrics)
+            log(f"Исполнитель завершён. Успешно: {done}, с ошибкой: {failed}")
+            return 0 if not failed else 1
+
+        queue = JobQueue(args.db)
+        for (batch, backend, state), count in queue.status(args.batch).items():
+            log(f"{batch} | {backend} | {state}: {count}")
+        for row in queue.failures(args.batch):
+            log(f"Ошибка: {row['input_path']} ({row['worker']}, попыток {row['attempts']}): {row['error']}")
+        queue.close()
+        return 0
+    finally:
+        if log_file:
+            log_file.close()
+
+
+if __name__ == "__main__":
+    freeze_support()  # для пула процессов в сборке PyInstaller
+    sys.exit(main())
@@ -1,14 +1,11 @@
 import os, sys
-import re
-import glob
 import tkinter as tk
 from tkinter import filedialog, messagebox, scrolledtext
 from datetime import datetime
-from excel_parser import ExcelProcessor
-from word_parser import WordProcessor
-from dwg_parser import AutoCADProcessor
-from sha_parser import ShaProcessorWinAPI
-from PIL import Image, ImageTk
+from multiprocessing import freeze_support
+from batch import UNITS, process_files, select_files
+from profiling import ProfileSettings
+
 
 class FileProcessorGUI:
     def __init__(self, root):
@@ -20,6 +17,9 @@ class FileProcessorGUI:
         self.input_dir = tk.StringVar()
         self.output_dir = tk.StringVar()
         self.debug_logging = tk.BooleanVar(value=False)  # Галочка для отладочных логов
+        self.all_units = tk.BooleanVar(value=False)  # Все блоки сразу, по подпапкам
+        self.profiling = tk.BooleanVar(value=False)  # Отчёты профилировщика рядом с результатами
+        self.profile_mode = tk.StringVar(value="slow=60")
         self.log_file = None
         self.create_widgets()
 
@@ -37,10 +37,11 @@ class FileProcessorGUI:
         frame_digits = tk.Frame(self.root)
         frame_digits.pack(anchor="w", padx=10)
 
-        digits = [("1", "1"), ("2", "2"), ("3", "3"), ("4", "4")]
+        digits = [(unit, unit) for unit in UNITS]
         for text, value in digits:
             tk.Radiobutton(frame_digits, text=text, variable=self.replacement_digit,
                            value=value).pack(side="left", padx=5)
+        tk.Checkbutton(frame_digits, text="Все блоки (1–4)", variable=self.all_units).pack(side="left", padx=5)
 
 
 
@@ -56,7 +57,11 @@ class FileProcessorGUI:
         tk.Entry(frame_out, textvariable=self.output_dir, width=50).pack(side="left")
         tk.Button(frame_out, text="Выбрать...", command=self.choose_output_dir).pack(side="left", padx=5)
 
-        tk.Checkbutton(self.root, text="Отладочные логи", variable=self.debug_logging).pack(anchor="w", padx=10, pady=5)
+        frame_options = tk.Frame(self.root)
+        frame_options.pack(anchor="w", padx=10, pady=5)
+        tk.Checkbutton(frame_options, text="Отладочные логи", variable=self.debug_logging).pack(side="left")
+        tk.Checkbutton(frame_options, text="Профилирование:", variable=self.profiling).pack(side="left", padx=(15, 0))
+        tk.Entry(frame_options, textvariable=self.profile_mode, width=22).pack(side="left")
         btn_run = tk.Button(frame_right, text="Запустить обработку",
                             command=self.run_processing,
                             bg="green", fg="white", font=("Arial", 11), padx=5, pady=5)
@@ -123,91 +128,12 @@ class FileProcessorGUI:
         self.log_to_gui(message)
 
     def select_files(self, input_dir):
-        excel_files = glob.glob(os.path.join(input_dir, '*.xls*'))
-        word_files = glob.glob(os.path.join(input_dir, '*.do*'))
-        dwg_files = glob.glob(os.path.join(input_dir, '*.dwg'))
-        sha_files = glob.glob(os.path.join(input_dir, '*.sha'))
-        files = excel_files + word_files + dwg_files + sha_files
-        return files
-
-    def process_files(self, input_files, output_dir, replacement_digit):
-        os.makedirs(output_dir, exist_ok=True)
-        processed = 0
-
-        sha_processor = ShaProcessorWinAPI(replacement_digit, log_callback=self.log, debug=self.debug_logging.get())
-        sha_app_started = False
-        try:
-            for input_path in input_files:
-                try:
-                    filename = os.path.basename(input_path)
-                    name, ext = os.path.splitext(filename)
-
-                    if name[0].isdigit():
-                        new_name = f"{replacement_digit}{name[1:]}"
-                    elif name.startswith("ED.D."):
-                        new_name = re.sub(
-                            r'(ED\.D\.[A-Z]\d{3}\.)(\d)',
-                            lambda m: f"{m.group(1)}{replacement_digit}",
-                            name
-                        )
-                    else:
-                        new_name = f"processed_{name}"
-
-                    if ext == ".xls":
-                        output_path = os.path.join(output_dir, new_name + ".xlsm")
-                    else:
-                        output_path = os.path.join(output_dir, new_name + ext)
-                    extension = ext.lower()
-
-                    if extension in ('.doc', '.docx', '.dotx'):
-                        processor = WordProcessor(replacement_digit, log_callback=self.log, debug=self.debug_logging.get())
-                        success = processor.process_file(input_path, output_path)
-                        if success:
-                            self.log(f"Успешно: {filename}")
-                            processed += 1
-                        else:
-                            self.log(f"Ошибка обработки: {filename}")
-
-                    elif extension in ('.xls', '.xlsx', '.xlsm'):
-                        processor = ExcelProcessor(replacement_digit, log_callback=self.log, debug=self.debug_logging.get())
-                        success = processor.process_file(input_path, output_path)
-                        if success:
-                            self.log(f"Успешно: {filename}")
-                            processed += 1
-                        else:
-                            self.log(f"Ошибка обработки: {filename}")
-
-                    elif extension == '.dwg':
-                        processor = AutoCADProcessor(replacement_digit, log_callback=self.log, debug=self.debug_logging.get())
-                        success_list = processor.process_files([input_path], output_dir)
-                        if all(success_list.values()):  # Check the values of the dictionary
-                            self.log(f"Успешно: {filename}")
-                            processed += 1
-                        else:
-                            self.log(f"Ошибка обработки: {filename}")
-
-                    elif extension == '.sha':
-                        if not sha_app_started:
-                            sha_processor.start_app()
-                            sha_app_started = True
-                        success = sha_processor.process_file(input_path, output_path)
-                        if success:
-                            self.log(f"Успешно: {filename}")
-                            processed += 1
-                        else:
-                            self.log(f"Ошибка обработки: {filename}")
-
-                    else:
-                        self.log(f"Пропуск {filename} (неподдерживаемый формат: {extension})")
-
-                except Exception as e:
-                    self.log(f"Критическая ошибка {filename}: {str(e)}")
-
-        finally:
-            if sha_app_started:
-                sha_processor.stop_app()
+        return select_files(input_dir)
 
-        return processed
+    def process_files(self, input_files, output_dir, replacement_digit, profile=None):
+        return process_files(input_files, output_dir, replacement_digit, log=self.log,
+                             debug=self.debug_logging.get(), all_units=self.all_units.get(),
+                             idle=self.root.update, daemon=True, profile=profile)
 
     def run_processing(self):
         repl_digit = self.replacement_digit.get().strip()
@@ -225,6 +151,15 @@ class FileProcessorGUI:
             messagebox.showerror("Ошибка", "Выберите папку для сохранения файлов!")
             return
 
+        profile = None
+        if self.profiling.get():
+            try:
+                profile = ProfileSettings.parse(self.profile_mode.get())
+            except ValueError:
+                messagebox.showerror("Ошибка", "Режим профилирования: all, sample=ДОЛЯ, slow=СЕКУНДЫ, rss=МБ "
+                                               "(через запятую)")
+                return
+
         try:
             log_file_path = os.path.join(output_dir, "log.txt")
             self.log_file = open(log_file_path, 'a', encoding='utf-8')
@@ -240,7 +175,7 @@ class FileProcessorGUI:
                 self.log("Файлы не найдены.")
                 return
 
-            processed_count = self.process_files(input_files, output_dir, repl_digit)
+            processed_count = self.process_files(input_files, output_dir, repl_digit, profile=profile)
             self.log(f"Обработка завершена. Успешно обработано: {processed_count}/{len(input_files)}")
             self.log(f"Результаты сохранены в: {output_dir}")
 
@@ -281,8 +216,12 @@ class FileProcessorGUI:
         lbl.pack(fill="both", expand=True)
 
 def set_icon(root, icon_path):
-    img = Image.open(icon_path)
-    icon = ImageTk.PhotoImage(img)
+    # PNG Tk 8.6 читает сам; Pillow загружается только для остальных форматов
+    try:
+        icon = tk.PhotoImage(file=icon_path)
+    except tk.TclError:
+        from PIL import Image, ImageTk
+        icon = ImageTk.PhotoImage(Image.open(icon_path))
     root.iconphoto(False, icon)
 
 def resource_path(relative_path):
@@ -291,6 +230,7 @@ def resource_path(relative_path):
     return os.path.join(os.path.abspath("."), relative_path)
 
 if __name__ == "__main__":
+    freeze_support()  # для пула процессов в сборке PyInstaller
     root = tk.Tk()
     set_icon(root, resource_path("icon.png"))
     app = FileProcessorGUI(root)
@@ -0,0 +1,208 @@
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Границы гистограмм времени этапов, секунды
+LATENCY_BUCKETS = (0.1, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0, 600.0)
+# Как часто переписывается файл метрик, секунды
+TEXTFILE_INTERVAL = 10.0
+DEFAULT_HOST = '127.0.0.1'
+
+# Имя -> (тип, описание) для строк # TYPE и # HELP
+METRICS = {
+    'wesa_files_total': ('counter', "Обработанные файлы по бэкенду и результату"),
+    'wesa_input_bytes_total': ('counter', "Размер входных файлов, байты"),
+    'wesa_output_bytes_total': ('counter', "Размер записанных результатов, байты"),
+    'wesa_stage_seconds': ('histogram', "Время этапа обработки файла: fetch, process, write, total"),
+    'wesa_retry_waits_total': ('counter', "Ожидания и повторы обращений к COM-приложениям"),
+    'wesa_retry_wait_seconds_total': ('counter', "Время ожиданий и повторов, секунды"),
+    'wesa_com_host_starts_total': ('counter', "Запуски дочерних COM-процессов"),
+    'wesa_com_host_stops_total': ('counter', "Остановки дочерних COM-процессов по причине"),
+    'wesa_com_app_starts_total': ('counter', "Запуски COM-приложений (AutoCAD, SmartSketch, Excel, Word)"),
+    'wesa_part_cache_requests_total': ('counter', "Обращения к кэшу частей Word/Excel: hit, miss"),
+    'wesa_queue_depth': ('gauge', "Файлы бэкенда, принятые и ещё не завершённые"),
+    'wesa_com_queue_depth': ('gauge', "Файлы, ожидающие COM-приложения"),
+    'wesa_last_update_timestamp_seconds': ('gauge', "Время последнего обновления метрик, Unix"),
+}
+
+
+def _labels(labels):
+    return tuple(sorted(labels.items()))
+
+
+def _format_labels(labels, extra=()):
+    items = list(labels) + list(extra)
+    if not items:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in items)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(items, escaped)) + '}'
+
+
+def _format_number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metrics:
+    """Метрики пакета в памяти: счётчики, значения и гистограммы с метками.
+
+    Обновляются из потока планировщика и COM-потоков, читаются экспортёрами
+    (render) — все обращения под одной блокировкой. Имена — из METRICS.
+    """
+
+    def __init__(self):
+        self._values = {}  # (имя, метки) -> число
+        self._histograms = {}  # (имя, метки) -> [число по корзинам..., сумма, число наблюдений]
+        self._updated = time.time()
+        self._lock = threading.Lock()
+
+    def inc(self, name, value=1, **labels):
+        if not value:
+            return
+        key = (name, _labels(labels))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+            self._updated = time.time()
+
+    def set(self, name, value, **labels):
+        with self._lock:
+            self._values[(name, _labels(labels))] = value
+            self._updated = time.time()
+
+    def observe(self, name, value, **labels):
+        key = (name, _labels(labels))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [0] * len(LATENCY_BUCKETS) + [0.0, 0]
+            for index, bound in enumerate(LATENCY_BUCKETS):
+                if value <= bound:
+                    histogram[index] += 1
+            histogram[-2] += value
+            histogram[-1] += 1
+            self._updated = time.time()
+
+    def render(self):
+        """Текстовый формат Prometheus (версия 0.0.4)."""
+        with self._lock:
+            values = dict(self._values)
+            histograms = {key: list(value) for key, value in self._histograms.items()}
+            updated = self._updated
+        values[('wesa_last_update_timestamp_seconds', ())] = round(updated, 3)
+        lines = []
+        for name, (kind, description) in METRICS.items():
+            series = sorted((labels, value) for (key, labels), value in values.items() if key == name)
+            observed = sorted((labels, value) for (key, labels), value in histograms.items() if key == name)
+            if not series and not observed:
+                continue
+            lines.append(f"# HELP {name} {description}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, value in series:
+                lines.append(f"{name}{_format_labels(labels)} {_format_number(value)}")
+            for labels, histogram in observed:
+                for bound, count in zip(LATENCY_BUCKETS, histogram):
+                    lines.append(f"{name}_bucket{_format_labels(labels, [('le', repr(bound))])} {count}")
+                lines.append(f"{name}_bucket{_format_labels(labels, [('le', '+Inf')])} {histogram[-1]}")
+                lines.append(f"{name}_sum{_format_labels(labels)} {_format_number(histogram[-2])}")
+                lines.append(f"{name}_count{_format_labels(labels)} {histogram[-1]}")
+        return '\n'.join(lines) + '\n'
+
+
+class TextfileExporter(threading.Thread):
+    """Файл метрик для textfile collector (node_exporter, windows_exporter), переписывается каждые interval секунд.
+
+    Файл заменяется целиком (временный файл + os.replace), поэтому сборщик
+    не видит его наполовину записанным. После stop файл остаётся с итогом пакета.
+    """
+
+    def __init__(self, metrics, path, interval=TEXTFILE_INTERVAL):
+        super().__init__(name="metrics-textfile", daemon=True)
+        self.metrics = metrics
+        self.path = path
+        self.interval = interval
+        self._stopping = threading.Event()
+
+    def write(self):
+        directory, name = os.path.split(os.path.abspath(self.path))
+        temp_path = os.path.join(directory, f".{name}.tmp")
+        with open(temp_path, 'w', encoding='utf-8', newline='\n') as f:
+            f.write(self.metrics.render())
+        os.replace(temp_path, self.path)
+
+    def run(self):
+        while not self._stopping.wait(self.interval):
+            try:
+                self.write()
+            except OSError:
+                pass  # папка сборщика недоступна — следующая попытка через interval
+
+    def stop(self):
+        self._stopping.set()
+        self.join()
+        try:
+            self.write()
+        except OSError:
+            pass
+
+
+class HttpExporter:
+    """Метрики по HTTP: GET /metrics, по умолчанию только на локальном адресе."""
+
+    def __init__(self, metrics, port, host=DEFAULT_HOST):
+        self.metrics = metrics
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(handler):
+                if handler.path.split('?')[0] not in ('/', '/metrics'):
+                    handler.send_error(404)
+                    return
+                body = metrics.render().encode('utf-8')
+                handler.send_response(200)
+                handler.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                handler.send_header('Content-Length', str(len(body)))
+                handler.end_headers()
+                handler.wfile.write(body)
+
+            def log_message(handler, format, *args):
+                pass  # запросы сборщика не засоряют лог пакета
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self.address = f"http://{host}:{self.server.server_port}/metrics"
+        self._thread = threading.Thread(target=self.server.serve_forever, name="metrics-http", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self._thread.join()
+
+
+def start_exporter(metrics, target):
+    """Экспорт metrics: target — файл *.prom (textfile collector) или [АДРЕС:]ПОРТ для HTTP.
+
+    Возвращает (экспортёр с методом stop, описание для лога).
+    """
+    if target.lower().endswith('.prom'):
+        exporter = TextfileExporter(metrics, target)
+        exporter.write()  # недоступная папка — ошибка сразу, а не молча в потоке
+        exporter.start()
+        return exporter, os.path.abspath(target)
+    host, _, port = target.rpartition(':')
+    exporter = HttpExporter(metrics, int(port), host or DEFAULT_HOST)
+    return exporter, exporter.address
+
+
+def export_metrics(target, log):
+    """Новые метрики для BatchScheduler с экспортом в target: (Metrics, экспортёр или None).
+
+    Если экспорт не запустился (порт занят, папки нет), обработка идёт без него — причина пишется в log.
+    """
+    metrics = Metrics()
+    try:
+        exporter, address = start_exporter(metrics, target)
+    except (OSError, ValueError) as e:
+        log(f"Метрики не экспортируются ({target}): {str(e)}")
+        return metrics, None
+    log(f"Метрики: {address}")
+    return metrics, exporter
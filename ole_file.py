@@ -0,0 +1,159 @@
+import struct
+
+# Составной файл OLE (Compound File Binary, [MS-CFB]) — контейнер .xls и .doc
+OLE_SIGNATURE = b'\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1'
+
+_HEADER = struct.Struct('<8s16s6H10L')
+_DIRECTORY_ENTRY = struct.Struct('<64sH2B3L16sL2QLQ')
+_DIFAT_IN_HEADER = 109
+_MAX_SECTOR = 0xFFFFFFFA
+_STREAM = 2
+_ROOT = 5
+
+
+class OleError(Exception):
+    pass
+
+
+class OleStream:
+    """Поток составного файла: данные и размещение по секторам исходного файла.
+
+    extents — список (смещение в файле, длина) в порядке следования байтов
+    потока; по нему правки потока переносятся в копию файла на месте.
+    """
+
+    def __init__(self, name, data, extents):
+        self.name = name
+        self.data = data
+        self.extents = extents
+
+    def patch(self, buffer, position, data):
+        """Запись data в копию файла buffer (bytearray) по смещению position внутри потока."""
+        if position + len(data) > len(self.data):
+            raise OleError(f"Запись за пределы потока {self.name}")
+        start = 0
+        for file_offset, length in self.extents:
+            if position < start + length and data:
+                inner = position - start
+                count = min(length - inner, len(data))
+                buffer[file_offset + inner:file_offset + inner + count] = data[:count]
+                data = data[count:]
+                position += count
+            start += length
+            if not data:
+                break
+
+
+class OleFile:
+    """Чтение составного файла OLE без сторонних библиотек; только для правок на месте.
+
+    Поддерживаются версии 3 и 4 (сектор 512 и 4096 байт), цепочки FAT,
+    DIFAT и мини-поток для потоков меньше 4096 байт.
+    """
+
+    def __init__(self, data):
+        self.data = data
+        if len(data) < 512 or data[:8] != OLE_SIGNATURE:
+            raise OleError("Не составной файл OLE")
+        header = _HEADER.unpack_from(data)
+        (_, _, _, _, _, sector_shift, mini_shift, _,
+         _, _, fat_count, first_directory, _, self.mini_cutoff,
+         first_minifat, minifat_count, first_difat, difat_count) = header
+        self.sector_size = 1 << sector_shift
+        self.mini_size = 1 << mini_shift
+
+        difat = list(struct.unpack_from(f'<{_DIFAT_IN_HEADER}L', data, 76))
+        sector = first_difat
+        per_difat = self.sector_size // 4 - 1
+        for _ in range(difat_count):
+            if sector > _MAX_SECTOR:
+                break
+            values = struct.unpack(f'<{per_difat + 1}L', self._sector(sector))
+            difat.extend(values[:-1])
+            sector = values[-1]
+        self.fat = []
+        for sector in difat[:fat_count]:
+            self.fat.extend(struct.unpack(f'<{self.sector_size // 4}L', self._sector(sector)))
+
+        directory = self._read_chain(first_directory, self.fat, self.sector_size, self._offset)
+        self.entries = []
+        for start in range(0, len(directory) - _DIRECTORY_ENTRY.size + 1, _DIRECTORY_ENTRY.size):
+            fields = _DIRECTORY_ENTRY.unpack_from(directory, start)
+            name_length = fields[1]
+            name = fields[0][:max(0, name_length - 2)].decode('utf-16-le', 'replace')
+            size = fields[12] if self.sector_size == 4096 else fields[12] & 0xFFFFFFFF
+            self.entries.append((name, fields[2], fields[11], size))
+        if not self.entries or self.entries[0][1] != _ROOT:
+            raise OleError("Нет корневой записи каталога")
+
+        root_start, root_size = self.entries[0][2], self.entries[0][3]
+        self.minifat = []
+        if minifat_count and first_minifat <= _MAX_SECTOR:
+            raw = self._read_chain(first_minifat, self.fat, self.sector_size, self._offset)
+            self.minifat = list(struct.unpack_from(f'<{len(raw) // 4}L', raw))
+        self._mini_stream = self._chain_extents(root_start, root_size, self.fat, self.sector_size, self._offset)
+
+    def _offset(self, sector):
+        return (sector + 1) * self.sector_size
+
+    def _sector(self, sector):
+        offset = self._offset(sector)
+        if offset + self.sector_size > len(self.data):
+            raise OleError("Сектор за концом файла (файл обрезан)")
+        return self.data[offset:offset + self.sector_size]
+
+    def _mini_offset(self, sector):
+        # Мини-сектор лежит внутри мини-потока, который сам размещён в обычных секторах
+        position = sector * self.mini_size
+        start = 0
+        for file_offset, length in self._mini_stream:
+            if position < start + length:
+                return file_offset + position - start
+            start += length
+        raise OleError("Мини-сектор за пределами мини-потока")
+
+    def _chain(self, sector, table):
+        sectors = []
+        while sector <= _MAX_SECTOR:
+            if sector >= len(table) or len(sectors) > len(table):
+                raise OleError("Повреждённая цепочка секторов")
+            sectors.append(sector)
+            sector = table[sector]
+        return sectors
+
+    def _chain_extents(self, sector, size, table, sector_size, offset):
+        extents = []
+        remaining = size
+        for current in self._chain(sector, table):
+            if remaining <= 0:
+                break
+            length = min(sector_size, remaining)
+            file_offset = offset(current)
+            if file_offset + length > len(self.data):
+                raise OleError("Поток выходит за конец файла (файл обрезан)")
+            # Соседние сектора объединяются в один отрезок
+            if extents and extents[-1][0] + extents[-1][1] == file_offset:
+                extents[-1] = (extents[-1][0], extents[-1][1] + length)
+            else:
+                extents.append((file_offset, length))
+            remaining -= length
+        if remaining > 0:
+            raise OleError("Поток короче заявленного размера")
+        return extents
+
+    def _read_chain(self, sector, table, sector_size, offset):
+        return b''.join(self.data[offset(s):offset(s) + sector_size] for s in self._chain(sector, table))
+
+    def exists(self, name):
+        return any(entry[0] == name and entry[1] == _STREAM for entry in self.entries)
+
+    def open_stream(self, name):
+        for entry_name, entry_type, start, size in self.entries:
+            if entry_name == name and entry_type == _STREAM:
+                if size < self.mini_cutoff:
+                    extents = self._chain_extents(start, size, self.minifat, self.mini_size, self._mini_offset)
+                else:
+                    extents = self._chain_extents(start, size, self.fat, self.sector_size, self._offset)
+                data = b''.join(self.data[offset:offset + length] for offset, length in extents)
+                return OleStream(name, data, extents)
+        raise OleError(f"Поток {name} не найден")
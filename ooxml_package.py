@@ -0,0 +1,193 @@
+import os
+import struct
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from zipfile import ZipFile, ZipInfo, ZIP_STORED, ZIP_DEFLATED
+from io_pipeline import kernel_copy
+
+# Структуры заголовков ZIP (APPNOTE.TXT), как в модуле zipfile
+_LOCAL_HEADER = struct.Struct('<4s2B4HL2L2H')
+_CENTRAL_HEADER = struct.Struct('<4s4B4HL2L5H2L')
+_END_RECORD = struct.Struct('<4s4H2LH')
+_LOCAL_SIGNATURE = b'PK\x03\x04'
+_CENTRAL_SIGNATURE = b'PK\x01\x02'
+_END_SIGNATURE = b'PK\x05\x06'
+
+_ZIP64_LIMIT = 0xFFFFFFFF
+_ZIP_MAX_ENTRIES = 0xFFFF
+_FLAG_UTF8 = 0x800
+_FLAG_DEFLATE_OPTIONS = 0x06
+
+_executor = None
+
+
+def _get_executor():
+    # zlib отпускает GIL, поэтому потоков достаточно для параллельного (рас)жатия
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=min(8, os.cpu_count() or 1))
+    return _executor
+
+
+def _compress(data, compress_type):
+    if compress_type == ZIP_STORED:
+        return data
+    compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+    return compressor.compress(data) + compressor.flush()
+
+
+def _dos_datetime(date_time):
+    year, month, day, hour, minute, second = date_time
+    return (hour << 11 | minute << 5 | second // 2,
+            (year - 1980) << 9 | month << 5 | day)
+
+
+class Package:
+    """Пакет OOXML (docx/xlsx/xlsm) для чтения частей и записи копии с заменёнными частями.
+
+    Неизменённые члены архива переносятся в выходной файл как есть, в сжатом
+    виде и тем же методом сжатия. Изменённые сжимаются исходным методом
+    (stored или deflate) параллельно в пуле потоков.
+
+    source — путь к файлу или bytes (вложенный пакет, обрабатываемый в памяти).
+    """
+
+    def __init__(self, source):
+        self.path = source if isinstance(source, str) else None
+        self.data = None if self.path else bytes(source)
+        self.zip = ZipFile(self.path or BytesIO(self.data))
+        self.infos = self.zip.infolist()
+        self._by_name = {info.filename: info for info in self.infos}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def __contains__(self, name):
+        return name in self._by_name
+
+    def close(self):
+        self.zip.close()
+
+    def namelist(self):
+        return [info.filename for info in self.infos]
+
+    def read_parts(self, names):
+        """Параллельное чтение (распаковка) частей: {имя: bytes}; отсутствующие пропускаются."""
+        names = [name for name in names if name in self._by_name]
+        return dict(zip(names, _get_executor().map(self.zip.read, names)))
+
+    def _open_source(self):
+        return open(self.path, 'rb') if self.path else BytesIO(self.data)
+
+    def _source_size(self):
+        return os.path.getsize(self.path) if self.path else len(self.data)
+
+    def to_bytes(self, replaced):
+        """Пакет с заменёнными частями в виде bytes (для записи обратно в родительский пакет)."""
+        out = BytesIO()
+        self.write(out, replaced)
+        return out.getvalue()
+
+    def copy(self, output):
+        """Копия исходного пакета без изменений; возвращает способ копирования для лога."""
+        if self.path and isinstance(output, str):
+            return kernel_copy(self.path, output)
+        data = self.data
+        if data is None:
+            with open(self.path, 'rb') as src:
+                data = src.read()
+        if isinstance(output, str):
+            with open(output, 'wb') as out:
+                out.write(data)
+        else:
+            output.write(data)
+        return 'write'
+
+    def write(self, output, replaced):
+        """Запись пакета в output (путь или файловый объект); replaced — {имя части: новые bytes}."""
+        sizes_ok = (len(self.infos) < _ZIP_MAX_ENTRIES
+                    and self._source_size() < _ZIP64_LIMIT
+                    and all(len(data) < _ZIP64_LIMIT for data in replaced.values()))
+        if sizes_ok:
+            if isinstance(output, str):
+                with open(output, 'wb') as out:
+                    written = self._write_raw(out, replaced)
+            else:
+                written = self._write_raw(output, replaced)
+            if written:
+                return
+        # Архив выходит за пределы ZIP без расширения ZIP64 — пишем стандартным способом
+        if not isinstance(output, str):
+            output.seek(0)
+            output.truncate()
+        self._write_zipfile(output, replaced)
+
+    def _write_raw(self, out, replaced):
+        """Запись с переносом сжатых данных без перепаковки; False — если нужен ZIP64."""
+        executor = _get_executor()
+        compressed = {name: executor.submit(_compress, data, self._method(name))
+                      for name, data in replaced.items()}
+
+        central = []
+        base = out.tell()
+        with self._open_source() as src:
+            for info in self.infos:
+                offset = out.tell() - base
+                if info.filename in replaced:
+                    data = replaced[info.filename]
+                    method = self._method(info.filename)
+                    payload = compressed[info.filename].result()
+                    crc, file_size, flags = zlib.crc32(data), len(data), 0
+                else:
+                    method = info.compress_type
+                    payload = self._read_raw(src, info)
+                    crc, file_size = info.CRC, info.file_size
+                    flags = info.flag_bits & _FLAG_DEFLATE_OPTIONS
+                if offset + len(payload) >= _ZIP64_LIMIT:
+                    return False
+                name = info.filename.encode('utf-8')
+                if not info.filename.isascii():
+                    flags |= _FLAG_UTF8
+                dos_time, dos_date = _dos_datetime(info.date_time)
+                out.write(_LOCAL_HEADER.pack(
+                    _LOCAL_SIGNATURE, 20, 0, flags, method, dos_time, dos_date,
+                    crc, len(payload), file_size, len(name), 0))
+                out.write(name)
+                out.write(payload)
+                central.append(_CENTRAL_HEADER.pack(
+                    _CENTRAL_SIGNATURE, 20, info.create_system, 20, 0, flags, method,
+                    dos_time, dos_date, crc, len(payload), file_size, len(name), 0, 0, 0,
+                    info.internal_attr, info.external_attr, offset) + name)
+        directory_offset = out.tell() - base
+        directory = b''.join(central)
+        if directory_offset + len(directory) >= _ZIP64_LIMIT:
+            return False
+        out.write(directory)
+        out.write(_END_RECORD.pack(_END_SIGNATURE, 0, 0, len(central), len(central),
+                                   len(directory), directory_offset, 0))
+        return True
+
+    def _method(self, name):
+        method = self._by_name[name].compress_type
+        return method if method in (ZIP_STORED, ZIP_DEFLATED) else ZIP_DEFLATED
+
+    def _read_raw(self, src, info):
+        """Сжатые байты члена архива без распаковки."""
+        src.seek(info.header_offset)
+        header = _LOCAL_HEADER.unpack(src.read(_LOCAL_HEADER.size))
+        src.seek(header[10] + header[11], os.SEEK_CUR)
+        return src.read(info.compress_size)
+
+    def _write_zipfile(self, output, replaced):
+        with ZipFile(output, 'w', allowZip64=True) as zip_out:
+            for info in self.infos:
+                data = replaced.get(info.filename)
+                if data is None:
+                    data = self.zip.read(info.filename)
+                new_info = ZipInfo(info.filename, info.date_time)
+                new_info.external_attr = info.external_attr
+                zip_out.writestr(new_info, data, compress_type=self._method(info.filename))
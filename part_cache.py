@@ -0,0 +1,141 @@
+import hashlib
+import os
+import tempfile
+
+# Меняется вместе с логикой обработки частей, которую не видно по правилам
+CACHE_VERSION = 2
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+
+_UNCHANGED = b'0'
+_CHANGED = b'1'
+_TEMP_PREFIX = '.tmp'
+
+_caches = {}
+
+
+def default_cache_path():
+    base = os.environ.get('LOCALAPPDATA') or os.path.expanduser('~')
+    return os.path.join(base, 'wesa_parser', 'part_cache')
+
+
+def content_hash(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def rules_key(owner, patterns):
+    """Отпечаток набора правил: класс обработчика, шаблоны и замены.
+
+    Для функций замены учитывается их байт-код и константы, поэтому
+    правка правила в коде сама делает старые записи кэша недоступными.
+    """
+    digest = hashlib.sha256(f"{CACHE_VERSION}:{owner}".encode('utf-8'))
+    for pattern, repl in patterns:
+        digest.update(f"\0{pattern.pattern}\0{pattern.flags}\0".encode('utf-8'))
+        if callable(repl):
+            code = repl.__code__
+            digest.update(code.co_code + repr(code.co_consts).encode('utf-8'))
+        else:
+            digest.update(repr(repl).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def open_cache(path=None, max_bytes=DEFAULT_MAX_BYTES):
+    """Кэш частей для каталога path; в одном процессе — один объект на каталог."""
+    path = path or default_cache_path()
+    if path not in _caches:
+        _caches[path] = PartCache(path, max_bytes)
+    return _caches[path]
+
+
+class PartCache:
+    """Кэш результатов обработки XML-частей по содержимому, общий для процессов пула.
+
+    Ключ — (хеш части, отпечаток правил, цифра), значение — признак изменения
+    и новые байты части. Каждая запись — отдельный файл в каталоге path,
+    записывается через временный файл и os.replace, поэтому процессы не мешают
+    друг другу. Когда записей становится больше max_bytes, удаляются давно
+    не использованные (по времени изменения файла, которое обновляется при чтении).
+    """
+
+    def __init__(self, path, max_bytes=DEFAULT_MAX_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._written = 0
+
+    def _entry_path(self, digest, rules, digit):
+        key = hashlib.sha256(f"{digest}:{rules}:{digit}".encode('utf-8')).hexdigest()
+        return os.path.join(self.path, key[:2], key)
+
+    def get(self, digest, rules, digit):
+        """(были ли изменения, новые байты или None) или None, если записи нет."""
+        entry_path = self._entry_path(digest, rules, digit)
+        try:
+            with open(entry_path, 'rb') as f:
+                raw = f.read()
+            os.utime(entry_path)
+        except OSError:
+            self.misses += 1
+            return None
+        if raw[:1] == _UNCHANGED:
+            self.hits += 1
+            return False, None
+        if raw[:1] == _CHANGED:
+            self.hits += 1
+            return True, raw[1:]
+        self.misses += 1
+        return None
+
+    def put(self, digest, rules, digit, data):
+        """Запись результата: data — новые байты части или None, если часть не изменилась."""
+        entry_path = self._entry_path(digest, rules, digit)
+        raw = _UNCHANGED if data is None else _CHANGED + data
+        temp_path = None
+        try:
+            os.makedirs(os.path.dirname(entry_path), exist_ok=True)
+            fd, temp_path = tempfile.mkstemp(prefix=_TEMP_PREFIX, dir=os.path.dirname(entry_path))
+            with os.fdopen(fd, 'wb') as f:
+                f.write(raw)
+            os.replace(temp_path, entry_path)
+        except OSError:
+            # Кэш необязателен: часть просто обработается заново
+            if temp_path is not None and os.path.exists(temp_path):
+                try:
+                    os.remove(temp_path)
+                except OSError:
+                    pass
+            return
+        self._written += len(raw)
+        if self._written >= self.max_bytes // 16:
+            self._written = 0
+            self.evict()
+
+    def evict(self):
+        """Удаление давно не использованных записей, пока кэш больше max_bytes (с запасом 20%)."""
+        entries = []
+        total = 0
+        for root, _, files in os.walk(self.path):
+            for name in files:
+                if name.startswith(_TEMP_PREFIX):
+                    continue
+                entry_path = os.path.join(root, name)
+                try:
+                    stat = os.stat(entry_path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry_path))
+                total += stat.st_size
+        if total <= self.max_bytes:
+            return
+        entries.sort()
+        limit = self.max_bytes * 0.8
+        for _, size, entry_path in entries:
+            if total <= limit:
+                break
+            try:
+                os.remove(entry_path)
+            except OSError:
+                continue
+            total -= size
+
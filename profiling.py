@@ -0,0 +1,185 @@
+import cProfile
+import os
+import pstats
+import shutil
+import tempfile
+import threading
+import time
+import tracemalloc
+import zlib
+
+ALL = 'all'
+TRACE_FRAMES = 1  # отчёт группирует выделения по строке, более глубокий стек только замедляет
+TOP_FUNCTIONS = 40
+TOP_ALLOCATIONS = 30
+# Снимок памяти делается, когда она выросла в полтора раза с прошлого снимка (проверка каждые 50 мс)
+PEAK_GROWTH = 1.5
+PEAK_INTERVAL = 0.05
+
+
+class ProfileSettings:
+    """Какие файлы профилировать: все, выборку или превысившие порог времени/памяти.
+
+    Задаётся строкой через запятую: 'all', 'sample=0.05' (доля файлов, выбор
+    по имени файла, одинаковый от запуска к запуску), 'slow=30' (секунды
+    обработки), 'rss=1024' (МБ памяти процесса после обработки). Файл,
+    превысивший порог, узнаётся только после обработки: он обрабатывается
+    ещё раз под профилировщиком во временную папку, результаты не трогаются.
+    Объект передаётся в процессы пула и COM-процессы.
+    """
+
+    def __init__(self, everything=False, sample=0.0, seconds=None, rss_mb=None):
+        self.everything = everything
+        self.sample = sample
+        self.seconds = seconds
+        self.rss_mb = rss_mb
+
+    @classmethod
+    def parse(cls, text):
+        settings = cls()
+        for item in filter(None, (part.strip() for part in text.split(','))):
+            name, _, value = item.partition('=')
+            if name == ALL and not value:
+                settings.everything = True
+            elif name == 'sample' and value:
+                settings.sample = float(value)
+            elif name == 'slow' and value:
+                settings.seconds = float(value)
+            elif name == 'rss' and value:
+                settings.rss_mb = float(value)
+            else:
+                raise ValueError(f"неизвестный режим профилирования: {item}")
+        return settings
+
+    def selects(self, filename):
+        """Профилировать ли файл сразу, не дожидаясь порогов."""
+        if self.everything:
+            return True
+        return self.sample > 0 and zlib.crc32(filename.lower().encode('utf-8')) % 10000 < self.sample * 10000
+
+    def exceeds(self, seconds, rss):
+        """Превышен ли порог: seconds — время обработки, rss — память процесса в байтах или None."""
+        if self.seconds is not None and seconds >= self.seconds:
+            return True
+        return self.rss_mb is not None and rss is not None and rss >= self.rss_mb * 1024 * 1024
+
+    @property
+    def has_thresholds(self):
+        return self.seconds is not None or self.rss_mb is not None
+
+
+def report_dir(outputs):
+    """Папка отчётов задания — рядом с первым результатом."""
+    return os.path.dirname(outputs[min(outputs)])
+
+
+class _PeakSampler(threading.Thread):
+    """Снимок tracemalloc около пика памяти: к концу обработки почти всё уже освобождено."""
+
+    def __init__(self):
+        super().__init__(name="profile-peak", daemon=True)
+        self.snapshot = None
+        self.size = 0
+        self._stopping = threading.Event()
+
+    def run(self):
+        while not self._stopping.wait(PEAK_INTERVAL):
+            current = tracemalloc.get_traced_memory()[0]
+            if current > self.size * PEAK_GROWTH:
+                self.size = current
+                self.snapshot = tracemalloc.take_snapshot()
+
+    def stop(self):
+        self._stopping.set()
+        self.join()
+
+
+def profiled(directory, filename, stage, func, *args):
+    """func(*args) под cProfile и tracemalloc; отчёты {файл}.{этап}.prof и .alloc.txt в directory.
+
+    Возвращает (результат func, пути отчётов). Отчёты, которые не удалось
+    записать, пропускаются.
+    """
+    tracing = tracemalloc.is_tracing()
+    if not tracing:
+        tracemalloc.start(TRACE_FRAMES)
+    sampler = _PeakSampler()
+    sampler.start()
+    profile = cProfile.Profile()
+    started = time.perf_counter()
+    profile.enable()
+    try:
+        result = func(*args)
+    finally:
+        profile.disable()
+        sampler.stop()
+        # Отчёт пишется и при ошибке обработки: он как раз нужен для разбора
+        paths = _write_reports(directory, filename, stage, profile, time.perf_counter() - started, sampler)
+        if not tracing:
+            tracemalloc.stop()
+    return result, paths
+
+
+def _write_reports(directory, filename, stage, profile, seconds, sampler):
+    current, peak = tracemalloc.get_traced_memory()
+    if sampler.snapshot is None or sampler.size < current:
+        sampler.snapshot, sampler.size = tracemalloc.take_snapshot(), current
+    # Фильтр по уже сгруппированным строкам: Snapshot.filter_traces перебирает каждое выделение
+    skipped = (tracemalloc.__file__, cProfile.__file__, __file__)
+    allocations = [stat for stat in sampler.snapshot.statistics('lineno')
+                   if stat.traceback[0].filename not in skipped][:TOP_ALLOCATIONS]
+    base = os.path.join(directory, f"{filename}.{stage}")
+    paths = []
+    try:
+        profile.dump_stats(base + '.prof')
+        paths.append(base + '.prof')
+        with open(base + '.alloc.txt', 'w', encoding='utf-8') as f:
+            f.write(f"{filename} ({stage}): {seconds:.2f} с, память Python: сейчас {current / 2**20:.1f} МБ, "
+                    f"пик {peak / 2**20:.1f} МБ\n\n")
+            f.write(f"Крупнейшие выделения памяти (по строкам) в момент {sampler.size / 2**20:.1f} МБ:\n")
+            for stat in allocations:
+                f.write(f"{stat}\n")
+            f.write("\nФункции по собственному времени:\n")
+            stats = pstats.Stats(profile, stream=f)
+            stats.sort_stats('tottime').print_stats(TOP_FUNCTIONS)
+        paths.append(base + '.alloc.txt')
+    except OSError:
+        pass
+    return paths
+
+
+def run_stage(settings, directory, filename, stage, run, rerun, rss=None, log=None, before_rerun=None):
+    """Этап обработки файла с профилированием по settings; возвращает результат run().
+
+    run() — обычная обработка. rerun(папка) — та же обработка с результатами
+    во временную папку: вызывается под профилировщиком, если файл превысил порог
+    (перед этим вызывается before_rerun). rss() — память процесса в байтах или None.
+    """
+    log = log or (lambda message: None)
+    if settings.selects(filename):
+        result, paths = profiled(directory, filename, stage, run)
+        if paths:
+            log(f"Профиль {filename} ({stage}): {', '.join(paths)}")
+        return result
+    if not settings.has_thresholds:
+        return run()
+
+    started = time.perf_counter()
+    result = run()
+    seconds = time.perf_counter() - started
+    usage = rss() if rss and settings.rss_mb is not None else None
+    if settings.exceeds(seconds, usage):
+        if before_rerun:
+            before_rerun()
+        scratch = tempfile.mkdtemp(prefix='wesa_profile_')
+        try:
+            _, paths = profiled(directory, filename, stage, rerun, scratch)
+        except Exception as e:
+            log(f"Профиль {filename} ({stage}) не снят: {str(e)}")
+            paths = []
+        finally:
+            shutil.rmtree(scratch, ignore_errors=True)
+        if paths:
+            memory = f", {usage / 2**20:.0f} МБ" if usage else ""
+            log(f"Профиль {filename} ({stage}, {seconds:.1f} с{memory}, повторная обработка): {', '.join(paths)}")
+    return result
@@ -0,0 +1,88 @@
+import random
+import threading
+import time
+
+# Фактические ожидания по видам: {имя: [число ожиданий, секунды]}
+_waits = {}
+_waits_lock = threading.Lock()
+
+
+def record_wait(name, seconds):
+    with _waits_lock:
+        entry = _waits.setdefault(name, [0, 0.0])
+        entry[0] += 1
+        entry[1] += seconds
+
+
+def take_waits():
+    """Накопленные ожидания с обнулением (для передачи из дочернего процесса)."""
+    global _waits
+    with _waits_lock:
+        waits, _waits = _waits, {}
+    return waits
+
+
+def merge_waits(total, waits):
+    for name, (count, seconds) in waits.items():
+        entry = total.setdefault(name, [0, 0.0])
+        entry[0] += count
+        entry[1] += seconds
+    return total
+
+
+def format_waits(waits):
+    return ", ".join(f"{name}: {count} раз, {seconds:.1f} с"
+                     for name, (count, seconds) in sorted(waits.items()))
+
+
+class Backoff:
+    """Экспоненциальная задержка с джиттером в пределах общего бюджета времени.
+
+    Каждая задержка initial * factor**n (не больше maximum) уменьшается
+    на случайную долю до jitter и не выходит за остаток бюджета. Бюджет
+    отсчитывается от первой паузы, так что объект можно создать заранее,
+    до цикла повторов. Все паузы учитываются в record_wait под именем name.
+    """
+
+    def __init__(self, name, initial=0.05, factor=2.0, maximum=2.0, budget=20.0, jitter=0.5):
+        self.name = name
+        self.initial = initial
+        self.factor = factor
+        self.maximum = maximum
+        self.budget = budget
+        self.jitter = jitter
+        self.attempt = 0
+        self.started = None
+
+    def remaining(self):
+        if self.started is None:
+            return self.budget
+        return self.budget - (time.monotonic() - self.started)
+
+    def expired(self):
+        return self.remaining() <= 0
+
+    def sleep(self):
+        """Пауза перед следующей попыткой; False — бюджет исчерпан и ждать больше нельзя."""
+        if self.started is None:
+            self.started = time.monotonic()
+        remaining = self.remaining()
+        if remaining <= 0:
+            return False
+        delay = min(self.maximum, self.initial * self.factor ** self.attempt)
+        delay = min(remaining, delay * (1 - self.jitter * random.random()))
+        self.attempt += 1
+        time.sleep(delay)
+        record_wait(self.name, delay)
+        return True
+
+
+def wait_until(check, name, budget=20.0, initial=0.05, maximum=1.0):
+    """Повторять check() с нарастающими паузами, пока не вернёт истину или не кончится бюджет."""
+    backoff = Backoff(name, initial=initial, maximum=maximum, budget=budget)
+    backoff.started = time.monotonic()
+    while True:
+        if check():
+            return True
+        if not backoff.sleep():
+            return False
@@ -0,0 +1,317 @@
+import re
+import threading
+import time
+from bisect import bisect_right
+from itertools import accumulate, compress, count
+from operator import ne
+
+# Флаги, которые можно перенести внутрь объединённого выражения как (?i:...)
+_INLINE_FLAGS = (
+    (re.IGNORECASE, 'i'),
+    (re.MULTILINE, 'm'),
+    (re.DOTALL, 's'),
+    (re.VERBOSE, 'x'),
+    (re.ASCII, 'a'),
+)
+
+
+# Разделитель текстов в общем буфере: U+0000 недопустим в XML 1.0, поэтому в тексте узлов
+# его не бывает, а для правил это не буква и не пробел — \b на нём срабатывает как на границе строки
+SEPARATOR = '\x00'
+# Якоря начала и конца строки в буфере значили бы другое — такие правила обрабатываются по одному тексту
+_ANCHORS = re.compile(r'(?<!\\)[$^]|\\[AZ]')
+
+
+# Время правил объединённого выражения делится между ними по отдельному прогону каждого
+# правила на образце из первых просмотренных текстов такой длины
+RULE_SAMPLE_CHARS = 16384
+# Шаблоны длиннее этого в отчёте по правилам обрезаются
+REPORT_PATTERN_CHARS = 60
+
+_rule_stats = {}  # (формат, шаблон) -> [попытки, совпадения, замены, секунды]
+_rule_stats_lock = threading.Lock()
+
+
+def record_rules(owner, patterns, attempts, matches, replacements, seconds):
+    """Учёт прохода правил формата owner по attempts текстам; matches, replacements, seconds — по правилам.
+
+    owner — имя обработчика (формат файла), None — без учёта. Замены считаются
+    только те, что действительно меняют текст.
+    """
+    if owner is None:
+        return
+    with _rule_stats_lock:
+        for (pattern, _), found, changed, spent in zip(patterns, matches, replacements, seconds):
+            total = _rule_stats.setdefault((owner, pattern.pattern), [0, 0, 0, 0.0])
+            total[0] += attempts
+            total[1] += found
+            total[2] += changed
+            total[3] += spent
+
+
+def take_rule_stats():
+    """Статистика правил процесса с последнего вызова (для передачи из дочернего процесса)."""
+    global _rule_stats
+    with _rule_stats_lock:
+        stats, _rule_stats = _rule_stats, {}
+    return stats
+
+
+def merge_rule_stats(total, stats):
+    for key, values in stats.items():
+        current = total.setdefault(key, [0, 0, 0, 0.0])
+        for index, value in enumerate(values):
+            current[index] += value
+
+
+def format_rule_stats(stats):
+    """Строки отчёта: итог по каждому формату, затем его правила от самого долгого."""
+    formats = {}
+    for (owner, source), values in stats.items():
+        formats.setdefault(owner, []).append((source, values))
+    lines = []
+    for owner in sorted(formats):
+        rules = sorted(formats[owner], key=lambda item: -item[1][3])
+        dead = sum(1 for _, values in rules if not values[1])
+        lines.append(f"Правила {owner}: {len(rules)}, без совпадений {dead}, "
+                     f"время {sum(values[3] for _, values in rules):.3f} с")
+        for source, (attempts, matches, replacements, seconds) in rules:
+            if len(source) > REPORT_PATTERN_CHARS:
+                source = source[:REPORT_PATTERN_CHARS] + '…'
+            lines.append(f"  {seconds * 1000:.1f} мс, текстов {attempts}, совпадений {matches}, "
+                         f"замен {replacements}: {source}")
+    return lines
+
+
+def _sub_counted(pattern, repl, text):
+    """pattern.subn с подсчётом замен, которые меняют текст: (текст, совпадения, замены)."""
+    changed = 0
+
+    def replace(m):
+        nonlocal changed
+        result = repl(m) if callable(repl) else m.expand(repl)
+        if result != m.group(0):
+            changed += 1
+        return result
+
+    text, found = pattern.subn(replace, text)
+    return text, found, changed
+
+
+def _sub_each(patterns, text, matches, replacements, seconds):
+    # Правила по очереди, счётчики и время добавляются в списки по правилам
+    for index, (pattern, repl) in enumerate(patterns):
+        started = time.perf_counter()
+        text, found, changed = _sub_counted(pattern, repl, text)
+        seconds[index] += time.perf_counter() - started
+        matches[index] += found
+        replacements[index] += changed
+    return text
+
+
+def sub_sequential(patterns, text, owner=None):
+    """Последовательные pattern.sub по одному тексту с учётом в статистике правил owner."""
+    if not text:
+        return text
+    matches, replacements, seconds = [0] * len(patterns), [0] * len(patterns), [0.0] * len(patterns)
+    text = _sub_each(patterns, text, matches, replacements, seconds)
+    record_rules(owner, patterns, 1, matches, replacements, seconds)
+    return text
+
+
+def _starts(texts):
+    """Начало каждого текста в буфере SEPARATOR.join(texts)."""
+    return [0] + list(accumulate(len(text) + 1 for text in texts[:-1]))
+
+
+def changed_indices(texts, new_texts):
+    """Индексы текстов, которые отличаются от исходных."""
+    return list(compress(count(), map(ne, texts, new_texts)))
+
+
+def sub_sequential_batch(patterns, texts, owner=None):
+    """Последовательные pattern.sub по всем текстам сразу: один вызов каждого правила на общий буфер.
+
+    Возвращает список новых текстов или None, если ничего не изменилось. Если
+    совпадение захватило разделитель (правило видит соседние тексты), тексты
+    обрабатываются по одному, как раньше. owner — формат для статистики правил.
+    """
+    if not texts:
+        return None
+    buffer = original = SEPARATOR.join(texts)
+    crossed = False
+    matches, replacements, seconds = [0] * len(patterns), [0] * len(patterns), [0.0] * len(patterns)
+
+    def guarded(repl):
+        def replace(m):
+            nonlocal crossed
+            if SEPARATOR in m.group(0):
+                crossed = True
+            return repl(m) if callable(repl) else m.expand(repl)
+        return replace
+
+    if not any(_ANCHORS.search(pattern.pattern) for pattern, _ in patterns):
+        buffer = _sub_each([(pattern, guarded(repl)) for pattern, repl in patterns], buffer,
+                           matches, replacements, seconds)
+        if buffer == original:
+            record_rules(owner, patterns, len(texts), matches, replacements, seconds)
+            return None
+        new_texts = buffer.split(SEPARATOR)
+        if not crossed and len(new_texts) == len(texts):
+            record_rules(owner, patterns, len(texts), matches, replacements, seconds)
+            return new_texts
+        # Совпадения пересчитываются по отдельным текстам, время общего прохода остаётся
+        matches, replacements = [0] * len(patterns), [0] * len(patterns)
+
+    new_texts = [_sub_each(patterns, text, matches, replacements, seconds) for text in texts]
+    record_rules(owner, patterns, len(texts), matches, replacements, seconds)
+    return new_texts if new_texts != texts else None
+
+
+def apply_edits(text, edits):
+    """Применение списка правок (start, end, replacement), отсортированного по start."""
+    parts = []
+    cursor = 0
+    for start, end, replacement in edits:
+        parts.append(text[cursor:start])
+        parts.append(replacement)
+        cursor = end
+    parts.append(text[cursor:])
+    return ''.join(parts)
+
+
+class RuleSet:
+    """Набор правил замены (pattern, repl), объединённый в одно регулярное выражение.
+
+    Текст просматривается один раз слева направо, срабатывания не перекрываются:
+    берётся самое левое совпадение любого правила, а если в одной позиции
+    срабатывает несколько правил — то, что стоит раньше в списке patterns.
+    Это совпадает с последовательными pattern.sub, только пока совпадения
+    разных правил не могут перекрываться: иначе более раннее по тексту
+    совпадение поглощает текст, который правило выше по списку заменило бы
+    первым. Такие наборы (правила ExcelProcessor) применяются через sub_sequential.
+    owner — формат для статистики правил (None — без учёта).
+    """
+
+    def __init__(self, patterns, owner=None):
+        self.patterns = list(patterns)
+        self.owner = owner
+        # Образец текста для долей времени правил и доли по нему (см. _record)
+        self._sample = ''
+        self._weights = None
+        self._weighed_chars = 0
+        # Строковая замена без обратных ссылок подставляется как есть, без повторного match
+        self._literal = [isinstance(repl, str) and '\\' not in repl for _, repl in self.patterns]
+        self._fused = self._compile_fused() if self.patterns else None
+        self._batchable = not any(_ANCHORS.search(pattern.pattern) for pattern, _ in self.patterns)
+
+    def _compile_fused(self):
+        alternatives = []
+        for index, (pattern, _) in enumerate(self.patterns):
+            flags = ''.join(char for flag, char in _INLINE_FLAGS if pattern.flags & flag)
+            alternatives.append(f"(?P<r{index}>(?{flags}:{pattern.pattern}))" if flags
+                                else f"(?P<r{index}>{pattern.pattern})")
+        return re.compile('|'.join(alternatives))
+
+    def finditer(self, text):
+        """Все срабатывания правил: (start, end, replacement, индекс правила)."""
+        if self._fused is None or not text:
+            return
+        for m in self._fused.finditer(text):
+            index = int(m.lastgroup[1:])
+            pattern, repl = self.patterns[index]
+            if self._literal[index]:
+                replacement = repl
+            else:
+                # Группы правила нумеруются по его собственному шаблону
+                match = pattern.match(text, m.start())
+                replacement = repl(match) if callable(repl) else match.expand(repl)
+            yield m.start(), m.end(), replacement, index
+
+    def find_edits(self, text):
+        """Правки (start, end, replacement), которые действительно меняют текст."""
+        started = time.perf_counter()
+        matches, replacements = [0] * len(self.patterns), [0] * len(self.patterns)
+        edits = []
+        for start, end, replacement, rule in self.finditer(text):
+            matches[rule] += 1
+            if replacement != text[start:end]:
+                replacements[rule] += 1
+                edits.append((start, end, replacement))
+        self._record(text, 1, matches, replacements, time.perf_counter() - started)
+        return edits
+
+    def find_edits_batch(self, texts):
+        """Правки для списка текстов за один проход по общему буферу: {индекс текста: правки}.
+
+        Тексты склеиваются через SEPARATOR, смещения правок пересчитываются
+        к началу своего текста. Если совпадение пересекает разделитель,
+        тексты просматриваются по одному.
+        """
+        if self._fused is None or not texts:
+            return {}
+        if self._batchable:
+            started = time.perf_counter()
+            buffer = SEPARATOR.join(texts)
+            starts = _starts(texts)
+            matches, replacements = [0] * len(self.patterns), [0] * len(self.patterns)
+            edits = {}
+            for start, end, replacement, rule in self.finditer(buffer):
+                index = bisect_right(starts, start) - 1
+                offset = starts[index]
+                if end - offset > len(texts[index]):
+                    break
+                matches[rule] += 1
+                if replacement != buffer[start:end]:
+                    replacements[rule] += 1
+                    edits.setdefault(index, []).append((start - offset, end - offset, replacement))
+            else:
+                self._record(buffer, len(texts), matches, replacements, time.perf_counter() - started)
+                return edits
+        edits = {}
+        for index, text in enumerate(texts):
+            found = self.find_edits(text)
+            if found:
+                edits[index] = found
+        return edits
+
+    def _record(self, text, attempts, matches, replacements, seconds):
+        """Учёт прохода по text: время общего выражения делится между правилами.
+
+        Доля правила — его отдельный прогон по образцу из первых RULE_SAMPLE_CHARS
+        символов просмотренных текстов: так видно правила, которые дорого ищут,
+        но не срабатывают. Доли пересчитываются, только когда образец вырос
+        вдвое, поэтому за жизнь набора правил их замер стоит не больше
+        пары прогонов по RULE_SAMPLE_CHARS символам.
+        """
+        if self.owner is None:
+            return
+        if len(self._sample) < RULE_SAMPLE_CHARS:
+            text = text[:RULE_SAMPLE_CHARS]
+            self._sample = (f"{self._sample}{SEPARATOR}{text}" if self._sample else text)[:RULE_SAMPLE_CHARS]
+        grown = len(self._sample) >= min(2 * self._weighed_chars, RULE_SAMPLE_CHARS)
+        if self._weights is None or (grown and len(self._sample) > self._weighed_chars):
+            self._weights = self._measure_weights(self._sample)
+            self._weighed_chars = len(self._sample)
+        total = sum(self._weights)
+        record_rules(self.owner, self.patterns, attempts, matches, replacements,
+                     [seconds * weight / total for weight in self._weights])
+
+    def _measure_weights(self, sample):
+        weights = []
+        for pattern, _ in self.patterns:
+            started = time.perf_counter()
+            for _ in pattern.finditer(sample):
+                pass
+            weights.append(time.perf_counter() - started)
+        if not sum(weights):
+            weights = [1.0] * len(weights)  # прогон быстрее разрешения таймера — поровну
+        return weights
+
+    def sub(self, text):
+        if not text:
+            return text
+        edits = self.find_edits(text)
+        if not edits:
+            return text
+        return apply_edits(text, edits)
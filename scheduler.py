@@ -0,0 +1,497 @@
+import os
+import queue
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from shutil import rmtree
+from tempfile import mkdtemp
+from backends import BACKENDS, CONVERSIONS, CONVERTED, XML_BACKENDS, load
+from com_host import ComHost, JOB_TIMEOUTS
+from corpus_index import index_file
+from cost_model import CostModel, makespan
+from host_process import process_usage
+from io_pipeline import StagingArea
+from metrics import Metrics
+from part_cache import open_cache
+from profiling import report_dir, run_stage
+from retry import format_waits, merge_waits
+from rules import format_rule_stats, merge_rule_stats, take_rule_stats
+
+
+class Job:
+    def __init__(self, input_path, outputs, backend):
+        self.input_path = input_path
+        self.outputs = outputs  # {цифра блока: путь результата}
+        self.backend = backend
+        self.filename = os.path.basename(input_path)
+        self.temp_dir = None  # для конвертации .xls/.doc: папка с промежуточным .xlsm/.docx
+        # Что читают и куда пишут обработчики: при локальной подготовке — копии в рабочей папке
+        self.source_path = input_path
+        self.targets = outputs
+        self.size = 0
+        self.stage_dir = None
+        self.stage_queue = None  # бэкенд, по окну которого задание прочитано при подготовке
+        # Оценка и фактическое время обработки (секунды); бэкенд оценки не меняется при конвертации
+        self.cost_backend = backend
+        self.predicted = 0.0
+        self.elapsed = 0.0
+        # Время этапов для метрик: принято планировщиком (time.monotonic), чтение и запись при подготовке
+        self.submitted = None
+        self.fetch_seconds = 0.0
+        self.write_seconds = 0.0
+        self.rule_stats = {}  # статистика правил замены по этому файлу (rules.take_rule_stats)
+
+
+_processors = {}  # обработчики процесса пула: правила компилируются один раз на процесс
+
+
+def run_xml_job(backend, replacement_digit, debug, input_path, outputs, part_cache=None, profile=None, report=None,
+                index=None):
+    """Обработка Word/Excel/.xls/.doc в процессе пула: (результат, логи, секунды, статистика правил,
+    (попадания, промахи) кэша частей).
+
+    Результат None — .xls/.doc нельзя изменить без конвертации через Excel/Word.
+    part_cache — каталог кэша обработанных частей (None — без кэша), profile —
+    profiling.ProfileSettings или None, report — (папка отчётов, имя исходного файла), index —
+    (файл индекса идентификаторов, путь файла в индексе, путь для хеша содержимого) или None.
+    """
+    started = time.perf_counter()
+    messages = []
+    key = (backend, replacement_digit, debug, part_cache)
+    if key not in _processors:
+        _processors[key] = load(backend)(replacement_digit, debug=debug,
+                                         part_cache=open_cache(part_cache) if part_cache else None)
+    processor = _processors[key]
+    processor.log = messages.append
+    cache = getattr(processor, 'part_cache', None)
+    cache_before = (cache.hits, cache.misses) if cache else (0, 0)
+    rule_stats = []  # статистика первого прохода, если файл обрабатывается повторно под профилировщиком
+    try:
+        if profile is None:
+            success = processor.process_file_fanout(input_path, outputs)
+        else:
+            success = run_stage(profile, report[0], report[1], backend,
+                                lambda: processor.process_file_fanout(input_path, outputs),
+                                lambda directory: _rerun_xml(backend, replacement_digit, input_path, outputs,
+                                                             directory),
+                                rss=lambda: (process_usage(os.getpid()) or (None,))[0], log=messages.append,
+                                before_rerun=lambda: rule_stats.append(take_rule_stats()))
+    except Exception as e:
+        messages.append(f"Критическая ошибка {os.path.basename(input_path)}: {str(e)}")
+        success = False
+    if index is not None and success:
+        # Тексты читаются из того же файла, что и обрабатывался (после конвертации — из .xlsm/.docx)
+        try:
+            index_file(index[0], backend, index[1], data_path=index[2], texts_path=input_path)
+        except Exception as e:
+            messages.append(f"Индекс: {os.path.basename(index[1])} не записан: {str(e)}")
+    rule_stats.append(take_rule_stats())
+    cache_after = (cache.hits, cache.misses) if cache else (0, 0)
+    return (success, messages, time.perf_counter() - started, rule_stats[0],
+            (cache_after[0] - cache_before[0], cache_after[1] - cache_before[1]))
+
+
+def _rerun_xml(backend, replacement_digit, input_path, outputs, directory):
+    # Повтор под профилировщиком: без кэша частей и логов, результаты — во временную папку
+    processor = load(backend)(replacement_digit)
+    return processor.process_file_fanout(
+        input_path, {digit: os.path.join(directory, os.path.basename(path)) for digit, path in outputs.items()})
+
+
+class ComWorker(threading.Thread):
+    """Поток-надзиратель одного COM-бэкенда.
+
+    Само приложение работает в дочернем процессе (com_host.ComHost), который
+    запускается при первом задании. Поток передаёт ему задания по одному
+    с ограничением времени и перезапускает процесс после зависания, падения
+    или по мере износа (число заданий, память, дескрипторы).
+    """
+
+    def __init__(self, backend, replacement_digit, debug, events, timeout=None, options=None, idle_timeout=None,
+                 profile=None, index=None, metrics=None):
+        super().__init__(name=f"com-{backend}", daemon=True)
+        self.backend = backend
+        self.replacement_digit = replacement_digit
+        self.debug = debug
+        self.options = options
+        self.events = events
+        self.timeout = timeout or JOB_TIMEOUTS[backend]
+        self.idle_timeout = idle_timeout  # через сколько секунд без заданий закрыть приложение (None — не закрывать)
+        self.profile = profile
+        self.index = index  # файл индекса идентификаторов или None
+        self.metrics = metrics or Metrics()
+        self.jobs = queue.Queue()
+
+    def _log(self, message):
+        self.events.put(('log', None, message))
+
+    def _record_waits(self, waits):
+        if waits:
+            self.events.put(('waits', None, waits))
+
+    def run(self):
+        host = None
+        try:
+            while True:
+                try:
+                    job = self.jobs.get(timeout=self.idle_timeout if host is not None else None)
+                except queue.Empty:
+                    # Заданий давно нет: приложение закрывается и освобождает лицензию
+                    self._log(f"{self.backend}: нет файлов {self.idle_timeout / 60:g} мин, приложение закрыто")
+                    host.stop()
+                    host = None
+                    self.metrics.inc('wesa_com_host_stops_total', backend=self.backend, reason='idle')
+                    continue
+                if job is None:
+                    break
+                if host is None:
+                    host = ComHost(self.backend, self.replacement_digit, self.debug, self._log,
+                                   self._record_waits, self.options, self.profile, self.index)
+                    app_starts = 0
+                    self.metrics.inc('wesa_com_host_starts_total', backend=self.backend)
+                started = time.monotonic()
+                result = host.run_job(job, self.timeout)
+                job.elapsed += time.monotonic() - started
+                self.metrics.inc('wesa_com_app_starts_total', host.app_starts - app_starts, backend=self.backend)
+                app_starts = host.app_starts
+                self.events.put((self.backend, job, result))
+                reason = host.failure
+                if host.alive and host.worn_out():
+                    host.stop()
+                    reason = 'recycle'
+                if not host.alive:
+                    self.metrics.inc('wesa_com_host_stops_total', backend=self.backend, reason=reason)
+                    host = None
+        finally:
+            if host is not None:
+                host.stop()
+
+
+class BatchScheduler:
+    """Параллельный запуск пакета: очередь на каждый бэкенд.
+
+    Word/Excel идут в пул процессов, AutoCAD, SmartSketch и конвертация .xls/.doc
+    через Excel/Word — каждый в свой STA-поток. Бэкенды работают одновременно,
+    поэтому время пакета стремится ко времени самого медленного из них.
+
+    С staging=True входные файлы заранее копируются в локальную папку,
+    а результаты записываются в папку назначения фоновыми потоками
+    (см. io_pipeline.StagingArea) — для сетевых ресурсов.
+
+    Задания запускаются в порядке убывания оценки времени (cost_model.CostModel):
+    самые долгие файлы начинаются первыми и не задерживают конец пакета.
+    По завершении в лог выводится прогноз и фактическое время пакета.
+
+    Ход работы отражается в metrics (metrics.Metrics) по мере обработки:
+    файлы, байты, время этапов, ожидания COM, перезапуски, кэш частей, очереди.
+    """
+
+    def __init__(self, replacement_digit, debug=False, max_workers=None, staging=False, job_timeout=None,
+                 backend_options=None, part_cache=None, cost_model=None, com_idle_timeout=None, profile=None,
+                 index=None, metrics=None):
+        self.replacement_digit = replacement_digit
+        self.debug = debug
+        self.max_workers = max_workers
+        self.staging = staging
+        self.job_timeout = job_timeout  # None — значения по умолчанию из com_host.JOB_TIMEOUTS
+        self.backend_options = backend_options or {}  # {бэкенд: параметры обработчика COM}
+        self.part_cache = part_cache  # каталог кэша частей Word/Excel, общий для процессов пула
+        self.cost_model = cost_model or CostModel()
+        self.com_idle_timeout = com_idle_timeout  # см. ComWorker.idle_timeout
+        self.profile = profile  # profiling.ProfileSettings или None — без профилирования
+        self.index = index  # файл индекса идентификаторов (corpus_index) или None — без индексации
+        self.metrics = metrics or Metrics()  # экспортируется снаружи (metrics.start_exporter), если нужно
+
+    def run(self, jobs, log, idle=None, more=None):
+        """Генератор (job, success) по мере завершения заданий.
+
+        log, idle и more вызываются только из потока, который итерирует генератор,
+        поэтому их можно безопасно связывать с Tk.
+
+        more — источник новых заданий во время работы (например, общая очередь
+        заданий): вызывается, пока идёт ожидание результатов, и возвращает список
+        заданий или None, когда новых больше не будет. До этого COM-приложения
+        не закрываются, даже если их задания кончились.
+        """
+        started = time.monotonic()
+        jobs = self._order_jobs(jobs)
+        predicted = self._predict_batch(jobs)
+        feeding = more is not None
+        actual = {}  # когда закончилась обработка последнего задания группы, секунды от начала
+        events = queue.Queue()
+        workers = {}
+        stopped_workers = []
+        pool = None
+        staging = None
+        pending = 0
+        waits = {}  # фактические ожидания COM-бэкендов: {вид: [число, секунды]}
+        rule_stats = {}  # статистика правил замены по обработанным файлам
+        # Сколько заданий бэкенда ещё не передано обработчику: по нулю COM-поток завершается
+        undispatched = {}
+        metrics = self.metrics
+
+        def dispatch(job):
+            nonlocal pool
+            if job.backend in XML_BACKENDS:
+                if pool is None:
+                    pool = ProcessPoolExecutor(max_workers=self.max_workers)
+                self._submit_xml(pool, events, job, job.source_path)
+            else:
+                if job.backend not in workers:
+                    workers[job.backend] = ComWorker(job.backend, self.replacement_digit, self.debug, events,
+                                                     timeout=self.job_timeout,
+                                                     options=self.backend_options.get(job.backend),
+                                                     idle_timeout=self.com_idle_timeout,
+                                                     profile=self.profile, index=self.index,
+                                                     metrics=self.metrics)
+                    workers[job.backend].start()
+                if job.backend in CONVERTED:
+                    job.temp_dir = mkdtemp()  # для .xlsm/.docx из дочернего процесса Excel/Word
+                workers[job.backend].jobs.put(job)
+            handed_over(job.backend)
+
+        def handed_over(backend):
+            undispatched[backend] -= 1
+            if not undispatched[backend] and backend in workers and not feeding:
+                # Поток доработает очередь и закроет приложение; новое задание получит новый поток
+                workers[backend].jobs.put(None)
+                stopped_workers.append(workers.pop(backend))
+
+        def submit(new_jobs):
+            nonlocal pending
+            # Сначала счётчики всех заданий, иначе COM-поток остановится после первого же
+            for job in new_jobs:
+                undispatched[job.backend] = undispatched.get(job.backend, 0) + 1
+            for job in new_jobs:
+                job.submitted = time.monotonic()
+                metrics.inc('wesa_queue_depth', 1, backend=job.cost_backend)
+                if staging is not None:
+                    staging.submit(job)
+                else:
+                    dispatch(job)
+                pending += 1
+
+        def feed():
+            nonlocal feeding
+            new_jobs = more()
+            if new_jobs is None:
+                feeding = False
+                for backend in [backend for backend in workers if not undispatched.get(backend)]:
+                    workers[backend].jobs.put(None)
+                    stopped_workers.append(workers.pop(backend))
+            elif new_jobs:
+                submit(self._order_jobs(new_jobs))
+
+        def completed(job, success):
+            group = self._group(job.cost_backend)
+            actual[group] = time.monotonic() - started
+            merge_rule_stats(rule_stats, job.rule_stats)
+            metrics.observe('wesa_stage_seconds', job.elapsed, backend=job.cost_backend, stage='process')
+            if success and job.elapsed:
+                self.cost_model.record(job.cost_backend, job.input_path, job.size, job.elapsed)
+            if self.debug:
+                log(f"Время {job.filename}: прогноз {job.predicted:.1f} с, факт {job.elapsed:.1f} с")
+
+        def finished(job, success):
+            # Без локальной подготовки результат уже на месте; иначе ждём отложенной записи
+            if staging is None:
+                return True
+            staging.finish(job, success)
+            return False
+
+        def done(job, success):
+            # Итог задания для метрик, перед тем как отдать его вызывающему
+            backend = job.cost_backend
+            metrics.inc('wesa_queue_depth', -1, backend=backend)
+            metrics.inc('wesa_files_total', backend=backend, result='success' if success else 'error')
+            metrics.inc('wesa_input_bytes_total', job.size, backend=backend)
+            if success:
+                metrics.inc('wesa_output_bytes_total', self._output_bytes(job), backend=backend)
+            metrics.observe('wesa_stage_seconds', time.monotonic() - job.submitted, backend=backend, stage='total')
+
+        def record_waits(payload):
+            merge_waits(waits, payload)
+            for name, (count, seconds) in payload.items():
+                metrics.inc('wesa_retry_waits_total', count, kind=name)
+                metrics.inc('wesa_retry_wait_seconds_total', seconds, kind=name)
+
+        def queue_depths():
+            depths = {}
+            for worker in stopped_workers + list(workers.values()):
+                depths[worker.backend] = depths.get(worker.backend, 0) + worker.jobs.qsize()
+            for backend, depth in depths.items():
+                metrics.set('wesa_com_queue_depth', depth, backend=backend)
+
+        try:
+            if self.staging:
+                # Пулу — окно по числу процессов плюс такое же упреждение, как у COM-бэкендов
+                window = self._pool_workers() + 2
+                staging = StagingArea(events, limits={backend: window for backend in XML_BACKENDS})
+            submit(jobs)
+
+            while pending or feeding:
+                queue_depths()
+                try:
+                    kind, job, payload = events.get(timeout=0.1)
+                except queue.Empty:
+                    if idle:
+                        idle()
+                    if feeding:
+                        feed()
+                    continue
+                if kind == 'log':
+                    log(payload)
+                elif kind == 'waits':
+                    record_waits(payload)
+                elif kind == 'fetched':
+                    metrics.observe('wesa_stage_seconds', job.fetch_seconds, backend=job.cost_backend, stage='fetch')
+                    if payload is None:
+                        dispatch(job)
+                        continue
+                    log(f"Ошибка чтения {job.filename}: {str(payload)}")
+                    handed_over(job.backend)
+                    pending -= 1
+                    done(job, False)
+                    yield job, False
+                elif kind == 'written':
+                    if isinstance(payload, Exception):
+                        log(f"Ошибка записи {job.filename}: {str(payload)}")
+                        payload = False
+                    metrics.observe('wesa_stage_seconds', job.write_seconds, backend=job.cost_backend, stage='write')
+                    pending -= 1
+                    done(job, payload)
+                    yield job, payload
+                elif kind in CONVERTED and payload:
+                    # .xls/.doc сконвертирован — дальше обычная обработка Excel/Word в пуле
+                    if pool is None:
+                        pool = ProcessPoolExecutor(max_workers=self.max_workers)
+                    self._submit_xml(pool, events, job, payload, backend=CONVERTED[kind])
+                elif kind == 'xml':
+                    success, messages = self._xml_result(job, payload)
+                    for message in messages:
+                        log(message)
+                    if success is None:
+                        # .xls/.doc не удалось изменить на месте — конвертация через Excel/Word
+                        if self._reroute_to_conversion(job, log):
+                            undispatched[job.backend] = undispatched.get(job.backend, 0) + 1
+                            dispatch(job)
+                            continue
+                        success = False
+                    completed(job, success)
+                    if finished(job, success):
+                        pending -= 1
+                        done(job, success)
+                        yield job, success
+                else:
+                    self._cleanup(job)
+                    completed(job, bool(payload))
+                    if finished(job, bool(payload)):
+                        pending -= 1
+                        done(job, bool(payload))
+                        yield job, bool(payload)
+            if predicted:
+                log(self._format_times(predicted, actual, time.monotonic() - started))
+        finally:
+            self.cost_model.save()
+            for worker in workers.values():
+                worker.jobs.put(None)
+            for worker in stopped_workers + list(workers.values()):
+                worker.join()
+            if pool is not None:
+                pool.shutdown(wait=True)
+            if staging is not None:
+                staging.close()
+            while not events.empty():
+                kind, job, payload = events.get_nowait()
+                if kind == 'log':
+                    log(payload)
+                elif kind == 'waits':
+                    record_waits(payload)
+            queue_depths()
+            if waits:
+                log(f"Ожидания COM: {format_waits(waits)}")
+            for line in format_rule_stats(rule_stats):
+                log(line)
+
+    def _pool_workers(self):
+        # Число процессов пула: без max_workers ProcessPoolExecutor берёт число процессоров
+        return self.max_workers or os.cpu_count() or 1
+
+    @staticmethod
+    def _group(backend):
+        # XML-бэкенды делят общий пул процессов, у каждого COM-бэкенда своё приложение
+        return 'пул' if backend in XML_BACKENDS else backend
+
+    def _order_jobs(self, jobs):
+        """Оценка времени каждого задания и порядок запуска: от самого долгого к самому короткому."""
+        for job in jobs:
+            try:
+                job.size = os.path.getsize(job.input_path)
+            except OSError:
+                job.size = 0
+            job.predicted = self.cost_model.predict(job.backend, job.input_path, job.size)
+        return sorted(jobs, key=lambda job: job.predicted, reverse=True)
+
+    def _predict_batch(self, jobs):
+        """Прогноз времени каждой группы: пул — по числу процессов, COM-бэкенд — последовательно."""
+        costs = {}
+        for job in jobs:
+            costs.setdefault(self._group(job.backend), []).append(job.predicted)
+        pool_workers = self._pool_workers()
+        return {group: makespan(values, pool_workers if group == 'пул' else 1)
+                for group, values in costs.items()}
+
+    @staticmethod
+    def _format_times(predicted, actual, total):
+        details = "; ".join(f"{group}: прогноз {seconds:.0f} с, факт {actual.get(group, 0):.0f} с"
+                            for group, seconds in sorted(predicted.items(), key=lambda item: -item[1]))
+        return f"Время пакета: прогноз {max(predicted.values()):.0f} с, факт {total:.0f} с ({details})"
+
+    def _submit_xml(self, pool, events, job, input_path, backend=None):
+        future = pool.submit(run_xml_job, backend or job.backend, self.replacement_digit,
+                             self.debug, input_path, job.targets, self.part_cache,
+                             self.profile, (report_dir(job.outputs), job.filename),
+                             (self.index, job.input_path, job.source_path) if self.index else None)
+        future.add_done_callback(lambda f: events.put(('xml', job, f)))
+
+    @staticmethod
+    def _reroute_to_conversion(job, log):
+        """Перевод задания на конвертацию: .xls → .xlsm через Excel, .doc → .docx через Word."""
+        converter, extension = CONVERSIONS[job.backend]
+        if not BACKENDS[converter].available():
+            missing = ", ".join(BACKENDS[converter].missing())
+            log(f"Пропуск конвертации {job.filename} (не установлены модули: {missing})")
+            return False
+        job.backend = converter
+        job.outputs = {digit: os.path.splitext(path)[0] + extension for digit, path in job.outputs.items()}
+        job.targets = {digit: os.path.splitext(path)[0] + extension for digit, path in job.targets.items()}
+        return True
+
+    def _xml_result(self, job, future):
+        self._cleanup(job)
+        try:
+            success, messages, seconds, rule_stats, (hits, misses) = future.result()
+        except Exception as e:
+            return False, [f"Критическая ошибка {job.filename}: {str(e)}"]
+        job.elapsed += seconds
+        merge_rule_stats(job.rule_stats, rule_stats)
+        self.metrics.inc('wesa_part_cache_requests_total', hits, result='hit')
+        self.metrics.inc('wesa_part_cache_requests_total', misses, result='miss')
+        return success, messages
+
+    @staticmethod
+    def _output_bytes(job):
+        # Результаты, которые обработчик не сохранил (SHA без изменений), не считаются
+        total = 0
+        for path in job.outputs.values():
+            try:
+                total += os.path.getsize(path)
+            except OSError:
+                pass
+        return total
+
+    @staticmethod
+    def _cleanup(job):
+        if job.temp_dir:
+            rmtree(job.temp_dir, ignore_errors=True)
+            job.temp_dir = None
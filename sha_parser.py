@@ -4,7 +4,10 @@ import winreg
 import win32com.client
 import pythoncom
 import pywintypes
-import time
+from backends import SHA
+from host_process import HOST_PROCESSES, process_ids, resolve_host
+from retry import wait_until
+from rules import sub_sequential
 
 def get_license_servers_from_registry():
     """Читаем серверы лицензий из реестра и формируем строку INGR_LICENSE_PATH"""
@@ -20,16 +23,14 @@ def get_license_servers_from_registry():
 
 def wait_for_object_ready(obj, timeout=3.0):
     """Ожидание готовности COM-объекта (без лишних логов)."""
-    start_time = time.time()
-    while time.time() - start_time < timeout:
+    def ready():
         try:
             pythoncom.PumpWaitingMessages()
-            if obj is not None:
-                return True
+            return obj is not None
         except Exception:
-            pass
-        time.sleep(0.1)
-    return False
+            return False
+
+    return wait_until(ready, "ready_sha", budget=timeout)
 
 class ShaProcessorWinAPI:
     def __init__(self, replacement_digit, log_callback=None, debug=False):
@@ -37,6 +38,12 @@ class ShaProcessorWinAPI:
         self.debug = debug  # Флаг отладки
         self.log = log_callback or (lambda msg: None)  # Если колбэк не передан — молчит
         self.app = None
+        self.host_pid = None  # PID запущенного нами SmartSketch (None — не наш или неизвестен)
+        # Режим нескольких блоков: {цифра: путь} и найденные текстовые свойства
+        self._fanout_outputs = None
+        self._fanout_targets = None
+        # Тексты обхода для индекса идентификаторов: [(место, текст)] или None — не собирать
+        self.seen_texts = None
         self._log(f"Инициализация ShaProcessorWinAPI с цифрой: {self.replacement_digit}")
 
         self.patterns = [
@@ -91,7 +98,9 @@ class ShaProcessorWinAPI:
             self._log("[ЛИЦЕНЗИИ] Не удалось найти сервера в реестре")
 
         try:
+            before = process_ids(HOST_PROCESSES[SHA])
             self.app = win32com.client.Dispatch("Shape2DServer.Application")
+            self.host_pid = resolve_host(self.app, HOST_PROCESSES[SHA], before)
             self._log("SmartSketch запущен успешно")
         except Exception as e:
             self._log(f"Ошибка запуска SmartSketch: {e}")
@@ -108,6 +117,7 @@ class ShaProcessorWinAPI:
             self._log(f"Ошибка при закрытии SmartSketch: {e}")
         finally:
             self.app = None
+            self.host_pid = None
             pythoncom.CoUninitialize()
 
     def _replace_text_in_object(self, text_obj, obj_name):
@@ -116,9 +126,13 @@ class ShaProcessorWinAPI:
             if hasattr(text_obj, "Text"):
                 text = text_obj.Text
                 if text and isinstance(text, str):
+                    if self.seen_texts is not None:
+                        self.seen_texts.append((obj_name, text))
+                    if self._fanout_targets is not None:
+                        self._fanout_targets.append((text_obj, "Text", text, obj_name))
+                        return False
                     original_text = text
-                    for pattern, replacement in self.patterns:
-                        text = pattern.sub(replacement, text)
+                    text = sub_sequential(self.patterns, text, type(self).__name__)
 
                     if text != original_text:
                         text_obj.Text = text
@@ -162,9 +176,12 @@ class ShaProcessorWinAPI:
                 except Exception:
                     continue
                 if isinstance(val, str) and val.strip():
-                    new_val = val
-                    for pattern, repl in self.patterns:
-                        new_val = pattern.sub(repl, new_val)
+                    if self.seen_texts is not None:
+                        self.seen_texts.append((f"{obj_name}.{prop}", val))
+                    if self._fanout_targets is not None:
+                        self._fanout_targets.append((obj, prop, val, f"{obj_name}.{prop}"))
+                        continue
+                    new_val = sub_sequential(self.patterns, val, type(self).__name__)
                     if new_val != val:
                         try:
                             setattr(obj, prop, new_val)
@@ -174,11 +191,55 @@ class ShaProcessorWinAPI:
                             pass
         return changed
 
+    def _save_fanout(self, doc):
+        """SaveAs открытого документа для каждой цифры; меняются только отличающиеся свойства."""
+        initial_digit = self.replacement_digit
+        current = [value for _, _, value, _ in self._fanout_targets]
+        try:
+            for digit, output_path in self._fanout_outputs.items():
+                self.replacement_digit = str(digit)
+                changes_made = False
+                for i, (obj, prop, value, obj_name) in enumerate(self._fanout_targets):
+                    new_value = sub_sequential(self.patterns, value, type(self).__name__)
+                    if new_value != value:
+                        changes_made = True
+                    if new_value != current[i]:
+                        try:
+                            setattr(obj, prop, new_value)
+                            current[i] = new_value
+                            self._log(f"[ИЗМЕНЕНО] {obj_name}: '{value}' → '{new_value}'")
+                        except Exception as e:
+                            self._log(f"[ОШИБКА] {obj_name}: {e}")
+                if changes_made:
+                    doc.SaveAs(output_path)
+                    self._log(f"Документ сохранён: {output_path}")
+                else:
+                    self._log("Изменений не найдено, сохранение пропущено")
+        finally:
+            self.replacement_digit = initial_digit
+
+    def process_file_fanout(self, input_path, outputs):
+        """Обработка файла для нескольких блоков: outputs — {цифра: путь}.
+
+        Документ открывается и обходится один раз, затем SaveAs для каждой цифры.
+        """
+        if list(outputs) == [self.replacement_digit]:
+            return self.process_file(input_path, outputs[self.replacement_digit])
+        self._fanout_outputs = outputs
+        self._fanout_targets = []
+        try:
+            return self.process_file(input_path, None)
+        finally:
+            self._fanout_outputs = None
+            self._fanout_targets = None
+
     def process_file(self, input_path, output_path):
         """Открыть файл, заменить текст и сохранить новый."""
         if not self.app:
             raise RuntimeError("SmartSketch не запущен")
 
+        if self.seen_texts is not None:
+            self.seen_texts = []
         try:
             doc = self.app.Documents.Open(os.path.abspath(input_path))
             wait_for_object_ready(doc)
@@ -201,7 +262,9 @@ class ShaProcessorWinAPI:
                             changes_made = True
 
             # Сохраняем, если есть изменения
-            if changes_made:
+            if self._fanout_outputs is not None:
+                self._save_fanout(doc)
+            elif changes_made:
                 doc.SaveAs(output_path)
                 self._log(f"Документ сохранён: {output_path}")
             else:
@@ -0,0 +1,105 @@
+"""Сборка небольших составных файлов OLE ([MS-CFB]) для тестов правки .xls и .doc на месте."""
+import struct
+
+ENDOFCHAIN = 0xFFFFFFFE
+FREESECT = 0xFFFFFFFF
+FATSECT = 0xFFFFFFFD
+NOSTREAM = 0xFFFFFFFF
+MINI_CUTOFF = 4096
+MINI_SIZE = 64
+ENTRY_SIZE = 128
+
+
+def _entry(name, entry_type, start, size, right=NOSTREAM, child=NOSTREAM):
+    encoded = (name + '\0').encode('utf-16-le') if name else b''
+    return struct.pack('<64sH2B3L16sL2QLQ', encoded, len(encoded), entry_type, 1, NOSTREAM, right, child,
+                       b'\0' * 16, 0, 0, 0, start, size)
+
+
+def build(streams, sector_shift=9, scatter=False):
+    """Составной файл из {имя потока: данные}.
+
+    Потоки меньше 4096 байт попадают в мини-поток. sector_shift=12 — версия 4
+    (сектор 4096 байт). scatter — сектора разных цепочек идут вперемежку,
+    чтобы поток занимал несколько несмежных отрезков файла.
+    """
+    sector_size = 1 << sector_shift
+    names = list(streams)
+
+    mini = bytearray()
+    minifat = []
+    starts = {}
+    for name in names:
+        data = streams[name]
+        if not data:
+            starts[name] = ENDOFCHAIN
+        elif len(data) < MINI_CUTOFF:
+            count = -(-len(data) // MINI_SIZE)
+            first = len(minifat)
+            minifat.extend(range(first + 1, first + count))
+            minifat.append(ENDOFCHAIN)
+            starts[name] = first
+            mini += data.ljust(count * MINI_SIZE, b'\0')
+
+    # Цепочки обычных секторов: данные известны для всех, кроме каталога (в нём начала цепочек)
+    chains = {name: streams[name] for name in names if len(streams[name]) >= MINI_CUTOFF}
+    if mini:
+        chains['<mini>'] = bytes(mini)
+    if minifat:
+        chains['<minifat>'] = struct.pack(f'<{len(minifat)}L', *minifat)
+    directory_size = -(-(len(names) + 1) * ENTRY_SIZE // sector_size) * sector_size
+    chains['<directory>'] = b'\0' * directory_size
+    counts = {key: -(-len(data) // sector_size) for key, data in chains.items()}
+
+    order = []
+    if scatter:
+        remaining = dict(counts)
+        while any(remaining.values()):
+            for key in chains:
+                if remaining[key]:
+                    order.append(key)
+                    remaining[key] -= 1
+    else:
+        for key in chains:
+            order.extend([key] * counts[key])
+    per_sector = sector_size // 4
+    fat_count = 1
+    while fat_count * per_sector < len(order) + fat_count:
+        fat_count += 1
+    # Сектора FAT — в начале файла, чтобы обрезанный файл терял данные потоков, а не таблицу
+    fat_sectors = list(range(fat_count))
+    sectors = {key: [fat_count + index for index, owner in enumerate(order) if owner == key] for key in chains}
+    for name in names:
+        if name in chains:
+            starts[name] = sectors[name][0]
+
+    fat = [FREESECT] * (fat_count * per_sector)
+    for chain in sectors.values():
+        for current, following in zip(chain, chain[1:] + [ENDOFCHAIN]):
+            fat[current] = following
+    for sector in fat_sectors:
+        fat[sector] = FATSECT
+
+    entries = [_entry('Root Entry', 5, sectors['<mini>'][0] if mini else ENDOFCHAIN, len(mini),
+                      child=1 if names else NOSTREAM)]
+    for index, name in enumerate(names, 1):
+        entries.append(_entry(name, 2, starts[name], len(streams[name]),
+                              right=index + 1 if index < len(names) else NOSTREAM))
+    chains['<directory>'] = b''.join(entries).ljust(directory_size, b'\0')
+
+    body = bytearray(sector_size * (len(order) + fat_count))
+    body[:fat_count * sector_size] = struct.pack(f'<{len(fat)}L', *fat)
+    for key, data in chains.items():
+        for position, sector in enumerate(sectors[key]):
+            chunk = data[position * sector_size:(position + 1) * sector_size]
+            body[sector * sector_size:sector * sector_size + len(chunk)] = chunk
+
+    header = struct.pack('<8s16s6H10L', b'\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1', b'\0' * 16, 0x3E,
+                         4 if sector_shift == 12 else 3, 0xFFFE, sector_shift, 6, 0, 0,
+                         len(sectors['<directory>']) if sector_shift == 12 else 0, fat_count,
+                         sectors['<directory>'][0], 0, MINI_CUTOFF,
+                         sectors['<minifat>'][0] if minifat else ENDOFCHAIN, counts.get('<minifat>', 0),
+                         ENDOFCHAIN, 0)
+    difat = fat_sectors + [FREESECT] * (109 - fat_count)
+    header += struct.pack('<109L', *difat)
+    return header.ljust(sector_size, b'\0') + bytes(body)
@@ -0,0 +1,25 @@
+import json
+import cost_model
+from cost_model import CostModel
+
+
+def test_overlapping_saves_do_not_share_a_temp_file(tmp_path, monkeypatch):
+    # Второй процесс сохраняет модель, пока первый ещё пишет свою: запись первого не должна потеряться
+    path = str(tmp_path / 'timings.json')
+    first, second = CostModel(path), CostModel(path)
+    first.record('word', 'first.docx', 1000, 0.5)
+    second.record('word', 'second.docx', 1000, 0.5)
+    dump = json.dump
+
+    def interleaved(data, f, **kwargs):
+        if 'first.docx' in str(data['files']):
+            monkeypatch.setattr(cost_model.json, 'dump', dump)
+            second.save()
+        dump(data, f, **kwargs)
+
+    monkeypatch.setattr(cost_model.json, 'dump', interleaved)
+    first.save()
+
+    with open(path, encoding='utf-8') as f:
+        assert list(json.load(f)['files']) == [CostModel._file_key('first.docx', 1000)]
+    assert sorted(item.name for item in tmp_path.iterdir()) == ['timings.json']
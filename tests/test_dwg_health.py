@@ -0,0 +1,61 @@
+import json
+import dwg_health
+from dwg_health import RecoveryCache, audit_errors
+
+
+def _report(tmp_path, data):
+    path = tmp_path / 'drawing.adt'
+    path.write_bytes(data)
+    return str(path)
+
+
+def test_audit_errors_english(tmp_path):
+    report = _report(tmp_path, b"Auditing Header\r\nPass 1 20 objects audited\r\n"
+                               b"Total errors found 3 fixed 0\r\nErased 0 objects\r\n")
+    assert audit_errors(report) == 3
+
+
+def test_audit_errors_russian_ansi(tmp_path):
+    report = _report(tmp_path, "Всего найдено ошибок: 0, исправлено 0\r\n".encode('cp1251'))
+    assert audit_errors(report) == 0
+
+
+def test_audit_errors_utf16(tmp_path):
+    report = _report(tmp_path, "Total errors found 1 fixed 1\r\n".encode('utf-16'))
+    assert audit_errors(report) == 1
+
+
+def test_audit_errors_without_total(tmp_path):
+    # Нет итоговой строки — нет и вывода о состоянии чертежа
+    assert audit_errors(_report(tmp_path, b"Auditing Header\r\n")) is None
+
+
+def test_overlapping_saves_do_not_share_a_temp_file(tmp_path, monkeypatch):
+    # Второй процесс сохраняет кэш, пока первый ещё пишет свой: запись первого не должна потеряться
+    path = str(tmp_path / 'dwg_health.json')
+    first, second = RecoveryCache(path), RecoveryCache(path)
+    second.entries['b'] = {'recover': True, 'reason': 'длинная причина ' * 20}
+    dump = json.dump
+
+    def interleaved(data, f, **kwargs):
+        if 'a' in data:
+            monkeypatch.setattr(dwg_health.json, 'dump', dump)
+            second._save()
+        dump(data, f, **kwargs)
+
+    monkeypatch.setattr(dwg_health.json, 'dump', interleaved)
+    first.put('a', False, 'аудит: ошибок 0', 'a.dwg')
+
+    assert list(RecoveryCache(path).entries) == ['a']
+    assert sorted(item.name for item in tmp_path.iterdir()) == ['dwg_health.json']
+
+
+def test_may_recover_by_size(tmp_path):
+    cache = RecoveryCache(str(tmp_path / 'dwg_health.json'))
+    assert not cache.may_recover(100)
+    cache.put('a', False, 'аудит: ошибок 0', 'a.dwg', 100)
+    cache.put('b', True, 'аудит: ошибок 2', 'b.dwg', 200)
+    assert not cache.may_recover(100) and cache.may_recover(200)
+    # Запись без размера (старый формат кэша) не позволяет обойтись без хеша
+    cache.entries['c'] = {'recover': True, 'reason': 'повторная попытка после ошибки', 'file': 'c.dwg'}
+    assert cache.may_recover(100)
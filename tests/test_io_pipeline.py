@@ -0,0 +1,37 @@
+import queue
+from io_pipeline import StagingArea
+from scheduler import Job
+
+
+def fetched(events, count):
+    jobs = []
+    for _ in range(count):
+        kind, job, error = events.get(timeout=5)
+        assert kind == 'fetched' and error is None
+        jobs.append(job)
+    return jobs
+
+
+def test_window_per_backend(tmp_path):
+    # Пул получает окно по числу процессов, COM-бэкенд — обычное окно в два задания
+    events = queue.Queue()
+    staging = StagingArea(events, limits={'word': 5})
+    try:
+        for index in range(8):
+            source = tmp_path / f'{index}.docx'
+            source.write_bytes(b'x')
+            backend = 'word' if index < 6 else 'autocad'
+            staging.submit(Job(str(source), {'2': str(tmp_path / f'{index}.out')}, backend))
+        jobs = fetched(events, 7)
+        assert sorted(job.stage_queue for job in jobs) == ['autocad', 'autocad'] + ['word'] * 5
+        assert events.empty()
+
+        # Слот освобождается только после отложенной записи результатов
+        word = next(job for job in jobs if job.backend == 'word')
+        staging.finish(word, False)
+        # Следующее чтение может начаться раньше, чем событие записи попадёт в очередь
+        following = sorted((events.get(timeout=5) for _ in range(2)), key=lambda event: event[0])
+        assert [(kind, job.backend) for kind, job, _ in following] == [('fetched', 'word'), ('written', 'word')]
+        assert following[1][1] is word and following[1][2] is False
+    finally:
+        staging.close()
@@ -0,0 +1,96 @@
+import random
+import re
+from excel_parser import ExcelProcessor
+from rules import RULE_SAMPLE_CHARS, RuleSet, SEPARATOR, sub_sequential, sub_sequential_batch, take_rule_stats
+from word_parser import WordProcessor
+
+# Фрагменты, из которых собираются тексты для сравнения объединённого и последовательного проходов
+_TOKENS = ['ED.D.P123.2', 'ED.D.A000.4', '10UKD', '20ukd10', '30xED', 'C02', 'C05x', 'Unit 2', 'Unit2',
+           'блока № 3', 'ED.B.P000.S', ' ', '.', 'x', '1', '0', '-', '\n', 'ED.D.', 'UKD']
+
+
+def _texts(count, seed=26):
+    rng = random.Random(seed)
+    return [''.join(rng.choice(_TOKENS) for _ in range(rng.randint(1, 8))) for _ in range(count)]
+
+
+def test_same_position_earlier_rule_wins():
+    rules = RuleSet([(re.compile('ab'), 'X'), (re.compile('abc'), 'Y')])
+    assert rules.sub('abc abc') == 'Xc Xc'
+
+
+def test_leftmost_match_consumes_text_of_earlier_rule():
+    # Контракт объединённого прохода: самое левое совпадение побеждает правило выше по списку.
+    # У ExcelProcessor совпадения правил перекрываются, поэтому он применяет их последовательно
+    patterns = ExcelProcessor('1').patterns
+    assert RuleSet(patterns).sub('10xED.D.A123.2') == '10xED.D.A123.2'
+    assert sub_sequential(patterns, '10xED.D.A123.2') == '10xED.D.A123.1'
+
+
+def test_word_rules_fused_match_sequential():
+    texts = _texts(3000)
+    for digit in '1234':
+        processor = WordProcessor(digit)
+        for text in texts:
+            assert processor.rules.sub(text) == sub_sequential(processor.patterns, text), (digit, text)
+
+
+def test_find_edits_batch_matches_single_texts():
+    rules = WordProcessor('3').rules
+    texts = _texts(500)
+    expected = {index: edits for index, edits in enumerate(map(rules.find_edits, texts)) if edits}
+    assert rules.find_edits_batch(texts) == expected
+
+
+def test_find_edits_batch_falls_back_when_match_crosses_separator():
+    # Правило с \s* могло бы захватить разделитель между текстами — тогда тексты просматриваются по одному
+    rules = RuleSet([(re.compile(r'a[\s\x00]*b'), 'X')])
+    texts = ['a', 'b', 'a b']
+    assert rules.find_edits_batch(texts) == {2: [(0, 3, 'X')]}
+
+
+def test_sub_sequential_batch_matches_single_texts():
+    patterns = ExcelProcessor('2').patterns
+    texts = _texts(500) + ['&L&11ED.D.P123.1', '&R&11C03']
+    expected = [sub_sequential(patterns, text) for text in texts]
+    assert sub_sequential_batch(patterns, texts) == expected
+    assert sub_sequential_batch(patterns, ['нет совпадений']) is None
+    assert SEPARATOR not in ''.join(expected)
+
+
+class _CountingPattern:
+    """Шаблон, который считает отдельные прогоны finditer (замеры долей времени правил)."""
+
+    def __init__(self, source):
+        self.compiled = re.compile(source)
+        self.pattern = self.compiled.pattern
+        self.flags = self.compiled.flags
+        self.runs = 0
+
+    def finditer(self, text):
+        self.runs += 1
+        return self.compiled.finditer(text)
+
+    def match(self, text, pos=0):
+        return self.compiled.match(text, pos)
+
+
+def test_rule_weights_are_measured_a_bounded_number_of_times():
+    pattern = _CountingPattern('ab')
+    rules = RuleSet([(pattern, 'X'), (re.compile('cd'), 'Y')], owner='test')
+    take_rule_stats()
+    for index in range(5000):
+        rules.find_edits(f'ab cd {index}')
+    rules.find_edits_batch(['ab'] * 100)
+    # Образец растёт вдвое до RULE_SAMPLE_CHARS: замеров порядка log2(RULE_SAMPLE_CHARS), а не по одному на текст
+    assert pattern.runs <= RULE_SAMPLE_CHARS.bit_length() + 1
+    stats = take_rule_stats()
+    assert stats[('test', 'ab')][:3] == [5100, 5100, 5100]
+    assert stats[('test', 'cd')][:3] == [5100, 5000, 5000]
+
+
+def test_rule_set_without_owner_records_nothing():
+    pattern = _CountingPattern('ab')
+    take_rule_stats()
+    RuleSet([(pattern, 'X')]).find_edits('ab ab')
+    assert pattern.runs == 0 and take_rule_stats() == {}
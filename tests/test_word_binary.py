@@ -0,0 +1,144 @@
+import re
+import struct
+import pytest
+from compound_file import build
+from ole_file import OleFile
+from word_binary import DocProcessor, DocUnsupported, _Document
+from word_parser import WordProcessor
+
+CLX = 16  # смещение Clx в потоке 1Table
+STREAM_SIZE = 4608  # больше границы мини-потока: WordDocument лежит в обычных секторах
+
+# Куски текста: (текст, сжатый cp1252 или UTF-16, смещение в потоке WordDocument).
+# Второй кусок пересекает границу сектора 2048, 'ED.D.P123.1' разрезан между сжатым куском и UTF-16
+MAIN = [('Шифр 1', False, 1024), ('0UKD; XYZ ED.D.P1', True, 2040), ('23.1\rUnit 2\r', False, 3000)]
+HEADER = [('Unit 1 C02\r', False, 3500)]
+
+
+def fib(text_count, header_count, lcb_clx, flags=0x0200):
+    """FIB Word 97: FibBase, FibRgW97 (14 слов), FibRgLw97 (22 числа), FibRgFcLcb97 (93 пары)."""
+    data = bytearray(898)
+    struct.pack_into('<2H', data, 0, 0xA5EC, 0x00C1)
+    struct.pack_into('<H', data, 10, flags)
+    struct.pack_into('<H', data, 32, 14)
+    struct.pack_into('<H', data, 62, 22)
+    struct.pack_into('<l', data, 64 + 12, text_count)
+    struct.pack_into('<l', data, 64 + 20, header_count)
+    struct.pack_into('<H', data, 152, 93)
+    struct.pack_into('<2L', data, 154 + 33 * 8, CLX, lcb_clx)
+    return bytes(data)
+
+
+def clx(pieces):
+    """Clx: один Prc (свойства, пропускаются при разборе) и Pcdt с таблицей кусков."""
+    cps = [0]
+    descriptors = b''
+    for text, compressed, position in pieces:
+        cps.append(cps[-1] + len(text))
+        fc = position * 2 | 0x40000000 if compressed else position
+        descriptors += struct.pack('<HLH', 0, fc, 0)
+    plc = struct.pack(f'<{len(cps)}l', *cps) + descriptors
+    return b'\x01' + struct.pack('<h', 2) + b'\x00\x00' + b'\x02' + struct.pack('<L', len(plc)) + plc
+
+
+def document(main=MAIN, header=HEADER, lcb_extra=0, sector_shift=9, scatter=False):
+    pieces = main + header
+    table = b'\0' * CLX + clx(pieces)
+    stream = bytearray(fib(sum(len(text) for text, _, _ in main), sum(len(text) for text, _, _ in header),
+                           len(table) - CLX + lcb_extra))
+    stream = stream.ljust(STREAM_SIZE, b'\0')
+    for text, compressed, position in pieces:
+        encoded = text.encode('cp1252' if compressed else 'utf-16-le')
+        stream[position:position + len(encoded)] = encoded
+    del stream[STREAM_SIZE:]  # кусок может указывать за конец потока
+    return build({'WordDocument': bytes(stream), '1Table': table}, sector_shift, scatter)
+
+
+def write_doc(tmp_path, data, name='doc.doc'):
+    path = tmp_path / name
+    path.write_bytes(data)
+    return str(path)
+
+
+def paragraphs(data):
+    return list(_Document(data).paragraphs())
+
+
+def test_paragraphs_follow_piece_table():
+    assert paragraphs(document()) == [(0, 'Шифр 10UKD; XYZ ED.D.P123.1'), (28, 'Unit 2'), (35, 'Unit 1 C02')]
+
+
+@pytest.mark.parametrize('sector_shift, scatter', [(9, False), (9, True), (12, False)])
+def test_equal_length_patch_round_trip(tmp_path, sector_shift, scatter):
+    source = document(sector_shift=sector_shift, scatter=scatter)
+    input_path = write_doc(tmp_path, source)
+    outputs = {digit: str(tmp_path / f'{digit}.doc') for digit in '234'}
+    assert DocProcessor('1').process_file_fanout(input_path, outputs)
+
+    original = paragraphs(source)
+    for digit, output_path in outputs.items():
+        rules = WordProcessor(digit).rules
+        with open(output_path, 'rb') as f:
+            result = f.read()
+        assert paragraphs(result) == [(cp, rules.sub(text)) for cp, text in original]
+        # Меняются только байты символов: размер файла и поток таблиц те же
+        assert len(result) == len(source)
+        assert OleFile(result).open_stream('1Table').data == OleFile(source).open_stream('1Table').data
+    with open(outputs['3'], 'rb') as f:
+        assert [text for _, text in paragraphs(f.read())] == [
+            'Шифр 30UKD; XYZ ED.D.P123.3', 'Unit 3', 'Unit 3 C01']
+
+
+def test_iter_texts_lists_processed_paragraphs(tmp_path):
+    input_path = write_doc(tmp_path, document())
+    assert [text for _, text in DocProcessor('2').iter_texts(input_path)] == [
+        'Шифр 10UKD; XYZ ED.D.P123.1', 'Unit 2', 'Unit 1 C02']
+
+
+def _processor_with(pattern, replacement):
+    class Processor(DocProcessor):
+        def _build_patterns(self):
+            return [(re.compile(pattern), replacement)]
+    return Processor('2')
+
+
+@pytest.mark.parametrize('pattern, replacement', [
+    ('UKD', 'UKDX'),  # меняется длина текста
+    ('XYZ', 'ЖЖЖ'),  # символы не помещаются в сжатый (cp1252) кусок
+])
+def test_unpatchable_replacement_needs_conversion(tmp_path, pattern, replacement):
+    input_path = write_doc(tmp_path, document())
+    output_path = tmp_path / 'out.doc'
+    assert _processor_with(pattern, replacement).process_file_fanout(input_path, {'2': str(output_path)}) is None
+    assert not output_path.exists()
+
+
+def test_revisions_table_needs_conversion(tmp_path):
+    main = MAIN + [('Лист регистрации изменений\r', False, 3200)]
+    input_path = write_doc(tmp_path, document(main=main))
+    output_path = tmp_path / 'out.doc'
+    assert DocProcessor('2').process_file_fanout(input_path, {'2': str(output_path)}) is None
+    assert not output_path.exists()
+
+
+def _short_word_document():
+    return build({'WordDocument': struct.pack('<2H', 0xA5EC, 0x00C1) + b'\0' * 20, '1Table': b'\0' * 64})
+
+
+@pytest.mark.parametrize('data', [
+    pytest.param(_short_word_document(), id='short-fib'),
+    pytest.param(document(lcb_extra=4096), id='clx-beyond-table'),
+    pytest.param(document(header=[('Unit 1 C02\r', False, STREAM_SIZE - 4)]), id='piece-beyond-stream'),
+    pytest.param(document()[:2000], id='truncated-compound-file'),
+])
+def test_truncated_document_needs_conversion(tmp_path, data):
+    input_path = write_doc(tmp_path, data)
+    output_path = tmp_path / 'out.doc'
+    assert DocProcessor('2').process_file_fanout(input_path, {'2': str(output_path)}) is None
+    assert not output_path.exists()
+
+
+def test_encrypted_document_is_rejected():
+    data = bytearray(fib(0, 0, 0, flags=0x0200 | 0x0100))
+    with pytest.raises(DocUnsupported):
+        _Document(build({'WordDocument': bytes(data), '1Table': b'\0' * 64}))
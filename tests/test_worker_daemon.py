@@ -0,0 +1,52 @@
+import os
+import sys
+import threading
+from multiprocessing.connection import Listener
+import pytest
+import worker_daemon
+from worker_daemon import run_remote
+
+
+@pytest.fixture
+def daemon(tmp_path, monkeypatch):
+    """Демон-заглушка: отвечает на пакет сообщениями из replies и закрывает соединение."""
+    monkeypatch.setenv('LOCALAPPDATA', str(tmp_path))
+    os.makedirs(os.path.dirname(worker_daemon._key_path()))
+    key = b'k' * 32
+    with open(worker_daemon._key_path(), 'wb') as f:
+        f.write(key)
+    if sys.platform == 'win32':
+        address = rf'\\.\pipe\wesa_parser-test-{os.getpid()}'
+    else:
+        address = str(tmp_path / 'daemon.sock')
+    listener = Listener(address, authkey=key)
+    replies = []
+
+    def serve():
+        with listener.accept() as conn:
+            conn.recv()
+            for reply in replies:
+                conn.send(reply)
+
+    thread = threading.Thread(target=serve, daemon=True)
+    thread.start()
+    yield address, replies
+    thread.join(5)
+    listener.close()
+
+
+def test_completed_batch_returns_processed_count(daemon):
+    address, replies = daemon
+    replies.extend([('log', 'Файл успешно обработан'), ('done', 3)])
+    messages = []
+    assert run_remote(['a.docx'], 'out', '2', messages.append, address=address) == 3
+    assert messages == ['Файл успешно обработан']
+
+
+def test_dropped_daemon_falls_back_to_local_processing(daemon):
+    # Демон упал посреди пакета: вызывающий должен обработать пакет сам, а не считать его готовым
+    address, replies = daemon
+    replies.append(('log', 'Файл успешно обработан'))
+    messages = []
+    assert run_remote(['a.docx', 'b.docx'], 'out', '2', messages.append, address=address) is None
+    assert messages[-1].startswith("Фоновый обработчик прервал соединение")
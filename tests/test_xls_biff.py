@@ -0,0 +1,141 @@
+import re
+import struct
+import pytest
+from compound_file import build
+from excel_parser import ExcelProcessor
+from ole_file import OleError, OleFile
+from rules import sub_sequential
+from xls_biff import XlsProcessor, XlsUnsupported, collect_texts
+
+SUMMARY = b'\x05SummaryInformation'.decode('latin-1')
+
+
+def record(kind, body=b''):
+    return struct.pack('<2H', kind, len(body)) + body
+
+
+def xl_string(text, rich_runs=0):
+    high = any(ord(char) > 255 for char in text)
+    flags = (0x01 if high else 0) | (0x08 if rich_runs else 0)
+    head = struct.pack('<HB', len(text), flags) + (struct.pack('<H', rich_runs) if rich_runs else b'')
+    return head + text.encode('utf-16-le' if high else 'latin-1') + b'\0' * 4 * rich_runs
+
+
+def workbook(fillers=0):
+    """Поток Workbook: SST со строкой, перенесённой в CONTINUE, колонтитулы и ячейки LABEL."""
+    sst = struct.pack('<2L', 4, 4) + xl_string('ED.D.P123.1') + xl_string('Rich 10ABC', rich_runs=1)
+    sst += xl_string('UKD 20UKD')
+    # 'Блок 10UKD': начало в SST 16-битными символами, продолжение в CONTINUE 8-битными
+    sst += struct.pack('<HB', 10, 0x01) + 'Блок'.encode('utf-16-le')
+    cont = b'\x00' + ' 10UKD'.encode('latin-1')
+    data = record(0x0809, struct.pack('<4H2L', 0x0600, 0x0005, 0, 0, 0, 0))
+    data += record(0x00FC, sst) + record(0x003C, cont)
+    data += record(0x0014, xl_string('&R&11C02')) + record(0x0015, xl_string('&L&11ED.D.P123.1'))
+    data += record(0x0204, struct.pack('<3H', 0, 0, 15) + xl_string('20XYZ-10UKD'))
+    for index in range(fillers):
+        data += record(0x0204, struct.pack('<3H', index + 1, 0, 15) + xl_string(f'строка {index}'))
+    return data + record(0x000A)
+
+
+def write_xls(tmp_path, data, name='book.xls'):
+    path = tmp_path / name
+    path.write_bytes(data)
+    return str(path)
+
+
+def read_texts(path):
+    with open(path, 'rb') as f:
+        return [text.text for text in collect_texts(OleFile(f.read()).open_stream('Workbook').data)]
+
+
+def test_collect_texts_reads_continue_and_rich_strings():
+    assert [text.text for text in collect_texts(workbook())] == [
+        'ED.D.P123.1', 'Rich 10ABC', 'UKD 20UKD', 'Блок 10UKD', '&R&11C02', '&L&11ED.D.P123.1', '20XYZ-10UKD']
+
+
+@pytest.mark.parametrize('fillers, sector_shift, scatter', [
+    (0, 9, False),  # Workbook в мини-потоке
+    (0, 9, True),
+    (400, 9, True),  # Workbook в обычных секторах, разбросанных по файлу
+    (400, 12, False),  # версия 4, сектор 4096 байт
+])
+def test_equal_length_patch_round_trip(tmp_path, fillers, sector_shift, scatter):
+    summary = bytes(range(256)) * 2
+    source = build({'Workbook': workbook(fillers), SUMMARY: summary}, sector_shift, scatter)
+    input_path = write_xls(tmp_path, source)
+    outputs = {digit: str(tmp_path / f'{digit}.xls') for digit in '234'}
+    assert XlsProcessor('1').process_file_fanout(input_path, outputs)
+
+    original = read_texts(input_path)
+    for digit, output_path in outputs.items():
+        patterns = ExcelProcessor(digit).patterns
+        assert read_texts(output_path) == [sub_sequential(patterns, text) for text in original]
+        with open(output_path, 'rb') as f:
+            result = f.read()
+        # Структура файла та же: меняются только байты символов строк
+        assert len(result) == len(source)
+        assert OleFile(result).open_stream(SUMMARY).data == summary
+    assert read_texts(outputs['3'])[3:6] == ['Блок 30UKD', '&R&11C01', '&L&11ED.D.P123.3']
+
+
+def _processor_with(pattern, replacement):
+    processor = XlsProcessor('2')
+    processor.patterns = [(re.compile(pattern), replacement)]
+    return processor
+
+
+@pytest.mark.parametrize('pattern, replacement', [
+    ('UKD', 'UKDX'),  # меняется длина строки
+    ('XYZ', 'ЖЖЖ'),  # символы не помещаются в 8-битную строку
+])
+def test_unpatchable_replacement_needs_conversion(tmp_path, pattern, replacement):
+    input_path = write_xls(tmp_path, build({'Workbook': workbook()}))
+    output_path = tmp_path / 'out.xls'
+    assert _processor_with(pattern, replacement).process_file_fanout(input_path, {'2': str(output_path)}) is None
+    assert not output_path.exists()
+
+
+def test_truncated_compound_file_is_rejected(tmp_path):
+    source = build({'Workbook': workbook(400)})
+    with pytest.raises(OleError):
+        OleFile(source[:len(source) // 2]).open_stream('Workbook')
+    with pytest.raises(OleError):
+        OleFile(source[:300])
+    with pytest.raises(OleError):
+        OleFile(source[:600])  # без таблицы FAT
+    input_path = write_xls(tmp_path, source[:len(source) // 2])
+    output_path = tmp_path / 'out.xls'
+    assert XlsProcessor('2').process_file_fanout(input_path, {'2': str(output_path)}) is None
+    assert not output_path.exists()
+
+
+def test_truncated_records_are_rejected(tmp_path):
+    data = workbook()
+    # SST обещает больше строк, чем в нём есть
+    sst = data.index(struct.pack('<2H', 0x00FC, 0)[:2])
+    broken = bytearray(data)
+    struct.pack_into('<2L', broken, sst + 4, 9, 9)
+    with pytest.raises(XlsUnsupported):
+        collect_texts(bytes(broken))
+    input_path = write_xls(tmp_path, build({'Workbook': bytes(broken)}))
+    assert XlsProcessor('2').process_file_fanout(input_path, {'2': str(tmp_path / 'out.xls')}) is None
+
+
+def test_password_protected_workbook_is_rejected():
+    data = workbook()
+    bof_end = 4 + 16
+    with pytest.raises(XlsUnsupported):
+        collect_texts(data[:bof_end] + record(0x002F, b'\0' * 6) + data[bof_end:])
+
+
+def test_ole_stream_patch_stays_inside_stream():
+    source = build({'Workbook': workbook(400)}, scatter=True)
+    stream = OleFile(source).open_stream('Workbook')
+    assert len(stream.extents) > 1
+    buffer = bytearray(source)
+    # Запись через границу несмежных секторов
+    boundary = stream.extents[0][1] - 2
+    stream.patch(buffer, boundary, b'ABCD')
+    assert OleFile(bytes(buffer)).open_stream('Workbook').data[boundary:boundary + 4] == b'ABCD'
+    with pytest.raises(OleError):
+        stream.patch(buffer, len(stream.data) - 1, b'AB')
@@ -0,0 +1,124 @@
+import pytest
+from lxml import etree as ET
+from word_parser import WordProcessor
+from xml_splice import CachedParts, SpliceError, XmlPart
+
+W = 'http://schemas.openxmlformats.org/wordprocessingml/2006/main'
+
+DOCUMENT = (
+    "<?xml version='1.0' encoding='UTF-8' standalone='yes'?>\r\n"
+    f"<w:document xmlns:w='{W}' xmlns:x=\"urn:x\">\r\n"
+    "  <w:body>\r\n"
+    "    <!-- 10UKD в комментарии -->\r\n"
+    "    <w:p><w:r><w:rPr><w:b/></w:rPr><w:t>1</w:t></w:r>"
+    "<w:r><w:t xml:space='preserve'>0UKD и ED.D.P123.</w:t></w:r><w:r><w:t>2</w:t></w:r></w:p>\r\n"
+    "    <w:p><w:r><w:t>A &amp; B &#x41;&lt;10UKD&gt;</w:t></w:r></w:p>\r\n"
+    "    <w:p><w:r><w:t/></w:r><w:r><w:tab/>Unit 1 после</w:r>хвост 10ABC<x:y a=\"1>2\"/>хвост 20XYZ</w:p>\r\n"
+    "  </w:body>\r\n"
+    "</w:document>"
+).encode('utf-8')
+
+
+def canonical(data):
+    return ET.tostring(ET.fromstring(data), method='c14n')
+
+
+def spliced_and_full(part):
+    """Правки поверх исходника и полная сериализация того же дерева."""
+    return part._splice(*part.changed()), part._serialize()
+
+
+def texts(tree, tag):
+    return [node.text for node in tree.iter(f'{{{W}}}{tag}')]
+
+
+def test_splice_keeps_untouched_bytes():
+    part = XmlPart(DOCUMENT)
+    part.tree.find(f'.//{{{W}}}t').text = '2'
+    spliced, full = spliced_and_full(part)
+    # Изменился ровно один символ, объявление, кавычки и переводы строк остались как были
+    assert spliced == DOCUMENT.replace(b'<w:t>1</w:t>', b'<w:t>2</w:t>', 1)
+    assert canonical(spliced) == canonical(full)
+    assert part.to_bytes() == spliced
+
+
+def test_splice_escapes_entities():
+    part = XmlPart(DOCUMENT)
+    node = part.tree.findall(f'.//{{{W}}}t')[3]
+    assert node.text == 'A & B A<10UKD>'
+    node.text = node.text.replace('10UKD', '20UKD') + ' <b> & \r'
+    spliced, full = spliced_and_full(part)
+    assert b'<w:t>A &amp; B A&lt;20UKD&gt; &lt;b&gt; &amp; &#13;</w:t>' in spliced
+    assert canonical(spliced) == canonical(full)
+    assert ET.fromstring(spliced).findall(f'.//{{{W}}}t')[3].text == node.text
+
+
+def test_splice_tails_and_comments():
+    part = XmlPart(DOCUMENT)
+    root = part.tree.getroot()
+    comment = next(node for node in root.iter() if node.tag is ET.Comment)
+    comment.text = comment.text.replace('10UKD', '20UKD')
+    tab = root.find(f'.//{{{W}}}tab')
+    tab.tail = tab.tail.replace('Unit 1', 'Unit 2')
+    last_run = tab.getparent()
+    last_run.tail = 'хвост 20ABC'
+    y = root.find('.//{urn:x}y')
+    y.tail = ''
+    spliced, full = spliced_and_full(part)
+    assert canonical(spliced) == canonical(full)
+    assert b'<!-- 20UKD' in spliced and b'<x:y a="1>2"/></w:p>' in spliced
+
+
+def test_text_of_empty_element_falls_back_to_full_serialization():
+    part = XmlPart(DOCUMENT)
+    empty = part.tree.findall(f'.//{{{W}}}t')[4]
+    assert empty.text is None
+    empty.text = 'новый'
+    with pytest.raises(SpliceError):
+        part._splice(*part.changed())
+    assert part.to_bytes() == part._serialize()
+    assert texts(ET.fromstring(part.to_bytes()).getroottree(), 't')[4] == 'новый'
+
+
+def test_cdata_falls_back_to_full_serialization():
+    data = f"<w:document xmlns:w='{W}'><w:t><![CDATA[10UKD <сырой>]]></w:t></w:document>".encode('utf-8')
+    part = XmlPart(data)
+    node = part.tree.find(f'{{{W}}}t')
+    node.text = node.text.replace('10UKD', '20UKD')
+    with pytest.raises(SpliceError):
+        part._splice(*part.changed())
+    result = part.to_bytes()
+    assert ET.fromstring(result).find(f'{{{W}}}t').text == '20UKD <сырой>'
+
+
+def test_structure_change_falls_back_to_full_serialization():
+    part = XmlPart(DOCUMENT)
+    body = part.tree.find(f'{{{W}}}body')
+    ET.SubElement(body, f'{{{W}}}p')
+    part.tree.find(f'.//{{{W}}}t').text = '2'
+    with pytest.raises(SpliceError):
+        part._splice(*part.changed())
+    assert part.to_bytes() == part._serialize()
+
+
+@pytest.mark.parametrize('digit', '1234')
+def test_word_replacements_across_runs(digit):
+    # Правила видят текст абзаца целиком: 10UKD и ED.D.P123.2 разбиты по нескольким <w:t>
+    part = XmlPart(DOCUMENT)
+    assert WordProcessor(digit)._process_xml_tree(part.tree)
+    spliced, full = spliced_and_full(part)
+    assert canonical(spliced) == canonical(full)
+    paragraph = ''.join(texts(ET.fromstring(spliced).getroottree(), 't')[:3])
+    assert paragraph == f'{digit}0UKD и ED.D.P123.{digit}'
+
+
+def test_cached_parts_match_fresh_parse_for_each_digit():
+    # Одна часть для нескольких цифр: после restore следующая цифра считается от исходного текста
+    processor = WordProcessor('1')
+    parts = CachedParts({'word/document.xml': DOCUMENT}, None, lambda message: None)
+    for digit in '2341':
+        processor.set_digit(digit)
+        result = parts.transform(processor._process_xml_tree, processor.rules_key, digit)
+        fresh = XmlPart(DOCUMENT)
+        processor._process_xml_tree(fresh.tree)
+        assert canonical(result['word/document.xml']) == canonical(fresh._serialize())
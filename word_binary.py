@@ -0,0 +1,248 @@
+import os
+import re
+import struct
+from ole_file import OleFile, OleError, OLE_SIGNATURE
+from rules import apply_edits
+from word_parser import REVISIONS_HEADING, WordProcessor
+
+# Документ Word 97–2003 ([MS-DOC]): поток WordDocument начинается с FIB
+_WORD_IDENT = 0xA5EC
+_MIN_NFIB = 0x00C1  # Word 97 и новее; Word 6/95 устроены иначе
+_ENCRYPTED = 0x0100
+_TABLE_1 = 0x0200  # fWhichTblStm: таблицы в потоке 1Table, иначе 0Table
+_CLX_INDEX = 33  # пара fcClx/lcbClx в FibRgFcLcb
+
+# Счётчики символов поддокументов в FibRgLw97 (смещения от начала блока)
+_CCP = {
+    'text': 12, 'ftn': 16, 'hdd': 20, 'mcr': 24,
+    'atn': 28, 'edn': 32, 'txbx': 36, 'hdr_txbx': 40,
+}
+
+# Элементы Clx: Prc (свойства, пропускаются) и Pcdt (таблица кусков)
+_PRC = 0x01
+_PCDT = 0x02
+_COMPRESSED = 0x40000000
+
+# Символы, завершающие абзац: конец абзаца, ячейки или строки таблицы, разрыв страницы/раздела
+_PARAGRAPH_END = re.compile('[\r\x07\x0c]')
+
+
+class DocUnsupported(Exception):
+    """Документ нельзя изменить на месте: нужна конвертация через Word."""
+
+
+class _Piece:
+    """Кусок текста: диапазон CP и его место в потоке WordDocument."""
+
+    __slots__ = ('cp_start', 'cp_end', 'position', 'compressed')
+
+    def __init__(self, cp_start, cp_end, position, compressed):
+        self.cp_start = cp_start
+        self.cp_end = cp_end
+        self.position = position
+        self.compressed = compressed
+
+    @property
+    def width(self):
+        return 1 if self.compressed else 2
+
+    @property
+    def encoding(self):
+        # Сжатый текст — 8-битный cp1252 ([MS-DOC] 2.4.1), иначе UTF-16LE
+        return 'cp1252' if self.compressed else 'utf-16-le'
+
+
+def _fib(data):
+    """Разбор FIB: флаги, счётчики символов поддокументов и положение Clx."""
+    if len(data) < 34:
+        raise DocUnsupported("поток WordDocument слишком короткий")
+    ident, nfib = struct.unpack_from('<2H', data, 0)
+    if ident != _WORD_IDENT:
+        raise DocUnsupported("не документ Word")
+    if nfib < _MIN_NFIB:
+        raise DocUnsupported("формат Word 6/95")
+    flags = struct.unpack_from('<H', data, 10)[0]
+    if flags & _ENCRYPTED:
+        raise DocUnsupported("документ защищён паролем")
+
+    csw = struct.unpack_from('<H', data, 32)[0]
+    position = 34 + csw * 2
+    cslw = struct.unpack_from('<H', data, position)[0]
+    lw = position + 2
+    counts = {name: struct.unpack_from('<l', data, lw + offset)[0] for name, offset in _CCP.items()}
+    position = lw + cslw * 4
+    cb_rg_fc_lcb = struct.unpack_from('<H', data, position)[0]
+    if cb_rg_fc_lcb <= _CLX_INDEX:
+        raise DocUnsupported("в FIB нет таблицы кусков")
+    fc_clx, lcb_clx = struct.unpack_from('<2L', data, position + 2 + _CLX_INDEX * 8)
+    table = '1Table' if flags & _TABLE_1 else '0Table'
+    return counts, table, fc_clx, lcb_clx
+
+
+def _pieces(table, fc_clx, lcb_clx):
+    """Таблица кусков (PlcPcd) из Clx потока таблиц."""
+    position = fc_clx
+    end = fc_clx + lcb_clx
+    if end > len(table):
+        raise DocUnsupported("Clx за пределами потока таблиц")
+    while position < end and table[position] == _PRC:
+        size = struct.unpack_from('<h', table, position + 1)[0]
+        position += 3 + size
+    if position >= end or table[position] != _PCDT:
+        raise DocUnsupported("нет таблицы кусков")
+    lcb = struct.unpack_from('<L', table, position + 1)[0]
+    position += 5
+    count = (lcb - 4) // 12  # (n + 1) CP по 4 байта и n Pcd по 8 байт
+    cps = struct.unpack_from(f'<{count + 1}l', table, position)
+    descriptors = position + (count + 1) * 4
+    pieces = []
+    for index in range(count):
+        fc = struct.unpack_from('<L', table, descriptors + index * 8 + 2)[0]
+        if fc & _COMPRESSED:
+            pieces.append(_Piece(cps[index], cps[index + 1], (fc & ~_COMPRESSED) // 2, True))
+        else:
+            pieces.append(_Piece(cps[index], cps[index + 1], fc, False))
+    return pieces
+
+
+def _subdocuments(counts):
+    """Диапазоны CP, которые обрабатываются: основной текст, колонтитулы и надписи.
+
+    Поддокументы идут в потоке подряд: основной текст, сноски, колонтитулы,
+    макросы, примечания, концевые сноски, надписи, надписи колонтитулов.
+    Сноски и примечания не меняются — как и в .docx.
+    """
+    ranges = []
+    cp = 0
+    for name in ('text', 'ftn', 'hdd', 'mcr', 'atn', 'edn', 'txbx', 'hdr_txbx'):
+        count = max(counts[name], 0)
+        if count and name in ('text', 'hdd', 'txbx', 'hdr_txbx'):
+            ranges.append((cp, cp + count))
+        cp += count
+    return ranges
+
+
+class _Document:
+    """Текст документа .doc по CP с отображением каждого символа на байты потока WordDocument."""
+
+    def __init__(self, data):
+        ole = OleFile(data)
+        self.stream = ole.open_stream('WordDocument')
+        counts, table_name, fc_clx, lcb_clx = _fib(self.stream.data)
+        if not ole.exists(table_name):
+            raise DocUnsupported(f"нет потока {table_name}")
+        self.pieces = _pieces(ole.open_stream(table_name).data, fc_clx, lcb_clx)
+        self.ranges = _subdocuments(counts)
+        self.main_end = counts['text']
+
+    def _piece(self, cp):
+        for piece in self.pieces:
+            if piece.cp_start <= cp < piece.cp_end:
+                return piece
+        raise DocUnsupported(f"символ {cp} вне таблицы кусков")
+
+    def text(self, start, end):
+        chunks = []
+        data = self.stream.data
+        for piece in self.pieces:
+            first = max(start, piece.cp_start)
+            last = min(end, piece.cp_end)
+            if first >= last:
+                continue
+            offset = piece.position + (first - piece.cp_start) * piece.width
+            raw = data[offset:offset + (last - first) * piece.width]
+            if len(raw) != (last - first) * piece.width:
+                raise DocUnsupported("текст за пределами потока WordDocument")
+            chunks.append(raw.decode(piece.encoding, 'replace'))
+        return ''.join(chunks)
+
+    def paragraphs(self):
+        """(первый CP, текст) каждого абзаца в обрабатываемых поддокументах."""
+        for start, end in self.ranges:
+            text = self.text(start, end)
+            cursor = 0
+            for match in _PARAGRAPH_END.finditer(text):
+                if match.start() > cursor:
+                    yield start + cursor, text[cursor:match.start()]
+                cursor = match.end()
+            if cursor < len(text):
+                yield start + cursor, text[cursor:]
+
+    def patch(self, buffer, cp, text):
+        """Замена символов с позиции cp в копии файла buffer; длина текста не меняется."""
+        for offset, char in enumerate(text):
+            piece = self._piece(cp + offset)
+            try:
+                encoded = char.encode(piece.encoding)
+            except UnicodeEncodeError:
+                raise DocUnsupported(f"символ '{char}' не помещается в 8-битный текст")
+            self.stream.patch(buffer, piece.position + (cp + offset - piece.cp_start) * piece.width, encoded)
+
+
+class DocProcessor(WordProcessor):
+    """Обработка .doc (Word 97–2003) без Word: правка текста на месте в копии файла.
+
+    Составной файл, FIB и таблица кусков разбираются один раз; правила
+    WordProcessor применяются к абзацам основного текста, колонтитулов
+    и надписей. Символы заменяются в тех же секторах файла, поэтому
+    разметка документа не меняется. Если замена меняет длину текста,
+    документ содержит лист регистрации изменений (очистка таблицы меняет
+    структуру) или защищён паролем, файл отдаётся на конвертацию через Word
+    (process_file_fanout возвращает None). Файлы .doc, которые на деле
+    являются пакетами OOXML, обрабатываются как .docx.
+    """
+
+    def iter_texts(self, input_path):
+        """Тексты для индекса идентификаторов: абзацы, которые получают правила ('WordDocument', текст)."""
+        with open(input_path, 'rb') as f:
+            data = f.read()
+        if not data.startswith(OLE_SIGNATURE):
+            yield from super().iter_texts(input_path)
+            return
+        for _, text in _Document(data).paragraphs():
+            yield 'WordDocument', text
+
+    def process_file_fanout(self, input_path, outputs):
+        """Обработка для нескольких блоков: outputs — {цифра: путь}; None — нужна конвертация."""
+        with open(input_path, 'rb') as f:
+            data = f.read()
+        if not data.startswith(OLE_SIGNATURE):
+            return super().process_file_fanout(input_path, outputs)
+
+        filename = os.path.basename(input_path)
+        self._log(f"Открыт файл: {input_path}")
+        try:
+            document = _Document(data)
+            paragraphs = list(document.paragraphs())
+            if any(REVISIONS_HEADING.search(text) for cp, text in paragraphs if cp < document.main_end):
+                raise DocUnsupported("лист регистрации изменений очищается только в .docx")
+        except (OleError, DocUnsupported, struct.error) as e:
+            self._log(f"Без конвертации не обработать {filename}: {e}")
+            return None
+
+        initial_digit = self.replacement_digit
+        patched = {}
+        try:
+            for digit in outputs:
+                self.set_digit(digit)
+                buffer = bytearray(data)
+                found = self.rules.find_edits_batch([text for _, text in paragraphs])
+                for index, edits in found.items():
+                    cp, text = paragraphs[index]
+                    for start, end, replacement in edits:
+                        if len(replacement) != end - start:
+                            raise DocUnsupported(f"меняется длина текста '{text[start:end]}'")
+                        document.patch(buffer, cp + start, replacement)
+                    self._log(f"Замена текста: '{text}' → '{apply_edits(text, edits)}'")
+                patched[digit] = buffer
+        except (OleError, DocUnsupported) as e:
+            self._log(f"Без конвертации не обработать {filename}: {e}")
+            return None
+        finally:
+            self.set_digit(initial_digit)
+
+        for digit, output_path in outputs.items():
+            with open(output_path, 'wb') as f:
+                f.write(patched[digit])
+            self._log(f"Файл успешно обработан: {output_path}")
+        return True
@@ -1,22 +1,106 @@
 import os
 import re
-from shutil import rmtree
-from tempfile import mkdtemp
-from zipfile import ZipFile
-from lxml import etree as ET
+from bisect import bisect_right
+from io import BytesIO
+from itertools import accumulate, filterfalse
+from operator import attrgetter
 import logging
+from lxml import etree as ET
+from backends import DOC
+from host_process import HOST_PROCESSES, process_ids, resolve_host
+from excel_parser import ExcelProcessor
+from ooxml_package import Package
+from part_cache import rules_key
+from rules import RuleSet, SEPARATOR, apply_edits
+from xml_splice import CachedParts
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger('WordProcessor')
 
+W_NS = 'http://schemas.openxmlformats.org/wordprocessingml/2006/main'
+W_P = f'{{{W_NS}}}p'
+W_T = f'{{{W_NS}}}t'
+
+_TEXT = attrgetter('text')
+_TAIL = attrgetter('tail')
+
+# Заголовок таблицы изменений, строки данных которой очищаются
+REVISIONS_HEADING = re.compile(r'Лист\s+регистрации\s+изменений|Record\s+of\s+revisions', re.IGNORECASE)
+
+# Вложенные OOXML-пакеты в word/embeddings/, которые обрабатываются рекурсивно
+EMBEDDED_PACKAGES = {'.docx': 'word', '.docm': 'word', '.xlsx': 'excel', '.xlsm': 'excel'}
+MAX_EMBEDDING_DEPTH = 3
+
+
+class DocConverter:
+    """Конвертация .doc в .docx через один экземпляр Word (COM).
+
+    Используется только для документов, которые нельзя изменить на месте
+    (word_binary.DocProcessor). Экземпляр запускается один раз в start()
+    и переиспользуется для всех файлов из одного и того же потока.
+    """
+
+    def __init__(self, log_callback=None):
+        self.log = log_callback or (lambda msg: None)
+        self.word = None
+        self.host_pid = None  # PID запущенного нами Word (None — не наш или неизвестен)
+
+    def start(self):
+        try:
+            import win32com.client as win32
+        except ImportError:
+            raise ImportError(
+                "pywin32 не установлен. Установите 'pip install pywin32' для конвертации на Windows.")
+        before = process_ids(HOST_PROCESSES[DOC])
+        self.word = win32.DispatchEx('Word.Application')
+        self.host_pid = resolve_host(self.word, HOST_PROCESSES[DOC], before)
+        self.word.Visible = False
+        self.word.DisplayAlerts = 0  # wdAlertsNone
+
+    def convert(self, input_path, output_path):
+        doc = self.word.Documents.Open(os.path.abspath(input_path), ConfirmConversions=False,
+                                       ReadOnly=True, AddToRecentFiles=False)
+        try:
+            doc.SaveAs2(os.path.abspath(output_path), FileFormat=16)  # 16 = wdFormatDocumentDefault (.docx)
+        finally:
+            doc.Close(False)
+        self.log(f"Конвертация завершена: {output_path}")
+
+    def stop(self):
+        try:
+            if self.word is not None:
+                self.word.Quit()
+        finally:
+            self.word = None
+            self.host_pid = None
+
+
 class WordProcessor:
-    def __init__(self, replacement_digit, log_callback=None, debug=False):
+    def __init__(self, replacement_digit, log_callback=None, debug=False, part_cache=None):
         self.replacement_digit = str(replacement_digit)
         self.debug = debug  # Флаг отладки
         self.log = log_callback or (lambda msg: None)  # Если колбэк не передан — молчит
         self._log(f"Инициализация WordProcessor с цифрой: {self.replacement_digit}")
+        self.depth = 0  # Уровень вложенности (для docx, встроенных в docx)
+        self.part_cache = part_cache  # part_cache.PartCache или None
+        self._rule_sets = {}  # цифра -> (шаблоны, RuleSet, отпечаток правил)
+
+        self.set_digit(self.replacement_digit)
 
-        self.patterns = [
+    def set_digit(self, replacement_digit):
+        """Переключение цифры замены: набор правил зависит от блока (ED.B.P000.S для 3/4).
+
+        Правила каждой цифры компилируются один раз за жизнь обработчика.
+        """
+        self.replacement_digit = str(replacement_digit)
+        if self.replacement_digit not in self._rule_sets:
+            patterns = self._build_patterns()
+            self._rule_sets[self.replacement_digit] = (patterns, RuleSet(patterns, type(self).__name__),
+                                                       rules_key('WordProcessor', patterns))
+        self.patterns, self.rules, self.rules_key = self._rule_sets[self.replacement_digit]
+
+    def _build_patterns(self):
+        patterns = [
             # ED.D.*  — меняем только последнюю цифру
             (re.compile(r'\b(ED\.D\.[A-Z]\d\d\d\.)\d\b'),
              lambda m: f"{m.group(1)}{self.replacement_digit}"),
@@ -36,11 +120,13 @@ class WordProcessor:
         ]
 
         if self.replacement_digit in ("3", "4"):
-            self.patterns.append(
+            patterns.append(
                 (re.compile(r'\bED\.B\.P000\.S\b'),
                  "ED.B.P000.W")
             )
 
+        return patterns
+
     def _log(self, message):
         # Логи, которые всегда записываются
         always_log = (
@@ -58,56 +144,105 @@ class WordProcessor:
     def _apply_replacements(self, text):
         if text is None:
             return None
-        original_text = text
-        for pattern, repl in self.patterns:
-            text = pattern.sub(repl, text)
-        if text != original_text:
-            self._log(f"Замена текста: '{original_text}' → '{text}'")
-        return text
+        new_text = self.rules.sub(text)
+        if new_text != text:
+            self._log(f"Замена текста: '{text}' → '{new_text}'")
+        return new_text
+
+    def _collect_paragraph_runs(self, tree):
+        """Группировка <w:t> по ближайшему родительскому <w:p>.
+
+        Вложенные абзацы (надписи, содержимое элементов управления) образуют
+        свои группы, поэтому каждый <w:t> попадает ровно в один абзац.
+        """
+        paragraphs = {}
+        for t in tree.iter(W_T):
+            # Обычно <w:t> лежит в <w:r> прямо внутри абзаца — без обхода всех предков
+            run = t.getparent()
+            p = run.getparent() if run is not None else None
+            if p is None or p.tag != W_P:
+                p = next(t.iterancestors(W_P), None)
+                if p is None:
+                    continue
+            paragraphs.setdefault(p, []).append(t)
+        return paragraphs
+
+    def _process_paragraph(self, runs, texts, full_text, edits):
+        """Правки (edits) склеенного текста абзаца с точной раскладкой по <w:t>."""
+        # Карта смещений: bounds[i] — конец текста i-го <w:t> в тексте абзаца
+        bounds = list(accumulate(len(text) for text in texts))
+        pieces = [[] for _ in runs]
+
+        def owner(pos):
+            return min(bisect_right(bounds, pos), len(runs) - 1)
+
+        def copy(start, end):
+            while start < end:
+                i = owner(start)
+                stop = min(end, bounds[i])
+                pieces[i].append(full_text[start:stop])
+                start = stop
+
+        cursor = 0
+        for start, end, replacement in edits:
+            copy(cursor, start)
+            if len(replacement) == end - start:
+                # Замена той же длины — посимвольно, форматирование каждого run сохраняется
+                for offset, char in enumerate(replacement):
+                    pieces[owner(start + offset)].append(char)
+            else:
+                pieces[owner(start)].append(replacement)
+            cursor = end
+        copy(cursor, len(full_text))
+
+        new_full_text = ''.join(''.join(parts) for parts in pieces)
+        self._log(f"Замена текста: '{full_text}' → '{new_full_text}'")
+        for t, text, parts in zip(runs, texts, pieces):
+            new_text = ''.join(parts)
+            if new_text != text:
+                t.text = new_text
 
     def _process_xml_tree(self, tree):
         modified = False
-        nsmap = {'w': 'http://schemas.openxmlformats.org/wordprocessingml/2006/main'}
-
-        # --- 1. Проход по всем узлам ---
-        for elem in tree.iter():
-            if elem.text:
-                new_text = self._apply_replacements(elem.text)
-                if new_text != elem.text:
-                    elem.text = new_text
-                    modified = True
-            if elem.tail:
-                new_tail = self._apply_replacements(elem.tail)
-                if new_tail != elem.tail:
-                    elem.tail = new_tail
-                    modified = True
-
-        # --- 2. Дополнительный проход — для случаев, когда "C0" и цифра разделены ---
-        for parent in tree.findall('.//w:p', namespaces=nsmap) + tree.findall('.//w:sdtContent', namespaces=nsmap):
-            texts = parent.findall('.//w:t', namespaces=nsmap)
-            if len(texts) < 2:
-                continue
+        nsmap = {'w': W_NS}
 
-            # Склеиваем текст всех <w:t> в этом контейнере
-            full_text = ''.join(t.text or '' for t in texts)
-            new_full_text = self._apply_replacements(full_text)
+        # --- 1. Абзацы: текст абзаца склеивается из всех его run, правила идут
+        # одним проходом по тексту всех абзацев части ---
+        paragraphs = list(self._collect_paragraph_runs(tree).values())
+        paragraph_runs = set()
+        for runs in paragraphs:
+            paragraph_runs.update(runs)
+        run_texts = [[t.text or '' for t in runs] for runs in paragraphs]
+        full_texts = [''.join(texts) for texts in run_texts]
+        for index, edits in self.rules.find_edits_batch(full_texts).items():
+            self._process_paragraph(paragraphs[index], run_texts[index], full_texts[index], edits)
+            full_texts[index] = ''.join(t.text or '' for t in paragraphs[index])
+            modified = True
 
-            if new_full_text != full_text:
-                modified = True
-                # Распределяем обратно по тем же <w:t>
-                idx = 0
-                for t in texts:
-                    part_len = len(t.text or '')
-                    t.text = new_full_text[idx:idx + part_len]
-                    idx += part_len
+        # --- 2. Остальные узлы (core.xml, текст вне абзацев) и все tail — тоже одним буфером ---
+        nodes = list(tree.iter())
+        text_nodes = list(filterfalse(paragraph_runs.__contains__, filter(_TEXT, nodes)))
+        tail_nodes = list(filter(_TAIL, nodes))
+        texts = list(map(_TEXT, text_nodes)) + list(map(_TAIL, tail_nodes))
+        for index, edits in self.rules.find_edits_batch(texts).items():
+            new_text = apply_edits(texts[index], edits)
+            self._log(f"Замена текста: '{texts[index]}' → '{new_text}'")
+            if index < len(text_nodes):
+                text_nodes[index].text = new_text
+            else:
+                tail_nodes[index - len(text_nodes)].tail = new_text
+            modified = True
 
         # --- 3. Новый блок: Очистка текста в столбцах таблицы "Лист регистрации изменений" или "Record of revisions" ---
+        # Сначала один поиск заголовка по тексту всех абзацев: в большинстве частей его нет
+        if not REVISIONS_HEADING.search(SEPARATOR.join(full_texts)):
+            return modified
         for p in tree.findall('.//w:p', namespaces=nsmap):
             para_texts = ''.join(t.text or '' for t in p.findall('.//w:t', namespaces=nsmap)).strip()
-            if re.search(r'Лист\s+регистрации\s+изменений|Record\s+of\s+revisions', para_texts, re.IGNORECASE):
+            if REVISIONS_HEADING.search(para_texts):
                 # Находим следующую таблицу после параграфа
                 tbl = p.getnext()
-                while tbl is not None and tbl.tag != '{http://schemas.openxmlformats.org/wordprocessingml/2006/main}tbl':
+                while tbl is not None and tbl.tag != f'{{{W_NS}}}tbl':
                     tbl = tbl.getnext()
                 if tbl is not None:
                     self._log("Найдена таблица 'Лист регистрации изменений' или 'Record of revisions'. Очистка данных в столбцах.")
@@ -127,44 +262,125 @@ class WordProcessor:
         return modified
 
     def process_file(self, input_path, output_path):
-        tmp_dir = mkdtemp()
-        self._log(f"Открыт файл: {input_path}")
-        modified_files = set()
+        return self.process_file_fanout(input_path, {self.replacement_digit: output_path})
 
-        try:
-            with ZipFile(input_path) as zip_in:
-                filenames = zip_in.namelist()
-                zip_in.extractall(tmp_dir)
+    def process_file_fanout(self, input_path, outputs):
+        """Обработка файла для нескольких блоков сразу: outputs — {цифра: путь}.
 
-            target_files = ['word/document.xml', 'docProps/core.xml']
-            target_files += [f for f in filenames if f.startswith('word/header') or f.startswith('word/footer')]
+        Пакет читается и XML разбирается один раз; для каждой цифры правила
+        применяются к тем же деревьям, которые затем возвращаются к исходному тексту.
+        """
+        self._log(f"Открыт файл: {input_path}")
 
-            for fname in target_files:
-                full_path = os.path.join(tmp_dir, fname)
-                if not os.path.exists(full_path) or os.path.getsize(full_path) == 0:
-                    self._log(f"Пропущен файл (отсутствует или пуст): {fname}")
-                    continue
-                try:
-                    parser = ET.XMLParser(remove_blank_text=True)
-                    tree = ET.parse(full_path, parser)
-                    modified = self._process_xml_tree(tree)
-                    if modified:
-                        tree.write(full_path, encoding='UTF-8', xml_declaration=True, pretty_print=True)
-                        modified_files.add(fname)
-                        self._log(f"Файл изменен: {fname}")
-                except ET.XMLSyntaxError as e:
-                    self._log(f"Ошибка XML в {fname}: {e}")
-
-            with ZipFile(output_path, 'w') as zip_out:
-                for fname in filenames:
-                    zip_out.write(os.path.join(tmp_dir, fname), fname)
-
-            self._log(f"Файл успешно обработан: {output_path}")
+        try:
+            with Package(input_path) as package:
+                self._process_package(package, outputs)
+            for output_path in outputs.values():
+                self._log(f"Файл успешно обработан: {output_path}")
             return True
 
         except Exception as e:
             self._log(f"Ошибка обработки {input_path}: {str(e)}")
             return False
 
+    @staticmethod
+    def _target_parts(filenames):
+        """Части пакета, к которым применяются правила: документ, свойства и колонтитулы."""
+        target_files = ['word/document.xml', 'docProps/core.xml']
+        target_files += [f for f in filenames if f.startswith('word/header') or f.startswith('word/footer')]
+        return target_files
+
+    def iter_texts(self, input_path):
+        """Тексты файла для индекса идентификаторов (corpus_index): (часть пакета, текст).
+
+        Те же тексты, что получают правила: абзац целиком, прочие узлы и хвосты.
+        Вложенные объекты не просматриваются.
+        """
+        with Package(input_path) as package:
+            data = package.read_parts(self._target_parts(package.namelist()))
+        for fname, xml in data.items():
+            if not xml:
+                continue
+            tree = ET.fromstring(xml)
+            paragraph_runs = set()
+            for runs in self._collect_paragraph_runs(tree).values():
+                paragraph_runs.update(runs)
+                yield fname, ''.join(t.text or '' for t in runs)
+            for node in tree.iter():
+                if node.text and node not in paragraph_runs:
+                    yield fname, node.text
+                if node.tail:
+                    yield fname, node.tail
+
+    def _process_package(self, package, outputs):
+        """Обработка открытого пакета; outputs — {цифра: путь или файловый объект}.
+
+        Возвращает {цифра: были ли изменения}. Без изменений путь получает копию
+        исходного файла, а в файловый объект ничего не записывается.
+        """
+        initial_digit = self.replacement_digit
+        target_files = self._target_parts(package.namelist())
+        data = package.read_parts(target_files)
+
+        sources = {}
+        for fname in target_files:
+            if not data.get(fname):
+                self._log(f"Пропущен файл (отсутствует или пуст): {fname}")
+                continue
+            sources[fname] = data[fname]
+        parts = CachedParts(sources, self.part_cache, self._log)
+
+        embedded = self._process_embeddings(package, list(outputs))
+
+        changed = {}
+        try:
+            for digit, output in outputs.items():
+                self.set_digit(digit)
+                modified_files = parts.transform(self._process_xml_tree, self.rules_key, digit)
+                for fname in modified_files:
+                    self._log(f"Файл изменен: {fname}")
+                for fname, results in embedded.items():
+                    if results.get(digit) is not None:
+                        modified_files[fname] = results[digit]
+                        self._log(f"Вложенный объект изменен: {fname}")
+
+                if modified_files:
+                    package.write(output, modified_files)
+                elif isinstance(output, str):
+                    # Правила ничего не нашли — пакет не пересобирается
+                    method = package.copy(output)
+                    self._log(f"Изменений нет, файл скопирован без перепаковки ({method}): {output}")
+                changed[digit] = bool(modified_files)
         finally:
-            rmtree(tmp_dir, ignore_errors=True)
\ No newline at end of file
+            self.set_digit(initial_digit)
+        return changed
+
+    def _process_embeddings(self, package, digits):
+        """Рекурсивная обработка вложенных docx/xlsx в памяти.
+
+        Возвращает {имя части: {цифра: новые bytes или None, если изменений нет}}.
+        """
+        if self.depth >= MAX_EMBEDDING_DEPTH:
+            return {}
+        names = [f for f in package.namelist()
+                 if f.startswith('word/embeddings/') and os.path.splitext(f)[1].lower() in EMBEDDED_PACKAGES]
+        results = {}
+        for fname, data in package.read_parts(names).items():
+            extension = os.path.splitext(fname)[1].lower()
+            if EMBEDDED_PACKAGES[extension] == 'word':
+                processor = WordProcessor(self.replacement_digit, log_callback=self.log, debug=self.debug,
+                                          part_cache=self.part_cache)
+                processor.depth = self.depth + 1
+            else:
+                processor = ExcelProcessor(self.replacement_digit, log_callback=self.log, debug=self.debug,
+                                           part_cache=self.part_cache)
+            self._log(f"Обработка вложенного объекта: {fname}")
+            outputs = {digit: BytesIO() for digit in digits}
+            try:
+                with Package(data) as embedded:
+                    changed = processor._process_package(embedded, outputs)
+            except Exception as e:
+                self._log(f"Ошибка обработки вложенного объекта {fname}: {str(e)}")
+                continue
+            results[fname] = {digit: outputs[digit].getvalue() if changed[digit] else None for digit in digits}
+        return results
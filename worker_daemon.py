@@ -0,0 +1,314 @@
+import argparse
+import getpass
+import os
+import queue
+import sys
+import tempfile
+import threading
+from datetime import datetime
+from multiprocessing import freeze_support
+from multiprocessing.connection import Client, Listener
+from backends import DWG
+from batch import UNITS, make_jobs
+from corpus_index import default_index_path
+from metrics import export_metrics
+from part_cache import default_cache_path
+from rules import format_rule_stats, merge_rule_stats
+from scheduler import BatchScheduler
+
+# Через сколько минут без заданий закрывать AutoCAD/SmartSketch/Excel/Word (лицензии)
+COM_IDLE_MINUTES = 30
+_KEY_BYTES = 32
+
+
+def default_address():
+    """Адрес демона текущего пользователя: именованный канал Windows или сокет Unix."""
+    if sys.platform == 'win32':
+        return rf'\\.\pipe\wesa_parser-{getpass.getuser()}'
+    return os.path.join(tempfile.gettempdir(), f'wesa_parser-{os.getuid()}.sock')
+
+
+def _key_path():
+    base = os.environ.get('LOCALAPPDATA') or os.path.expanduser('~')
+    return os.path.join(base, 'wesa_parser', 'daemon.key')
+
+
+def _read_key():
+    with open(_key_path(), 'rb') as f:
+        return f.read()
+
+
+def _connect(address=None):
+    """Соединение с запущенным демоном или None."""
+    try:
+        return Client(address or default_address(), authkey=_read_key())
+    except Exception:
+        # Нет ключа или канала, ключ от другого запуска (AuthenticationError)
+        return None
+
+
+def run_remote(input_files, output_dir, replacement_digit, log, all_units=False, idle=None, address=None):
+    """Обработка пакета запущенным демоном; возвращает число успешно обработанных.
+
+    None — демон не запущен или прервал соединение до итога пакета (пакет нужно
+    обработать самостоятельно; уже готовые им результаты перезапишутся теми же).
+    Сообщения демона передаются в log, idle вызывается, пока идёт ожидание.
+    """
+    conn = _connect(address)
+    if conn is None:
+        return None
+    with conn:
+        conn.send({'command': 'batch', 'input_files': [os.path.abspath(path) for path in input_files],
+                   'output_dir': os.path.abspath(output_dir), 'digit': replacement_digit,
+                   'all_units': all_units})
+        try:
+            while True:
+                if idle:
+                    while not conn.poll(0.1):
+                        idle()
+                kind, payload = conn.recv()
+                if kind == 'log':
+                    log(payload)
+                elif kind == 'done':
+                    return payload
+        except (EOFError, OSError):
+            log("Фоновый обработчик прервал соединение, пакет будет обработан в этом процессе")
+            return None
+
+
+def stop_daemon(address=None):
+    """Остановка демона после текущих заданий; False — демон не запущен."""
+    conn = _connect(address)
+    if conn is None:
+        return False
+    with conn:
+        conn.send({'command': 'stop'})
+    return True
+
+
+class _Session:
+    """Пакет одного клиента: передача сообщений, итог и статистика правил, когда обработаны все его файлы."""
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.remaining = 0
+        self.processed = 0
+        self.rule_stats = {}
+        self.finished = threading.Event()
+        self._lock = threading.Lock()
+
+    def send(self, kind, payload):
+        with self._lock:
+            try:
+                self.conn.send((kind, payload))
+            except (OSError, EOFError, ValueError):
+                pass  # клиент закрыт; файлы всё равно обрабатываются до конца
+
+    def log(self, message):
+        self.send('log', message)
+
+    def result(self, job, success):
+        merge_rule_stats(self.rule_stats, job.rule_stats)
+        if success:
+            self.log(f"Успешно: {job.filename}")
+            self.processed += 1
+        else:
+            self.log(f"Ошибка обработки: {job.filename}")
+        self.remaining -= 1
+        if not self.remaining:
+            self.close()
+
+    def close(self):
+        for line in format_rule_stats(self.rule_stats):
+            self.log(line)
+        self.send('done', self.processed)
+        self.finished.set()
+
+
+class WarmDaemon:
+    """Фоновый обработчик: пакеты от GUI и командной строки без повторного запуска.
+
+    Один BatchScheduler работает всё время жизни демона: пул процессов Word/Excel
+    с уже скомпилированными правилами и дочерние процессы AutoCAD, SmartSketch,
+    Excel и Word остаются запущенными между пакетами (COM-приложение закрывается
+    после com_idle_timeout секунд без заданий). Клиенты подключаются через
+    multiprocessing.connection к именованному каналу или сокету Unix; ключ
+    доступа хранится в профиле пользователя. Сообщения обработчиков получают
+    все клиенты, у которых есть незавершённые файлы, итог по файлу — только его клиент.
+    """
+
+    def __init__(self, log, address=None, debug=False, staging=False, job_timeout=None, dwg_editor=False,
+                 part_cache=True, com_idle_timeout=COM_IDLE_MINUTES * 60, index=None, metrics=None):
+        self.log = log
+        self.address = address or default_address()
+        self.debug = debug
+        self.staging = staging
+        self.job_timeout = job_timeout
+        self.dwg_editor = dwg_editor
+        self.part_cache = part_cache
+        self.com_idle_timeout = com_idle_timeout
+        self.index = index  # файл индекса идентификаторов или None
+        self.metrics = metrics  # файл *.prom или [АДРЕС:]ПОРТ для метрик демона, None — без экспорта
+        self.inbox = queue.Queue()  # (сессия, задания) от потоков клиентов
+        self.sessions = []
+        # Задание -> сессия клиента; не атрибут задания: задание передаётся дочерним процессам
+        self.owners = {}
+        self.stopping = False
+
+    def _write_key(self):
+        key = os.urandom(_KEY_BYTES)
+        path = _key_path()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(key)
+        return key
+
+    def _listen(self):
+        if sys.platform != 'win32' and os.path.exists(self.address):
+            if _connect(self.address) is not None:
+                raise RuntimeError(f"демон уже запущен: {self.address}")
+            os.remove(self.address)  # сокет остался от завершившегося демона
+        elif sys.platform == 'win32' and _connect(self.address) is not None:
+            raise RuntimeError(f"демон уже запущен: {self.address}")
+        return Listener(self.address, authkey=self._write_key())
+
+    def _accept(self, listener):
+        while True:
+            try:
+                conn = listener.accept()
+            except OSError:
+                return  # слушатель закрыт
+            except Exception:
+                continue  # клиент с неверным ключом
+            threading.Thread(target=self._serve, args=(conn,), daemon=True).start()
+
+    def _serve(self, conn):
+        try:
+            request = conn.recv()
+        except (OSError, EOFError):
+            conn.close()
+            return
+        if request.get('command') == 'stop':
+            self.inbox.put(None)
+            conn.close()
+            return
+        session = _Session(conn)
+        try:
+            jobs = make_jobs(request['input_files'], request['output_dir'], request['digit'], session.log,
+                             all_units=request['all_units'])
+        except Exception as e:
+            session.log(f"Критическая ошибка: {str(e)}")
+            jobs = []
+        if jobs:
+            session.remaining = len(jobs)
+            self.inbox.put((session, jobs))
+        else:
+            session.close()
+        session.finished.wait()
+        conn.close()
+
+    def _more(self):
+        jobs = []
+        while True:
+            try:
+                item = self.inbox.get_nowait()
+            except queue.Empty:
+                break
+            if item is None:
+                self.stopping = True
+                self.log("Получена команда остановки: демон завершится после текущих заданий")
+                continue
+            session, new_jobs = item
+            self.sessions.append(session)
+            for job in new_jobs:
+                self.owners[job] = session
+            self.log(f"Принят пакет: {len(new_jobs)} файлов")
+            jobs.extend(new_jobs)
+        if self.stopping and not jobs and not any(session.remaining for session in self.sessions):
+            return None
+        return jobs
+
+    def _broadcast(self, message):
+        self.log(message)
+        for session in self.sessions:
+            if session.remaining:
+                session.log(message)
+
+    def serve(self):
+        """Работа до команды остановки (stop_daemon)."""
+        part_cache = default_cache_path() if self.part_cache is True else self.part_cache
+        listener = self._listen()
+        threading.Thread(target=self._accept, args=(listener,), daemon=True).start()
+        self.log(f"Демон запущен: {self.address}")
+        # Счётчики копятся всё время жизни демона, между пакетами тоже
+        registry, exporter = export_metrics(self.metrics, self.log) if self.metrics else (None, None)
+        scheduler = BatchScheduler(UNITS[0], debug=self.debug, staging=self.staging, job_timeout=self.job_timeout,
+                                   backend_options={DWG: {'database_only': not self.dwg_editor}},
+                                   part_cache=part_cache or None, com_idle_timeout=self.com_idle_timeout,
+                                   index=self.index, metrics=registry)
+        try:
+            for job, success in scheduler.run([], log=self._broadcast, more=self._more):
+                self.owners.pop(job).result(job, success)
+                self.sessions = [session for session in self.sessions if session.remaining]
+        finally:
+            listener.close()
+            if exporter is not None:
+                exporter.stop()
+            if sys.platform != 'win32' and os.path.exists(self.address):
+                os.remove(self.address)
+            self.log("Демон остановлен")
+
+
+def main(argv=None):
+    """Запуск: python worker_daemon.py [--debug]; остановка: python worker_daemon.py --stop."""
+    parser = argparse.ArgumentParser(description="Фоновый обработчик пакетов для GUI и batch.py --daemon")
+    parser.add_argument("--stop", action="store_true", help="Остановить запущенный демон")
+    parser.add_argument("--staging", action="store_true", help="Локальная подготовка файлов (сетевые папки)")
+    parser.add_argument("--job-timeout", type=float, help="Предельное время одного файла DWG/SHA/XLS/DOC, секунды")
+    parser.add_argument("--dwg-editor", action="store_true", help="Открывать чертежи в редакторе AutoCAD")
+    parser.add_argument("--no-part-cache", action="store_true", help="Не использовать кэш частей")
+    parser.add_argument("--com-idle", type=float, default=COM_IDLE_MINUTES,
+                        help="Через сколько минут без заданий закрывать COM-приложения")
+    parser.add_argument("--index", nargs="?", const=True, metavar="ФАЙЛ",
+                        help="Пополнять индекс идентификаторов при обработке (по умолчанию — в профиле пользователя)")
+    parser.add_argument("--metrics", metavar="ФАЙЛ.prom|ПОРТ",
+                        help="Метрики Prometheus: файл для textfile collector или HTTP-порт")
+    parser.add_argument("--log", help="Файл лога демона")
+    parser.add_argument("--debug", action="store_true", help="Отладочные логи")
+    args = parser.parse_args(argv)
+
+    if args.stop:
+        if not stop_daemon():
+            print("Демон не запущен")
+            return 1
+        return 0
+
+    log_file = open(args.log, 'a', encoding='utf-8') if args.log else None
+
+    def log(message):
+        log_message = f"[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] {message}"
+        print(log_message, flush=True)
+        if log_file:
+            log_file.write(log_message + "\n")
+            log_file.flush()
+
+    daemon = WarmDaemon(log, debug=args.debug, staging=args.staging, job_timeout=args.job_timeout,
+                        dwg_editor=args.dwg_editor, part_cache=not args.no_part_cache,
+                        com_idle_timeout=args.com_idle * 60,
+                        index=default_index_path() if args.index is True else args.index,
+                        metrics=args.metrics)
+    try:
+        daemon.serve()
+    except RuntimeError as e:
+        log(str(e))
+        return 1
+    finally:
+        if log_file:
+            log_file.close()
+    return 0
+
+
+if __name__ == "__main__":
+    freeze_support()  # для пула процессов в сборке PyInstaller
+    sys.exit(main())
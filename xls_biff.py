@@ -0,0 +1,209 @@
+import os
+import struct
+from excel_parser import ExcelProcessor
+from ole_file import OleFile, OleError
+from rules import changed_indices, sub_sequential_batch
+
+# Записи BIFF8 ([MS-XLS]), в которых лежит текст
+_BOF = 0x0809
+_FILEPASS = 0x002F
+_SST = 0x00FC
+_CONTINUE = 0x003C
+_LABEL = 0x0204
+_HEADER = 0x0014
+_FOOTER = 0x0015
+_BIFF8 = 0x0600
+
+_RECORD = struct.Struct('<2H')
+
+# Флаги строки XLUnicodeRichExtendedString
+_HIGH_BYTE = 0x01
+_EXT_ST = 0x04
+_RICH_ST = 0x08
+
+
+class XlsUnsupported(Exception):
+    """Файл нельзя изменить на месте: нужна конвертация через Excel."""
+
+
+class _Text:
+    """Строка потока Workbook: текст и его части (позиция в потоке, число символов, 16-битные ли символы)."""
+
+    __slots__ = ('text', 'parts')
+
+    def __init__(self, text, parts):
+        self.text = text
+        self.parts = parts
+
+
+class _Reader:
+    """Чтение данных записи и её продолжений (CONTINUE) как одного потока.
+
+    Символы строки, перенесённые в следующую запись CONTINUE, предваряются
+    байтом флагов: кодировка продолжения может отличаться от начала строки.
+    """
+
+    def __init__(self, data, segments):
+        self.data = data
+        self.segments = segments
+        self.index = 0
+        self.pos = segments[0][0]
+
+    def _end(self):
+        start, length = self.segments[self.index]
+        return start + length
+
+    def _next_segment(self):
+        self.index += 1
+        if self.index >= len(self.segments):
+            raise XlsUnsupported("строка выходит за пределы записи")
+        self.pos = self.segments[self.index][0]
+
+    def read(self, count):
+        out = bytearray()
+        while count:
+            if self.pos >= self._end():
+                self._next_segment()
+            take = min(count, self._end() - self.pos)
+            out += self.data[self.pos:self.pos + take]
+            self.pos += take
+            count -= take
+        return bytes(out)
+
+    def chars(self, count, high_byte):
+        chunks = []
+        parts = []
+        while count:
+            if self.pos >= self._end():
+                self._next_segment()
+                high_byte = self.data[self.pos] & _HIGH_BYTE
+                self.pos += 1
+            width = 2 if high_byte else 1
+            take = min(count, (self._end() - self.pos) // width)
+            if not take:
+                raise XlsUnsupported("символ разделён между записями")
+            raw = self.data[self.pos:self.pos + take * width]
+            chunks.append(raw.decode('utf-16-le' if high_byte else 'latin-1'))
+            parts.append((self.pos, take, bool(high_byte)))
+            self.pos += take * width
+            count -= take
+        return _Text(''.join(chunks), parts)
+
+
+def _unicode_string(data, start, length):
+    """XLUnicodeString внутри одной записи: cch (2 байта), флаги, символы."""
+    reader = _Reader(data, [(start, length)])
+    cch, flags = struct.unpack('<HB', reader.read(3))
+    return reader.chars(cch, flags & _HIGH_BYTE)
+
+
+def _shared_strings(data, segments):
+    reader = _Reader(data, segments)
+    _, unique = struct.unpack('<2L', reader.read(8))
+    texts = []
+    for _ in range(unique):
+        cch, flags = struct.unpack('<HB', reader.read(3))
+        runs = struct.unpack('<H', reader.read(2))[0] if flags & _RICH_ST else 0
+        ext_size = struct.unpack('<l', reader.read(4))[0] if flags & _EXT_ST else 0
+        texts.append(reader.chars(cch, flags & _HIGH_BYTE))
+        reader.read(4 * runs + ext_size)  # форматирование и фонетика не меняются
+    return texts
+
+
+def collect_texts(data):
+    """Все изменяемые строки потока Workbook: SST, колонтитулы и ячейки LABEL."""
+    records = []
+    pos = 0
+    while pos + _RECORD.size <= len(data):
+        record_type, length = _RECORD.unpack_from(data, pos)
+        records.append((record_type, pos + _RECORD.size, length))
+        pos += _RECORD.size + length
+
+    if not records or records[0][0] != _BOF or struct.unpack_from('<H', data, records[0][1])[0] != _BIFF8:
+        raise XlsUnsupported("не BIFF8")
+    texts = []
+    for index, (record_type, start, length) in enumerate(records):
+        if record_type == _FILEPASS:
+            raise XlsUnsupported("книга защищена паролем")
+        if record_type == _SST:
+            segments = [(start, length)]
+            for next_type, next_start, next_length in records[index + 1:]:
+                if next_type != _CONTINUE:
+                    break
+                segments.append((next_start, next_length))
+            texts.extend(_shared_strings(data, segments))
+        elif record_type in (_HEADER, _FOOTER) and length:
+            texts.append(_unicode_string(data, start, length))
+        elif record_type == _LABEL:
+            texts.append(_unicode_string(data, start + 6, length - 6))  # строка, столбец, XF
+    return texts
+
+
+class XlsProcessor(ExcelProcessor):
+    """Обработка .xls (BIFF8) без Excel: правка строк на месте в копии файла.
+
+    Составной файл и поток Workbook разбираются один раз; правила
+    ExcelProcessor применяются к таблице общих строк (SST), колонтитулам
+    и ячейкам LABEL. Символы заменяются в тех же секторах файла, поэтому
+    структура книги не меняется. Если замена меняет длину строки или
+    не помещается в 8-битную кодировку, файл отдаётся на конвертацию
+    через Excel (process_file_fanout возвращает None).
+    """
+
+    def iter_texts(self, input_path):
+        """Тексты для индекса идентификаторов: строки, которые получают правила ('Workbook', текст)."""
+        with open(input_path, 'rb') as f:
+            data = f.read()
+        for text in collect_texts(OleFile(data).open_stream('Workbook').data):
+            yield 'Workbook', text.text
+
+    def process_file_fanout(self, input_path, outputs):
+        """Обработка для нескольких блоков: outputs — {цифра: путь}; None — нужна конвертация."""
+        filename = os.path.basename(input_path)
+        self._log(f"Открыт файл: {input_path}")
+        with open(input_path, 'rb') as f:
+            data = f.read()
+        try:
+            stream = OleFile(data).open_stream('Workbook')
+            texts = collect_texts(stream.data)
+        except (OleError, XlsUnsupported, struct.error) as e:
+            self._log(f"Без конвертации не обработать {filename}: {e}")
+            return None
+
+        initial_digit = self.replacement_digit
+        patched = {}
+        try:
+            for digit in outputs:
+                self.set_digit(digit)
+                buffer = bytearray(data)
+                strings = [text.text for text in texts]
+                new_strings = sub_sequential_batch(self.patterns, strings, type(self).__name__) or strings
+                for index in changed_indices(strings, new_strings):
+                    self._log(f"Замена текста: '{strings[index]}' → '{new_strings[index]}'")
+                    self._patch(stream, buffer, texts[index], new_strings[index])
+                patched[digit] = buffer
+        except XlsUnsupported as e:
+            self._log(f"Без конвертации не обработать {filename}: {e}")
+            return None
+        finally:
+            self.set_digit(initial_digit)
+
+        for digit, output_path in outputs.items():
+            with open(output_path, 'wb') as f:
+                f.write(patched[digit])
+            self._log(f"Файл успешно обработан: {output_path}")
+        return True
+
+    @staticmethod
+    def _patch(stream, buffer, text, new_text):
+        if len(new_text) != len(text.text):
+            raise XlsUnsupported(f"меняется длина строки '{text.text}'")
+        offset = 0
+        for position, count, high_byte in text.parts:
+            chunk = new_text[offset:offset + count]
+            offset += count
+            try:
+                encoded = chunk.encode('utf-16-le' if high_byte else 'latin-1')
+            except UnicodeEncodeError:
+                raise XlsUnsupported(f"символы '{chunk}' не помещаются в 8-битную строку")
+            stream.patch(buffer, position, encoded)
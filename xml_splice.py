@@ -0,0 +1,244 @@
+import re
+from itertools import compress, count, islice
+from operator import attrgetter, is_, ne
+from lxml import etree as ET
+from part_cache import content_hash
+
+# Начало любого узла внутри корня: элемент, комментарий или инструкция обработки
+_NODE_START = re.compile(rb'<(?!/)')
+_ROOT_START = re.compile(rb'<(?![?!/])')
+# Открывающий тег с учётом '>' внутри значений атрибутов
+_START_TAG = re.compile(rb'<[^>"\']*(?:(?:"[^"]*"|\'[^\']*\')[^>"\']*)*>')
+_CHAR_REF = re.compile(r'&(#x[0-9a-fA-F]+|#[0-9]+|lt|gt|amp|quot|apos);')
+_NAMED_REFS = {'lt': '<', 'gt': '>', 'amp': '&', 'quot': '"', 'apos': "'"}
+
+_TEXT = attrgetter('text')
+_TAIL = attrgetter('tail')
+
+
+class SpliceError(Exception):
+    """Исходные байты не удаётся сопоставить с деревом — нужна полная сериализация."""
+
+
+def _unescape(raw):
+    text = raw.decode('utf-8').replace('\r\n', '\n').replace('\r', '\n')
+
+    def ref(m):
+        name = m.group(1)
+        if name.startswith('#x'):
+            return chr(int(name[2:], 16))
+        if name.startswith('#'):
+            return chr(int(name[1:]))
+        return _NAMED_REFS[name]
+
+    return _CHAR_REF.sub(ref, text)
+
+
+def _escape(text):
+    text = text.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;').replace('\r', '&#13;')
+    return text.encode('utf-8')
+
+
+class XmlPart:
+    """XML-часть пакета (docx/xlsx), которая сохраняется правками поверх исходных байтов.
+
+    После обработки дерева to_bytes() находит в исходнике только изменённые
+    text/tail и подменяет их, остальное копируется как есть: отступы,
+    пробелы, порядок атрибутов и объявление XML остаются нетронутыми.
+    Если сопоставить изменения с исходником нельзя (изменилась структура,
+    CDATA, другая кодировка), часть сериализуется целиком.
+    """
+
+    def __init__(self, data):
+        self.data = data
+        self.tree = ET.fromstring(data).getroottree()
+        root = self.tree.getroot()
+        self._nodes = list(root.iter())
+        self._texts = list(map(_TEXT, self._nodes))
+        self._tails = list(map(_TAIL, self._nodes))
+
+    def changed(self):
+        """Индексы (в порядке обхода) узлов с изменённым text и tail."""
+        texts = list(map(_TEXT, self._nodes))
+        tails = list(map(_TAIL, self._nodes))
+        changed_texts = [] if texts == self._texts else list(compress(count(), map(ne, texts, self._texts)))
+        changed_tails = [] if tails == self._tails else list(compress(count(), map(ne, tails, self._tails)))
+        return changed_texts, changed_tails
+
+    def is_modified(self):
+        changed_texts, changed_tails = self.changed()
+        return bool(changed_texts or changed_tails)
+
+    def restore(self):
+        """Возврат text/tail к исходным значениям, чтобы обработать часть заново (другая цифра)."""
+        changed_texts, changed_tails = self.changed()
+        for i in changed_texts:
+            self._nodes[i].text = self._texts[i]
+        for i in changed_tails:
+            self._nodes[i].tail = self._tails[i]
+
+    def to_bytes(self):
+        changed_texts, changed_tails = self.changed()
+        if not changed_texts and not changed_tails:
+            return self.data
+        try:
+            return self._splice(changed_texts, changed_tails)
+        except SpliceError:
+            return self._serialize()
+
+    def _serialize(self):
+        docinfo = self.tree.docinfo
+        return ET.tostring(self.tree, encoding=docinfo.encoding or 'UTF-8',
+                           xml_declaration=True, standalone=docinfo.standalone)
+
+    def _check_source(self):
+        root = self.tree.getroot()
+        nodes = self._nodes
+        if sum(1 for _ in root.iter()) != len(nodes) or not all(map(is_, root.iter(), nodes)):
+            raise SpliceError("изменилась структура дерева")
+        if (self.tree.docinfo.encoding or 'UTF-8').upper().replace('_', '-') not in ('UTF-8', 'UTF8'):
+            raise SpliceError("кодировка отличается от UTF-8")
+        if b'<![CDATA[' in self.data or b'<!DOCTYPE' in self.data:
+            raise SpliceError("CDATA или DOCTYPE в исходнике")
+
+    def _splice(self, changed_texts, changed_tails):
+        self._check_source()
+        data = self.data
+        nodes = self._nodes
+
+        # Для tail нужен последний потомок узла: конец его закрывающего тега ищется от него
+        wanted = {}
+        for i in changed_texts:
+            wanted.setdefault(i, []).append(('text', i))
+        for i in changed_tails:
+            last = i + sum(1 for _ in nodes[i].iterdescendants())
+            wanted.setdefault(last, []).append(('tail', i))
+
+        root_start = _ROOT_START.search(data)
+        if root_start is None:
+            raise SpliceError("корневой элемент не найден")
+        starts = _NODE_START.finditer(data, root_start.start())
+
+        splices = []
+        position = 0
+        for index in sorted(wanted):
+            match = next(islice(starts, index - position, None), None)
+            position = index + 1
+            if match is None:
+                raise SpliceError("узел не найден в исходнике")
+            text_start, text_end, self_closing = self._locate_text(nodes[index], match.start())
+            for kind, i in wanted[index]:
+                if kind == 'text':
+                    if self_closing:
+                        if not nodes[i].text:
+                            continue
+                        raise SpliceError("текст у пустого элемента")
+                    splices.append(self._make_splice(text_start, text_end, self._texts[i], nodes[i].text))
+                else:
+                    tail_start = self._tail_start(nodes[i], nodes[index], text_end, self_closing)
+                    tail_end = data.find(b'<', tail_start)
+                    if tail_end < 0:
+                        raise SpliceError("tail корневого элемента")
+                    splices.append(self._make_splice(tail_start, tail_end, self._tails[i], nodes[i].tail))
+
+        splices.sort()
+        parts = []
+        cursor = 0
+        for start, end, payload in splices:
+            if start < cursor:
+                raise SpliceError("пересекающиеся правки")
+            parts.append(data[cursor:start])
+            parts.append(payload)
+            cursor = end
+        parts.append(data[cursor:])
+        return b''.join(parts)
+
+    def _locate_text(self, node, start):
+        """Границы text узла в исходнике и признак пустого элемента <x/>."""
+        data = self.data
+        if node.tag is ET.Comment:
+            end = data.find(b'-->', start)
+            if end < 0 or not data.startswith(b'<!--', start):
+                raise SpliceError("комментарий не найден")
+            return start + 4, end, False
+        if node.tag is ET.PI:
+            raise SpliceError("инструкция обработки")
+        qname = f"{node.prefix}:{ET.QName(node).localname}" if node.prefix else ET.QName(node).localname
+        if not data.startswith(qname.encode('utf-8'), start + 1):
+            raise SpliceError(f"ожидался тег {qname}")
+        tag = _START_TAG.match(data, start)
+        if tag is None:
+            raise SpliceError("незакрытый тег")
+        tag_end = tag.end()
+        if data[tag_end - 2:tag_end] == b'/>':
+            return tag_end, tag_end, True
+        return tag_end, data.find(b'<', tag_end), False
+
+    def _tail_start(self, node, last, text_end, self_closing):
+        """Позиция сразу за закрывающим тегом node; last — его последний потомок (или он сам)."""
+        data = self.data
+        if last.tag is ET.Comment:
+            pos = data.find(b'-->', text_end) + 3
+        elif self_closing:
+            pos = text_end
+        else:
+            pos = data.find(b'>', text_end) + 1
+        # Поднимаемся от последнего потомка к node: tail потомка, затем закрывающий тег родителя
+        while last is not node:
+            pos = data.find(b'>', data.find(b'<', pos)) + 1
+            last = last.getparent()
+        return pos
+
+    def _make_splice(self, start, end, old, new):
+        if _unescape(self.data[start:end]) != (old or ''):
+            raise SpliceError("исходный текст не совпадает с деревом")
+        return start, end, _escape(new or '')
+
+
+class CachedParts:
+    """XML-части одного пакета, обрабатываемые для нескольких цифр.
+
+    Часть разбирается только при первом промахе кэша; повторяющиеся
+    (одинаковые по содержимому) части стоят одного хеша и одного чтения кэша.
+    Без кэша (cache=None) работает как обычный разбор всех частей.
+    """
+
+    def __init__(self, sources, cache, log):
+        self.sources = sources
+        self.cache = cache
+        self.log = log
+        self.digests = {name: content_hash(data) for name, data in sources.items()} if cache else {}
+        self._parts = {}
+
+    def _part(self, name):
+        if name not in self._parts:
+            try:
+                self._parts[name] = XmlPart(self.sources[name])
+            except ET.XMLSyntaxError as e:
+                self.log(f"Ошибка XML в {name}: {e}")
+                self._parts[name] = None
+        return self._parts[name]
+
+    def transform(self, process, rules, digit):
+        """{имя: новые bytes} изменённых частей; process(tree) возвращает, были ли изменения."""
+        modified_files = {}
+        for name in self.sources:
+            if self.cache is not None:
+                cached = self.cache.get(self.digests[name], rules, digit)
+                if cached is not None:
+                    self.log(f"Часть из кэша: {name}")
+                    if cached[0]:
+                        modified_files[name] = cached[1]
+                    continue
+            part = self._part(name)
+            if part is None:
+                continue
+            data = None
+            if process(part.tree) and part.is_modified():
+                # Пишем только изменённые участки поверх исходных байтов
+                data = part.to_bytes()
+                modified_files[name] = data
+            part.restore()
+            if self.cache is not None:
+                self.cache.put(self.digests[name], rules, digit, data)
+        return modified_files